@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+/health Latency Benchmark
+Measures /health latency on an idle server and again while several scrapes
+are running, using the stub scraper so no network access is needed.
+
+Usage:
+    python3 benchmarks/health_latency.py [--scrapes 4] [--probes 200] [--latency 3]
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+STUB_SCRAPER = Path(__file__).resolve().parent / "stub_scraper.py"
+
+
+def load_server_module():
+    """Import thomasnet-server.py (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("thomasnet_server", ROOT / "thomasnet-server.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def probe_health(base_url, probes, interval):
+    """Hit /health `probes` times and return the latencies in milliseconds"""
+    latencies = []
+    for _ in range(probes):
+        start = time.perf_counter()
+        with urllib.request.urlopen(f"{base_url}/health", timeout=30) as response:
+            response.read()
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(interval)
+    return latencies
+
+
+def post_scrape(base_url, state):
+    """Run one scrape request against the server"""
+    body = json.dumps({"state": state, "service": "CNC Machining", "max_results": 10}).encode()
+    request = urllib.request.Request(f"{base_url}/scrape", data=body,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+
+
+def summarize(label, latencies):
+    print(f"{label:<22} n={len(latencies):<5} "
+          f"p50={percentile(latencies, 50):7.2f}ms  "
+          f"p99={percentile(latencies, 99):7.2f}ms  "
+          f"max={max(latencies):7.2f}ms  "
+          f"mean={statistics.mean(latencies):7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scrapes', type=int, default=4, help="concurrent scrapes to run during the loaded phase")
+    parser.add_argument('--workers', type=int, default=4, help="server scrape worker limit")
+    parser.add_argument('--probes', type=int, default=200, help="/health requests per phase")
+    parser.add_argument('--latency', type=float, default=3.0, help="stub scraper latency in seconds")
+    args = parser.parse_args()
+
+    os.environ["STUB_SCRAPER_LATENCY"] = str(args.latency)
+    server_module = load_server_module()
+    httpd = server_module.ThomasnetServer(('127.0.0.1', 0), server_module.ThomasnetHandler,
+                                          workers=args.workers, scraper_path=STUB_SCRAPER,
+                                          rate_limit=1000, rate_burst=1000)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    try:
+        # Spread the probes over roughly the scrape duration
+        interval = args.latency / args.probes
+        summarize("idle", probe_health(base_url, args.probes, interval))
+
+        # Distinct states so the scrapes aren't coalesced into one job
+        scrapers = [threading.Thread(target=post_scrape, args=(base_url, f"State {i}"))
+                    for i in range(args.scrapes)]
+        for thread in scrapers:
+            thread.start()
+        time.sleep(0.2)  # let the scrapes reach the scraper subprocess
+        summarize(f"during {args.scrapes} scrapes", probe_health(base_url, args.probes, interval))
+        for thread in scrapers:
+            thread.join()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
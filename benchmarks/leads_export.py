@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Lead Export Benchmark
+Fills scratch leads.dbs with 1,000 and with --leads synthetic leads, streams
+GET /leads/export from an in-process server in each format, and reports
+throughput and the peak Python memory allocated while streaming (server
+and client together), which should be the same for both sizes.
+
+Usage:
+    python3 benchmarks/leads_export.py                  # 1,000 vs 1,000,000 leads
+    python3 benchmarks/leads_export.py --leads 5000000
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+from health_latency import load_server_module
+from leads_search import fill
+
+EXPORTS = (("csv", "?format=csv", False), ("jsonl", "?format=jsonl", False), ("csv gzip", "?format=csv", True))
+READ_BYTES = 1 << 16
+
+
+def stream(url, gzipped):
+    """Read an export in blocks, as a download would; returns bytes received"""
+    request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"} if gzipped else {})
+    received = 0
+    with urllib.request.urlopen(request, timeout=600) as response:
+        block = response.read(READ_BYTES)
+        while block:
+            received += len(block)
+            block = response.read(READ_BYTES)
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--leads', type=int, default=1000000, help="leads in the large database (default 1000000)")
+    args = parser.parse_args()
+
+    server = load_server_module()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for count in (1000, args.leads):
+            path = os.path.join(tmpdir, f"leads-{count}.db")
+            fill(path, count, server)
+            httpd = server.ThomasnetServer(('127.0.0.1', 0), server.ThomasnetHandler, leads_path=path)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            base_url = f"http://127.0.0.1:{httpd.server_address[1]}/leads/export"
+            try:
+                for label, query, gzipped in EXPORTS:
+                    start = time.perf_counter()
+                    received = stream(base_url + query, gzipped)
+                    seconds = time.perf_counter() - start
+                    # Again with tracing on, which slows allocation too much to time the same run
+                    tracemalloc.start()
+                    stream(base_url + query, gzipped)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    print(f"{count:>8} leads  {label:<9} {count / seconds:>9.0f} rows/s  {seconds:6.2f}s  "
+                          f"{received / 1e6:8.1f}MB sent  peak {peak / 1e6:5.1f}MB")
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
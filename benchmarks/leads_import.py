@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Lead Import Benchmark
+Writes a synthetic CSV in the scraper's format and times importing it with
+LeadStore.import_csv, which POST /leads/import streams the request body
+into, so HTTP overhead is not included. It imports into an empty leads.db,
+then again with a tenth of the rows changed, reporting rows/sec for each.
+
+Usage:
+    python3 benchmarks/leads_import.py                  # 200,000 rows
+    python3 benchmarks/leads_import.py --rows 1000000
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+from health_latency import load_server_module
+
+STATES = ("OH", "TX", "CA", "MI", "IA", "GA", "FL", "AL")
+SERVICES = ("cnc", "cnc|welding", "robotic welding", "powder coating", "stamping|cnc")
+
+
+def write_csv(path, rows, changed_every=0):
+    """The scraper's CSV columns; with changed_every, every nth row gets new notes"""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Lead", "State", "Website", "Emails", "Phones", "Services", "Notes"])
+        for i in range(rows):
+            notes = "revisit" if changed_every and i % changed_every == 0 else ""
+            writer.writerow([f"Company {i} Inc.", STATES[i % len(STATES)], f"https://company{i}.example.com",
+                             f"sales@company{i}.example.com", f"(555) {i % 1000:03d}-{i % 10000:04d}",
+                             SERVICES[i % len(SERVICES)], notes])
+
+
+def time_import(store, path):
+    start = time.perf_counter()
+    with open(path, newline="", encoding="utf-8") as f:
+        result = store.import_csv(f)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help="rows in the CSV (default 200000)")
+    args = parser.parse_args()
+
+    server = load_server_module()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = server.LeadStore(os.path.join(tmpdir, "leads.db"))
+        path = os.path.join(tmpdir, "leads.csv")
+        for label, changed_every in (("new leads", 0), ("re-import, 10% changed", 10)):
+            write_csv(path, args.rows, changed_every)
+            result, seconds = time_import(store, path)
+            print(f"{label:<24} {args.rows / seconds:>9.0f} rows/s  {seconds:6.2f}s  "
+                  f"imported={result['imported']} updated={result['updated']} skipped={result['skipped']}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
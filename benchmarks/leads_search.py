@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Lead Search Benchmark
+Fills a scratch leads.db with synthetic leads and times LeadStore.search()
+(the /leads/search endpoint), LeadStore.page() (/leads), LeadStore.stats()
+(/stats) and the call queue (/queue, /queue/next, /queue/called) against it,
+reporting p50/p95/max latency per query.
+
+Usage:
+    python3 benchmarks/leads_search.py                     # 1,000,000 leads
+    python3 benchmarks/leads_search.py --leads 100000 --runs 50
+    python3 benchmarks/leads_search.py --db big.db         # keep the database for reuse
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from health_latency import load_server_module, percentile
+
+# Company names and surnames come from a few thousand made-up words, so most
+# words match a handful of leads, while suffixes and industries match many
+SYLLABLES = "ac al bar cor den el fin gal hal in jor kel lum mar nor or pel quin ros sal ter ul vex wil zan".split()
+SUFFIXES = ("Inc", "LLC", "Corp", "Manufacturing", "Machine Works", "Industries", "Fabrication", "Tool & Die")
+INDUSTRIES = ("Machining", "Plastics", "Welding", "Casting", "Forging", "Stamping", "Electronics", "Coatings")
+FIRST_NAMES = "ann bo carla dev erin farid gus hana ivan jo kai lena".split()
+STATES = ("Ohio", "Texas", "California", "Michigan", "Iowa", "Georgia")
+
+# (label, query): names and contacts of the first leads, a name's prefix as
+# it is typed, and a suffix on an eighth of all leads as the worst case
+SEARCHES = (("name", "halcor"), ("name prefix", "halc"), ("name and suffix", "roszan tool"),
+            ("contact", "ann quintercor"), ("two letters", "ro"), ("common word", "manufacturing"))
+QUEUE_REPS = 50
+PAGES = ({"state": "Ohio"}, {"state": "Texas", "sort": "last_called", "descending": True},
+         {"industry": "Welding", "sort": "company_name"}, {"never_called": True})
+
+
+def word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.choice((2, 3))))
+
+
+def make_lead(i, rng):
+    name = f"{word(rng).title()} {word(rng).title()} {rng.choice(SUFFIXES)} {i}"
+    domain = f"{name.split()[0].lower()}{i}.example.com"
+    return (name, f"{rng.choice(FIRST_NAMES).title()} {word(rng).title()}", f"sales@{domain}",
+            rng.choice(INDUSTRIES), rng.choice(STATES),
+            None if i % 4 == 0 else f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T10:00:00",
+            f"https://{domain}", f"asked about {rng.choice(INDUSTRIES).lower()}" if i % 3 == 0 else "")
+
+
+def fill(path, count, server):
+    """Create the leads table, indexes and triggers, then add `count` leads in batches"""
+    server.LeadStore(path, migrate=True).close()  # a --db kept from an older version is scratch too
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    existing = conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+    start = time.perf_counter()
+    for first in range(existing, count, 10000):
+        with conn:
+            conn.executemany("INSERT INTO leads (company_name, contact_name, email, industry, state, "
+                             "last_called, website, notes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (make_lead(i, rng) for i in range(first, min(first + 10000, count))))
+    if count > existing:
+        print(f"Inserted {count - existing} leads in {time.perf_counter() - start:.1f}s")
+    conn.close()
+
+
+def time_query(run, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        results = run()
+        samples.append((time.perf_counter() - start) * 1000)
+    return len(results), samples
+
+
+def report(label, found, samples):
+    print(f"{label:<48} {found:>4} rows  p50={percentile(samples, 50):7.2f}ms  "
+          f"p95={percentile(samples, 95):7.2f}ms  max={max(samples):7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--leads', type=int, default=1000000, help="leads in the database (default 1000000)")
+    parser.add_argument('--runs', type=int, default=20, help="timed runs of each query (default 20)")
+    parser.add_argument('--db', help="leads database to fill and keep (default a temporary file)")
+    args = parser.parse_args()
+
+    server = load_server_module()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.db or os.path.join(tmpdir, "leads.db")
+        fill(path, args.leads, server)
+        store = server.LeadStore(path)
+        for label, text in SEARCHES:
+            found, samples = time_query(lambda: store.search(text)[0], args.runs)
+            report(f"search {label} {text!r}", found, samples)
+        for options in PAGES:
+            found, samples = time_query(lambda: store.page(**options)[0], args.runs)
+            report(f"page {options}", found, samples)
+        found, samples = time_query(lambda: store.stats()["states"], args.runs)
+        report("stats", found, samples)
+
+        # A team of reps working the queue, each holding a lead ahead of the next pick
+        asks = iter(range(10 ** 9))
+        for options in ({}, {"state": "Ohio"}):
+            found, samples = time_query(lambda: store.queue(limit=20, **options), args.runs)
+            report(f"queue {options}", found, samples)
+            found, samples = time_query(lambda: [store.reserve_next(f"rep {next(asks) % QUEUE_REPS}", **options)],
+                                        args.runs)
+            report(f"queue next {options}, {QUEUE_REPS} reps", found, samples)
+        rng = random.Random(2)
+        found, samples = time_query(lambda: [store.record_call(rng.randrange(1, args.leads), "bench", "voicemail")],
+                                    args.runs)
+        report("queue called", found, samples)
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Server Load Test
+Starts thomasnet-server.py with the stub scraper, drives it with concurrent
+clients and reports requests/sec, p50/p95/p99 latency and the server's peak
+memory for a set of scenarios. Results are compared with the committed
+baselines in benchmarks/baselines.json.
+
+The stub's latency and output size are set per scenario, and can be
+overridden with --latency and --results.
+
+Usage:
+    python3 benchmarks/load_test.py                      # every scenario
+    python3 benchmarks/load_test.py scrape-cold health   # just these
+    python3 benchmarks/load_test.py --clients 32 --requests 400 scrape-cached
+    python3 benchmarks/load_test.py --save-baseline      # rewrite baselines.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from health_latency import percentile
+
+ROOT = Path(__file__).resolve().parent.parent
+SERVER = ROOT / "thomasnet-server.py"
+STUB_SCRAPER = Path(__file__).resolve().parent / "stub_scraper.py"
+BASELINES = Path(__file__).resolve().parent / "baselines.json"
+
+# name -> settings. `distinct` is how many different searches the clients
+# spread over: fewer means more cache hits and coalesced scrapes.
+SCENARIOS = {
+    "health": {
+        "description": "GET /health only",
+        "request": "health", "clients": 16, "requests": 4000,
+    },
+    "scrape-cold": {
+        "description": "POST /scrape, every search different, no cache",
+        "request": "scrape", "clients": 8, "requests": 64, "distinct": None,
+        "latency": 0.2, "results": 50, "workers": 4,
+    },
+    "scrape-cached": {
+        "description": "POST /scrape over 4 searches with the result cache on",
+        "request": "scrape", "clients": 8, "requests": 400, "distinct": 4,
+        "latency": 0.2, "results": 50, "workers": 4, "cache": True,
+    },
+    "scrape-coalesced": {
+        "description": "POST /scrape, all clients asking for the same search, no cache",
+        "request": "scrape", "clients": 8, "requests": 64, "distinct": 1,
+        "latency": 0.2, "results": 50, "workers": 4,
+    },
+    "scrape-warm-workers": {
+        "description": "scrape-cold on --warm-workers",
+        "request": "scrape", "clients": 8, "requests": 64, "distinct": None,
+        "latency": 0.2, "results": 50, "workers": 4, "warm_workers": True,
+    },
+    "results-large": {
+        "description": "GET /jobs/{id}/results of one finished 2000 prospect job, gzip accepted",
+        "request": "results", "clients": 8, "requests": 400,
+        "latency": 0, "results": 2000, "gzip": True,
+    },
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(scenario, tmpdir):
+    """Run the server CLI in its own process so its memory can be measured apart from the clients"""
+    port = free_port()
+    cmd = [sys.executable, str(SERVER), str(port), "--scraper", str(STUB_SCRAPER),
+           "--workers", str(scenario.get("workers", 4)), "--rate-limit", "100000", "--rate-burst", "100000",
+           "--jobs-db", "", "--leads-db", ""]
+    if scenario.get("cache"):
+        cmd += ["--cache-db", os.path.join(tmpdir, "cache.db")]
+    else:
+        cmd += ["--cache-ttl", "0"]
+    if scenario.get("warm_workers"):
+        cmd.append("--warm-workers")
+    env = dict(os.environ,
+               STUB_SCRAPER_LATENCY=str(scenario.get("latency", 0)),
+               STUB_SCRAPER_RESULTS=str(scenario.get("results", 10)))
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            conn.getresponse().read()
+            conn.close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+def peak_rss_mb(pid):
+    """The process's peak resident set size in MB, or None where /proc isn't available"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def make_request(scenario, index, job_id=None):
+    """(method, path, body, headers) of the index-th request of a scenario"""
+    headers = {"Accept-Encoding": "gzip"} if scenario.get("gzip") else {}
+    if scenario["request"] == "health":
+        return "GET", "/health", None, headers
+    if scenario["request"] == "results":
+        return "GET", f"/jobs/{job_id}/results", None, headers
+    distinct = scenario.get("distinct")
+    state = f"State {index % distinct if distinct else index}"
+    body = json.dumps({"state": state, "max_results": scenario.get("results", 10)})
+    return "POST", "/scrape", body, dict(headers, **{"Content-Type": "application/json"})
+
+
+def create_job(port, scenario):
+    """Run one scrape to completion for the results scenario and return its job ID"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    conn.request("POST", "/jobs", json.dumps({"max_results": scenario.get("results", 10)}),
+                 {"Content-Type": "application/json"})
+    job_id = json.loads(conn.getresponse().read())["id"]
+    while True:
+        conn.request("GET", f"/jobs/{job_id}")
+        if json.loads(conn.getresponse().read())["state"] != "running":
+            conn.close()
+            return job_id
+        time.sleep(0.05)
+
+
+def drive(port, scenario, job_id=None):
+    """
+    Send scenario["requests"] requests from scenario["clients"] threads, each
+    on its own keep-alive connection. Returns (latencies in ms, errors, seconds).
+    """
+    latencies = []
+    errors = []
+    next_index = iter(range(scenario["requests"]))
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+        while True:
+            with lock:
+                index = next(next_index, None)
+            if index is None:
+                break
+            method, path, body, headers = make_request(scenario, index, job_id)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                ok = False
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(scenario["clients"])]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors), time.perf_counter() - start
+
+
+def run_scenario(scenario):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        process, port = start_server(scenario, tmpdir)
+        try:
+            job_id = create_job(port, scenario) if scenario["request"] == "results" else None
+            latencies, errors, seconds = drive(port, scenario, job_id)
+            rss = peak_rss_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    if not latencies:
+        raise RuntimeError(f"every request failed ({errors} errors)")
+    return {
+        "clients": scenario["clients"],
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": round(len(latencies) / seconds, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.mean(latencies), 2),
+        "max_ms": round(max(latencies), 2),
+        "server_peak_rss_mb": rss,
+    }
+
+
+def change(value, baseline):
+    if value is None or not baseline:
+        return ""
+    return f" ({(value - baseline) / baseline * 100:+.0f}%)"
+
+
+def report(name, result, baseline=None):
+    baseline = baseline or {}
+    rss = result["server_peak_rss_mb"]
+    print(f"{name:<20} {result['requests']:>5} req  {result['errors']:>3} err  "
+          f"{result['rps']:>8.1f} req/s{change(result['rps'], baseline.get('rps'))}")
+    print(f"{'':<20} p50={result['p50_ms']:.2f}ms{change(result['p50_ms'], baseline.get('p50_ms'))}  "
+          f"p95={result['p95_ms']:.2f}ms{change(result['p95_ms'], baseline.get('p95_ms'))}  "
+          f"p99={result['p99_ms']:.2f}ms{change(result['p99_ms'], baseline.get('p99_ms'))}  "
+          f"rss={'n/a' if rss is None else f'{rss}MB'}"
+          f"{change(rss, baseline.get('server_peak_rss_mb'))}")
+
+
+def load_baselines():
+    try:
+        with open(BASELINES) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"scenarios": {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"scenarios to run (default all): {', '.join(SCENARIOS)}")
+    parser.add_argument('--clients', type=int, help="concurrent clients, overriding the scenario")
+    parser.add_argument('--requests', type=int, help="total requests, overriding the scenario")
+    parser.add_argument('--latency', type=float, help="stub scraper latency in seconds, overriding the scenario")
+    parser.add_argument('--results', type=int, help="prospects per scrape, overriding the scenario")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results in benchmarks/baselines.json")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+    overrides = {key: value for key, value in (("clients", args.clients), ("requests", args.requests),
+                                                ("latency", args.latency), ("results", args.results))
+                 if value is not None}
+    if overrides and args.save_baseline:
+        parser.error("baselines are only saved for the scenarios as defined")
+
+    baselines = load_baselines()
+    for name in args.scenarios or SCENARIOS:
+        scenario = dict(SCENARIOS[name], **overrides)
+        result = run_scenario(scenario)
+        report(name, result, None if overrides else baselines["scenarios"].get(name))
+        if args.save_baseline:
+            baselines["scenarios"][name] = dict(result, description=scenario["description"])
+
+    if args.save_baseline:
+        baselines["machine"] = {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        }
+        baselines["recorded_at"] = time.strftime("%Y-%m-%d")
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baselines to {BASELINES}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Stub Thomasnet Scraper
+Drop-in stand-in for thomasnet-scraper/run_scraper.py used by the benchmarks
+and tests. It takes the same arguments, sleeps instead of crawling and prints
+fake prospects.
+
+Environment variables:
+    STUB_SCRAPER_LATENCY   seconds to sleep before answering (default 1.0)
+    STUB_SCRAPER_RESULTS   number of prospects to print (default: max_results)
+    STUB_SCRAPER_FORMAT    "json" prints one JSON list at the end (default);
+                           "ndjson" prints one prospect per line as it is "found"
+    STUB_SCRAPER_INTERVAL  seconds between prospects in ndjson mode (default 0)
+    STUB_SCRAPER_EXIT_CODE exit with this status instead of printing results
+    STUB_SCRAPER_CHILD_PIDFILE  start a long-lived child process (standing in for
+                           a browser) and write its PID to this file
+    STUB_SCRAPER_RATE_LIMITED  when set, ask the server's rate limiter for a
+                           www.thomasnet.com token before each prospect, like a
+                           real scraper would before each company page
+    STUB_SCRAPER_PAGE_SIZE prospects per results page; in ndjson mode a
+                           {"__checkpoint__": ...} line follows every full page
+                           and a THOMASNET_RESUME checkpoint is honoured
+    STUB_SCRAPER_START_LOG append the index of the first prospect each run
+                           prints to this file
+    STUB_SCRAPER_SPANS     when set, print a {"__span__": ...} line for the
+                           search page (the latency sleep) and each company page
+    STUB_SCRAPER_COMPANY_LATENCY  seconds spent "visiting" each company page
+                           (default 0); companies listed in the server's
+                           THOMASNET_SKIP_FILE are skipped without a visit
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+
+def make_prospect(state, service, index):
+    """Build one fake prospect record"""
+    return {
+        "company": f"Stub Company {index}",
+        "website": f"https://stub{index}.example.com",
+        "state": state,
+        "service": service,
+        "phone": f"555-{index:04d}",
+    }
+
+
+def print_span(name, start, **attrs):
+    """Report a timed phase to the server, ending now"""
+    span = dict(attrs, name=name, start=start, duration=time.time() - start)
+    print(json.dumps({"__span__": span}), flush=True)
+
+
+def wait_for_token(host):
+    """Ask the server for a rate limit token, if it told us where"""
+    url = os.environ.get("THOMASNET_RATE_LIMIT_URL")
+    if not url:
+        return
+    import urllib.request  # only rate limited runs pay for the import at startup
+
+    body = json.dumps({"host": host, "job_id": os.environ.get("THOMASNET_JOB_ID")}).encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+
+
+def load_skip_file():
+    """Normalized company names and domains the server asked us not to visit"""
+    path = os.environ.get("THOMASNET_SKIP_FILE")
+    if not path:
+        return set(), set()
+    with open(path) as f:
+        skip = json.load(f)
+    return set(skip.get("companies", [])), set(skip.get("domains", []))
+
+
+def is_known(prospect, skip_companies, skip_domains):
+    """Match the way the server normalizes names and domains (good enough for stub companies)"""
+    host = urlparse(prospect["website"]).hostname or ""
+    domain = host[4:] if host.startswith("www.") else host
+    return prospect["company"].lower() in skip_companies or domain in skip_domains
+
+
+def resume_point(page_size):
+    """Index of the first prospect after the checkpoint the server passed us, and the visited set"""
+    checkpoint = json.loads(os.environ.get("THOMASNET_RESUME") or "{}")
+    return checkpoint.get("page", 0) * page_size, set(checkpoint.get("visited", []))
+
+
+def main():
+    state = sys.argv[1] if len(sys.argv) > 1 else "California"
+    service = sys.argv[2] if len(sys.argv) > 2 else "CNC Machining"
+    max_results = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+
+    latency = float(os.environ.get("STUB_SCRAPER_LATENCY", "1.0"))
+    count = int(os.environ.get("STUB_SCRAPER_RESULTS", max_results))
+
+    output_format = os.environ.get("STUB_SCRAPER_FORMAT", "json")
+    interval = float(os.environ.get("STUB_SCRAPER_INTERVAL", "0"))
+    rate_limited = bool(os.environ.get("STUB_SCRAPER_RATE_LIMITED"))
+    page_size = int(os.environ.get("STUB_SCRAPER_PAGE_SIZE", "0"))
+    spans = bool(os.environ.get("STUB_SCRAPER_SPANS"))
+    company_latency = float(os.environ.get("STUB_SCRAPER_COMPANY_LATENCY", "0"))
+    skip_companies, skip_domains = load_skip_file()
+    start, visited = resume_point(page_size) if page_size else (0, set())
+    start_log = os.environ.get("STUB_SCRAPER_START_LOG")
+    if start_log:
+        with open(start_log, "a") as f:
+            f.write(f"{start}\n")
+
+    pidfile = os.environ.get("STUB_SCRAPER_CHILD_PIDFILE")
+    if pidfile:
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(300)"])
+        with open(pidfile, "w") as f:
+            f.write(str(child.pid))
+
+    search_start = time.time()
+    time.sleep(latency)
+    if spans:
+        print_span("search_page", search_start, state=state)
+    exit_code = int(os.environ.get("STUB_SCRAPER_EXIT_CODE", "0"))
+    if exit_code:
+        print("stub scraper failure", file=sys.stderr)
+        sys.exit(exit_code)
+
+    prospects = []
+    for i in range(start, min(count, max_results)):
+        page_start = time.time()
+        prospect = make_prospect(state, service, i)
+        if prospect["website"] in visited or is_known(prospect, skip_companies, skip_domains):
+            continue
+        if rate_limited:
+            wait_for_token("www.thomasnet.com")
+        time.sleep(company_latency)
+        visited.add(prospect["website"])
+        prospects.append(prospect)
+        if spans:
+            print_span("company_page", page_start, url=prospect["website"])
+        if output_format == "ndjson":
+            print(json.dumps(prospects[-1]), flush=True)
+            if page_size and (i + 1) % page_size == 0:
+                checkpoint = {"page": (i + 1) // page_size, "visited": sorted(visited)}
+                print(json.dumps({"__checkpoint__": checkpoint}), flush=True)
+            time.sleep(interval)
+    if output_format != "ndjson":
+        print(json.dumps(prospects))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Warm Scraper Worker
+Long-lived process used by thomasnet-server.py --warm-workers. It imports the
+scraper's heavy dependencies once, then runs the command-line scraper in-process
+for every job it is sent, so jobs skip interpreter start-up and import time.
+
+Protocol (one JSON document per line):
+    stdin   {"argv": ["California", "CNC Machining", "Ascending", "100"], "env": {...}}
+    stdout  whatever the scraper prints, followed by
+            {"__worker__": "done", "returncode": 0, "stderr": "...", "rss_mb": 81.2}
+"""
+
+import io
+import json
+import os
+import sys
+import traceback
+
+WORKER_TAG = "__worker__"
+
+# Imported up front so every job finds them in sys.modules
+PRELOAD_MODULES = [
+    "selenium.webdriver",
+    "bs4",
+    "requests",
+]
+
+
+def preload():
+    for name in PRELOAD_MODULES:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def rss_mb():
+    """Current resident set size of this process in megabytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError):
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_job(code, scraper_path, argv, env, out):
+    """Run the scraper as __main__ with the given arguments; returns (returncode, stderr)"""
+    stderr = io.StringIO()
+    saved = sys.argv, sys.stdout, sys.stderr, sys.stdin
+    saved_env = dict(os.environ)
+    os.environ.update(env)
+    sys.argv = [scraper_path] + list(argv)
+    sys.stdout, sys.stderr = out, stderr
+    sys.stdin = open(os.devnull)
+    returncode = 0
+    try:
+        exec(code, {"__name__": "__main__", "__file__": scraper_path})
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        elif e.code is not None:
+            stderr.write(f"{e.code}\n")
+            returncode = 1
+    except BaseException:
+        traceback.print_exc(file=stderr)
+        returncode = 1
+    finally:
+        sys.stdin.close()
+        sys.argv, sys.stdout, sys.stderr, sys.stdin = saved
+        os.environ.clear()
+        os.environ.update(saved_env)
+    return returncode, stderr.getvalue()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: scraper-worker.py /path/to/run_scraper.py", file=sys.stderr)
+        sys.exit(2)
+
+    scraper_path = os.path.abspath(sys.argv[1])
+    scraper_dir = os.path.dirname(scraper_path)
+    if scraper_dir not in sys.path:
+        sys.path.insert(0, scraper_dir)
+    preload()
+    with open(scraper_path) as f:
+        code = compile(f.read(), scraper_path, "exec")
+
+    out = sys.stdout
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        returncode, stderr = run_job(code, scraper_path, request["argv"], request.get("env", {}), out)
+        out.write("\n")
+        out.write(json.dumps({WORKER_TAG: "done", "returncode": returncode,
+                              "stderr": stderr, "rss_mb": rss_mb()}) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2509 @@
+"""
+Test Suite for the Thomasnet Scraper Server
+Runs thomasnet-server.py in-process against the stub scraper
+"""
+
+import gzip
+import http.client
+import importlib.util
+import io
+import json
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import redirect_stdout
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+STUB_SCRAPER = ROOT / "benchmarks" / "stub_scraper.py"
+
+# thomasnet-server.py is not a valid module name, so load it by path
+_spec = importlib.util.spec_from_file_location("thomasnet_server", ROOT / "thomasnet-server.py")
+thomasnet_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(thomasnet_server)
+
+
+def make_leads_db(directory, leads):
+    """Create leads.db with the CRM's schema holding `leads`, a list of column dicts"""
+    path = os.path.join(directory, "leads.db")
+    thomasnet_server.LeadStore(path).close()
+    conn = sqlite3.connect(path)
+    for lead in leads:
+        conn.execute(f"INSERT INTO leads ({', '.join(lead)}) VALUES ({', '.join('?' * len(lead))})",
+                     list(lead.values()))
+    conn.commit()
+    conn.close()
+    return path
+
+
+class ServerTestCase(unittest.TestCase):
+    """Starts a server on a free port for each test"""
+
+    workers = 2
+    stub_latency = 0.5
+    use_cache = False
+    use_job_store = False
+    warm_workers = False
+
+    def server_options(self):
+        """Extra ThomasnetServer keyword arguments for a test case"""
+        # Rate limiting has its own tests; keep it out of the way elsewhere
+        options = {'rate_limit': 1000, 'rate_burst': 1000}
+        if self.use_cache:
+            options['cache_path'] = os.path.join(self.tmpdir.name, "cache.db")
+        if self.use_job_store:
+            options['jobs_path'] = os.path.join(self.tmpdir.name, "jobs.db")
+        if self.warm_workers:
+            options['warm_workers'] = True
+            options['worker_max_jobs'] = 3
+        return options
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self._old_env = dict(os.environ)
+        os.environ["STUB_SCRAPER_LATENCY"] = str(self.stub_latency)
+        self._stdout = redirect_stdout(io.StringIO())
+        self._stdout.__enter__()
+        self.httpd = thomasnet_server.ThomasnetServer(
+            ('127.0.0.1', 0), thomasnet_server.ThomasnetHandler,
+            workers=self.workers, scraper_path=STUB_SCRAPER, **self.server_options())
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._stdout.__exit__(None, None, None)
+        os.environ.clear()
+        os.environ.update(self._old_env)
+        self.tmpdir.cleanup()
+
+    def get(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=30) as response:
+            return response.status, json.loads(response.read())
+
+    def post(self, path, payload):
+        request = urllib.request.Request(self.base_url + path, data=json.dumps(payload).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+
+
+class TestConcurrentServing(ServerTestCase):
+    """Test cases for concurrent request handling"""
+
+    def test_scrape_returns_prospects(self):
+        """Test a plain /scrape call returns the scraper's prospects"""
+        status, prospects = self.post("/scrape", {"state": "Ohio", "service": "CNC Machining", "max_results": 3})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(prospects), 3)
+        self.assertEqual(prospects[0]["state"], "Ohio")
+
+    def test_health_not_blocked_by_scrape(self):
+        """Test /health answers while a scrape is still running"""
+        os.environ["STUB_SCRAPER_LATENCY"] = "2"
+        scrape = threading.Thread(target=self.post, args=("/scrape", {"max_results": 1}))
+        scrape.start()
+        time.sleep(0.2)
+
+        start = time.perf_counter()
+        status, body = self.get("/health")
+        elapsed = time.perf_counter() - start
+        scrape.join()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {"status": "ok"})
+        self.assertLess(elapsed, 0.5)
+
+    def test_scrapes_run_in_parallel_up_to_worker_limit(self):
+        """Test two scrapes with two workers run at the same time"""
+        # Different searches, so they aren't coalesced into one job
+        threads = [threading.Thread(target=self.post, args=("/scrape", {"state": state, "max_results": 1}))
+                   for state in ("Ohio", "Iowa")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each scrape started before the other finished
+        first, second = self.httpd.jobs._jobs.values()
+        self.assertLess(first.started_at, second.finished_at)
+        self.assertLess(second.started_at, first.finished_at)
+
+    def test_invalid_worker_count(self):
+        """Test the server rejects a worker limit below one"""
+        with self.assertRaises(ValueError):
+            thomasnet_server.ThomasnetServer(('127.0.0.1', 0), thomasnet_server.ThomasnetHandler, workers=0)
+
+
+class TestJobApi(ServerTestCase):
+    """Test cases for the asynchronous /jobs API"""
+
+    def wait_for_job(self, job_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            _, job = self.get(f"/jobs/{job_id}")
+            if job["state"] in ("done", "failed"):
+                return job
+            time.sleep(0.05)
+        self.fail(f"job {job_id} did not finish")
+
+    def test_create_job_returns_immediately(self):
+        """Test POST /jobs answers before the scrape finishes"""
+        start = time.perf_counter()
+        status, body = self.post("/jobs", {"state": "Texas", "max_results": 2})
+
+        self.assertEqual(status, 202)
+        self.assertLess(time.perf_counter() - start, self.stub_latency)
+        self.assertIn(body["state"], ("queued", "running"))
+        self.assertEqual(body["status_url"], f"/jobs/{body['id']}")
+
+    def test_job_status_and_results(self):
+        """Test polling a job to completion and fetching its prospects"""
+        _, created = self.post("/jobs", {"state": "Texas", "max_results": 2})
+
+        job = self.wait_for_job(created["id"])
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(job["progress"], {"found": 2, "max_results": 2})
+        self.assertGreaterEqual(job["elapsed"], self.stub_latency)
+
+        status, results = self.get(f"/jobs/{created['id']}/results")
+        self.assertEqual(status, 200)
+        self.assertEqual(results["count"], 2)
+        self.assertEqual(results["prospects"][0]["state"], "Texas")
+
+    def test_results_pages_follow_cursor(self):
+        """Test walking /jobs/{id}/results with cursor and limit returns every prospect once"""
+        _, created = self.post("/jobs", {"state": "Texas", "max_results": 7})
+        self.wait_for_job(created["id"])
+
+        companies, cursor, pages = [], "", 0
+        while cursor is not None:
+            _, page = self.get(f"/jobs/{created['id']}/results?limit=3&cursor={cursor}")
+            self.assertLessEqual(len(page["prospects"]), 3)
+            self.assertEqual(page["count"], 7)
+            companies += [p["company"] for p in page["prospects"]]
+            cursor, pages = page["next_cursor"], pages + 1
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(companies, [f"Stub Company {i}" for i in range(7)])
+
+    def test_results_page_of_running_job_keeps_cursor(self):
+        """Test a page at the end of a running job still hands back a cursor to poll"""
+        os.environ["STUB_SCRAPER_LATENCY"] = "2"
+        _, created = self.post("/jobs", {"state": "Texas", "max_results": 2})
+
+        _, page = self.get(f"/jobs/{created['id']}/results?limit=10")
+        self.assertEqual(page["prospects"], [])
+        self.assertEqual(page["next_cursor"], "0")
+
+    def test_results_limit_is_capped(self):
+        """Test a limit beyond MAX_PAGE_LIMIT is clamped"""
+        self.assertEqual(thomasnet_server.parse_page_params({"limit": ["50000"]}),
+                         (0, thomasnet_server.MAX_PAGE_LIMIT))
+
+    def test_invalid_cursor(self):
+        """Test a malformed cursor or limit is rejected with 400"""
+        _, created = self.post("/jobs", {"state": "Texas", "max_results": 1})
+        for query in ("cursor=abc", "limit=0", "limit=-5"):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(f"/jobs/{created['id']}/results?{query}")
+            self.assertEqual(ctx.exception.code, 400)
+
+    def test_unpaginated_results_are_written_in_chunks(self):
+        """Test the whole-list response is still valid JSON across several chunks"""
+        _, created = self.post("/jobs", {"state": "Texas", "max_results": 450})
+        self.wait_for_job(created["id"])
+
+        _, results = self.get(f"/jobs/{created['id']}/results")
+        self.assertEqual(results["count"], 450)
+        self.assertEqual(len(results["prospects"]), 450)
+        self.assertEqual(results["prospects"][-1]["company"], "Stub Company 449")
+        self.assertIsNone(results["error"])
+
+    def test_failed_job_reports_error(self):
+        """Test a job whose scraper is missing ends in the failed state"""
+        self.httpd.jobs.scraper_path = Path("/nonexistent/run_scraper.py")
+        _, created = self.post("/jobs", {})
+
+        job = self.wait_for_job(created["id"])
+        self.assertEqual(job["state"], "failed")
+        self.assertEqual(job["error"], "Thomasnet scraper not found")
+
+    def test_unknown_job(self):
+        """Test unknown job IDs return 404"""
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.get("/jobs/does-not-exist")
+        self.assertEqual(ctx.exception.code, 404)
+
+    def test_invalid_scrape_parameters(self):
+        """Test non-string search fields and non-positive max_results are rejected before any job is queued"""
+        for body in ({"state": ["x"]}, {"service": 5}, {"sort_order": ""}, {"max_results": -5},
+                     {"max_results": 0}, {"max_results": "many"}, {"max_results": [3]}):
+            for path in ("/jobs", "/scrape", "/scrape/stream"):
+                with self.assertRaises(urllib.error.HTTPError) as ctx:
+                    self.post(path, body)
+                self.assertEqual(ctx.exception.code, 400, (path, body))
+        self.assertEqual(self.httpd.jobs._jobs, {})
+
+    def test_jobs_queue_behind_worker_limit(self):
+        """Test jobs beyond the worker limit wait in the queued state"""
+        created = [self.post("/jobs", {"state": f"State {i}", "max_results": 1})[1]
+                   for i in range(self.workers + 1)]
+        time.sleep(0.1)
+
+        states = [self.get(f"/jobs/{job['id']}")[1]["state"] for job in created]
+        self.assertEqual(states.count("running"), self.workers)
+        self.assertEqual(states.count("queued"), 1)
+
+
+class TestStreaming(ServerTestCase):
+    """Test cases for NDJSON / SSE prospect streaming"""
+
+    stub_latency = 0
+
+    def open_stream(self, path, payload=None, accept=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data)
+        if accept:
+            request.add_header("Accept", accept)
+        return urllib.request.urlopen(request, timeout=30)
+
+    def test_ndjson_stream_delivers_prospects_before_job_ends(self):
+        """Test the first prospect arrives long before the scrape finishes"""
+        os.environ["STUB_SCRAPER_FORMAT"] = "ndjson"
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0.3"
+
+        start = time.perf_counter()
+        with self.open_stream("/scrape/stream", {"max_results": 4}) as response:
+            self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+            first = json.loads(response.readline())
+            first_at = time.perf_counter() - start
+            rest = [json.loads(line) for line in response]
+
+        self.assertEqual(first["event"], "prospect")
+        self.assertEqual(first["prospect"]["company"], "Stub Company 0")
+        self.assertLess(first_at, 0.9)
+        self.assertEqual([event["event"] for event in rest], ["prospect"] * 3 + ["done"])
+        self.assertEqual(rest[-1]["count"], 4)
+        self.assertEqual(rest[-1]["state"], "done")
+
+    def test_sse_stream(self):
+        """Test Server-Sent Events framing when the client asks for it"""
+        with self.open_stream("/scrape/stream", {"max_results": 2}, accept="text/event-stream") as response:
+            self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+            body = response.read().decode()
+
+        events = [block.split("\n") for block in body.strip().split("\n\n")]
+        self.assertEqual([lines[0] for lines in events], ["event: prospect", "event: prospect", "event: done"])
+        self.assertEqual(json.loads(events[1][1][len("data: "):])["company"], "Stub Company 1")
+
+    def test_legacy_json_list_output_is_streamed_at_exit(self):
+        """Test a scraper printing one JSON list still streams every prospect"""
+        with self.open_stream("/scrape/stream", {"max_results": 3}) as response:
+            events = [json.loads(line) for line in response]
+
+        self.assertEqual(len([event for event in events if event["event"] == "prospect"]), 3)
+        self.assertEqual(events[-1]["state"], "done")
+
+    def test_follow_existing_job(self):
+        """Test GET /jobs/{id}/stream replays and follows a queued job"""
+        _, created = self.post("/jobs", {"max_results": 2})
+
+        with self.open_stream(f"/jobs/{created['id']}/stream") as response:
+            events = [json.loads(line) for line in response]
+
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[-1]["id"], created["id"])
+
+    def test_failed_job_stream_reports_error(self):
+        """Test the done event carries the scraper error"""
+        self.httpd.jobs.scraper_path = Path("/nonexistent/run_scraper.py")
+
+        with self.open_stream("/scrape/stream", {}) as response:
+            events = [json.loads(line) for line in response]
+
+        self.assertEqual(events, [{"id": events[0]["id"], "state": "failed", "count": 0,
+                                   "error": "Thomasnet scraper not found", "event": "done"}])
+
+
+class TestKeepAliveAndCompression(ServerTestCase):
+    """Test cases for persistent connections and gzip responses"""
+
+    stub_latency = 0
+
+    def setUp(self):
+        super().setUp()
+        self.conn = http.client.HTTPConnection("127.0.0.1", self.httpd.server_address[1], timeout=30)
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def request(self, method, path, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        self.conn.request(method, path, body=body, headers=headers or {})
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def test_connection_is_reused(self):
+        """Test several requests, including a streamed one, share one TCP connection"""
+        response, body = self.request("GET", "/health")
+        self.assertEqual(response.version, 11)
+        self.assertEqual(response.headers["Content-Length"], str(len(body)))
+        sock = self.conn.sock
+
+        _, created = self.request("POST", "/jobs", {"max_results": 3})
+        job_id = json.loads(created)["id"]
+        response, stream = self.request("GET", f"/jobs/{job_id}/stream")
+        self.assertEqual(response.headers["Transfer-Encoding"], "chunked")
+        self.assertEqual(json.loads(stream.splitlines()[-1])["count"], 3)
+        response, body = self.request("GET", "/health")
+
+        self.assertEqual(json.loads(body), {"status": "ok"})
+        self.assertIs(self.conn.sock, sock)
+
+    def exchange(self, raw):
+        """Send raw request bytes on a new connection and read until the server closes it"""
+        client = socket.create_connection(self.httpd.server_address, timeout=30)
+        client.sendall(raw)
+        received = b""
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            received += data
+        client.close()
+        return received
+
+    def test_unread_body_closes_the_connection(self):
+        """Test a response sent without reading the body closes the connection instead of parsing the body"""
+        body = b'GET /health HTTP/1.1\r\nHost: test\r\n\r\n'
+        for path in ("/changes", "/queue/next", "/queues", "/leads/import", "/nowhere"):
+            received = self.exchange(f"POST {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n\r\n"
+                                     .encode() + body)
+            self.assertTrue(received.startswith(b"HTTP/1.1 404"), path)
+            self.assertIn(b"Connection: close", received)
+            self.assertEqual(received.count(b"HTTP/1.1 "), 1, path)
+
+    def test_json_body_without_content_length(self):
+        """Test a JSON POST without a Content-Length is a 400, not a dropped connection"""
+        for path in ("/jobs", "/scrape", "/scrape/batch"):
+            received = self.exchange(f"POST {path} HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n".encode())
+            self.assertTrue(received.startswith(b"HTTP/1.1 400"), path)
+            self.assertIn(b"Content-Length", received)
+
+    def test_large_results_are_gzipped(self):
+        """Test a big result list is compressed when the client accepts gzip"""
+        _, created = self.request("POST", "/jobs", {"max_results": 300})
+        job_id = json.loads(created)["id"]
+        self.httpd.jobs.get(job_id).done.wait(5)
+
+        response, body = self.request("GET", f"/jobs/{job_id}/results", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        results = json.loads(gzip.decompress(body))
+        self.assertEqual(len(results["prospects"]), 300)
+
+        response, page = self.request("GET", f"/jobs/{job_id}/results?limit=100",
+                                      headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(page))["prospects"]), 100)
+        self.assertLess(len(page), len(gzip.decompress(page)))
+
+        response, plain = self.request("GET", f"/jobs/{job_id}/results")
+        self.assertIsNone(response.headers["Content-Encoding"])
+        self.assertEqual(json.loads(plain), results)
+
+    def test_small_responses_are_not_gzipped(self):
+        """Test tiny bodies are sent as they are"""
+        response, body = self.request("GET", "/health", headers={"Accept-Encoding": "gzip"})
+        self.assertIsNone(response.headers["Content-Encoding"])
+        self.assertEqual(json.loads(body), {"status": "ok"})
+
+    def test_accepts_gzip(self):
+        """Test Accept-Encoding parsing"""
+        self.assertTrue(thomasnet_server.accepts_gzip("gzip, deflate, br"))
+        self.assertTrue(thomasnet_server.accepts_gzip("deflate;q=1.0, GZIP;q=0.5"))
+        self.assertTrue(thomasnet_server.accepts_gzip("*"))
+        self.assertFalse(thomasnet_server.accepts_gzip("gzip;q=0"))
+        self.assertFalse(thomasnet_server.accepts_gzip("br"))
+        self.assertFalse(thomasnet_server.accepts_gzip(None))
+
+
+class TestConditionalGet(ServerTestCase):
+    """Test cases for ETag / Last-Modified validators and 304 responses"""
+
+    stub_latency = 0
+
+    def conditional_get(self, path, **headers):
+        request = urllib.request.Request(self.base_url + path, headers={
+            name.replace('_', '-'): value for name, value in headers.items()})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def finished_job(self, max_results=3):
+        _, created = self.post("/jobs", {"max_results": max_results})
+        self.httpd.jobs.get(created["id"]).done.wait(5)
+        return created["id"]
+
+    def test_results_revalidate_with_etag(self):
+        """Test unchanged results answer If-None-Match with an empty 304"""
+        job_id = self.finished_job()
+        status, headers, body = self.conditional_get(f"/jobs/{job_id}/results")
+        self.assertEqual(status, 200)
+        etag = headers["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIsNotNone(headers["Last-Modified"])
+
+        status, headers, body = self.conditional_get(f"/jobs/{job_id}/results", If_None_Match=etag)
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(headers["ETag"], etag)
+
+        status, _, _ = self.conditional_get(f"/jobs/{job_id}/results", If_None_Match='W/"other", ' + etag)
+        self.assertEqual(status, 304)
+        status, _, body = self.conditional_get(f"/jobs/{job_id}/results", If_None_Match='W/"other"')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["count"], 3)
+
+    def test_etag_changes_as_prospects_arrive(self):
+        """Test a running job's validator moves on with every new prospect"""
+        os.environ["STUB_SCRAPER_FORMAT"] = "ndjson"
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0.3"
+        _, created = self.post("/jobs", {"max_results": 3})
+        time.sleep(0.2)
+        _, headers, _ = self.conditional_get(f"/jobs/{created['id']}/results")
+
+        self.httpd.jobs.get(created["id"]).done.wait(5)
+        status, _, body = self.conditional_get(f"/jobs/{created['id']}/results", If_None_Match=headers["ETag"])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["count"], 3)
+
+    def test_json_endpoints_are_hashed(self):
+        """Test other GET endpoints get content-hash ETags, and If-Modified-Since works without one"""
+        job_id = self.finished_job()
+        for path in (f"/jobs/{job_id}/results?limit=2", "/ratelimit", "/cache"):
+            _, headers, _ = self.conditional_get(path)
+            status, _, _ = self.conditional_get(path, If_None_Match=headers["ETag"])
+            self.assertEqual(status, 304, path)
+
+        _, headers, _ = self.conditional_get(f"/jobs/{job_id}/results?limit=2")
+        status, _, _ = self.conditional_get(f"/jobs/{job_id}/results?limit=2",
+                                            If_Modified_Since=headers["Last-Modified"])
+        self.assertEqual(status, 304)
+
+    def test_batch_results_revalidate(self):
+        """Test merged batch results are validated without re-merging"""
+        _, created = self.post("/scrape/batch", {"combinations": [{"state": "Ohio"}, {"state": "Iowa"}],
+                                                 "max_results": 2})
+        batch = self.httpd.jobs.get_batch(created["id"])
+        for job in batch.jobs:
+            job.done.wait(5)
+        _, headers, _ = self.conditional_get(f"/batches/{batch.id}/results")
+
+        with unittest.mock.patch.object(batch, "results", side_effect=AssertionError("merged again")):
+            status, _, _ = self.conditional_get(f"/batches/{batch.id}/results", If_None_Match=headers["ETag"])
+        self.assertEqual(status, 304)
+
+    def test_etag_matches(self):
+        """Test If-None-Match parsing"""
+        self.assertTrue(thomasnet_server.etag_matches('"abc"', 'W/"abc"'))
+        self.assertTrue(thomasnet_server.etag_matches('*', 'W/"abc"'))
+        self.assertFalse(thomasnet_server.etag_matches('"abcd"', 'W/"abc"'))
+
+
+class TestResultCache(unittest.TestCase):
+    """Test cases for the SQLite scrape result cache"""
+
+    params = {"state": "Ohio", "service": "CNC Machining", "sort_order": "Ascending",
+              "max_results": 10, "delay": 2}
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = thomasnet_server.ResultCache(os.path.join(self.tmpdir.name, "cache.db"), ttl=60, max_entries=2)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def search(self, **overrides):
+        return dict(self.params, **overrides)
+
+    def test_hit_and_miss_counters(self):
+        """Test a stored search is a hit and an unknown one a miss"""
+        self.assertIsNone(self.cache.get(self.params))
+        self.cache.put(self.params, [{"company": "Acme"}])
+
+        self.assertEqual(self.cache.get(self.params), [{"company": "Acme"}])
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+    def test_delay_is_not_part_of_the_key(self):
+        """Test searches differing only in delay share an entry"""
+        self.cache.put(self.params, [])
+        self.assertEqual(self.cache.get(self.search(delay=5)), [])
+        self.assertIsNone(self.cache.get(self.search(max_results=20)))
+
+    def test_expired_entries_miss(self):
+        """Test entries older than the TTL are dropped"""
+        self.cache.put(self.params, [])
+        with unittest.mock.patch.object(thomasnet_server.time, "time", return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get(self.params))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """Test the LRU entry goes once max_entries is exceeded"""
+        first, second, third = (self.search(state=state) for state in ("Ohio", "Iowa", "Utah"))
+        self.cache.put(first, [])
+        time.sleep(0.01)
+        self.cache.put(second, [])
+        time.sleep(0.01)
+        self.cache.get(first)  # first is now more recently used than second
+        time.sleep(0.01)
+        self.cache.put(third, [])
+
+        self.assertIsNone(self.cache.get(second))
+        self.assertEqual(self.cache.get(first), [])
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_cache_survives_reopen(self):
+        """Test results persist on disk across server restarts"""
+        self.cache.put(self.params, [{"company": "Acme"}])
+        self.cache.close()
+        self.cache = thomasnet_server.ResultCache(os.path.join(self.tmpdir.name, "cache.db"))
+
+        self.assertEqual(self.cache.get(self.params), [{"company": "Acme"}])
+
+
+class TestCachedScrapes(ServerTestCase):
+    """Test cases for serving scrapes from the result cache"""
+
+    use_cache = True
+
+    def test_repeat_search_is_served_from_cache(self):
+        """Test the second identical scrape skips the scraper"""
+        _, first = self.post("/scrape", {"state": "Ohio", "max_results": 2})
+
+        start = time.perf_counter()
+        _, second = self.post("/scrape", {"state": "Ohio", "max_results": 2})
+
+        self.assertLess(time.perf_counter() - start, self.stub_latency / 2)
+        self.assertEqual(first, second)
+        _, stats = self.get("/cache")
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+    def test_refresh_bypasses_cache(self):
+        """Test refresh=true runs the scraper again"""
+        self.post("/scrape", {"state": "Ohio", "max_results": 2})
+
+        start = time.perf_counter()
+        self.post("/scrape", {"state": "Ohio", "max_results": 2, "refresh": True})
+
+        self.assertGreaterEqual(time.perf_counter() - start, self.stub_latency)
+        self.assertEqual(self.get("/cache")[1]["hits"], 0)
+
+    def test_cached_job_is_flagged(self):
+        """Test a job answered from the cache finishes immediately with cached=true"""
+        self.post("/scrape", {"state": "Ohio", "max_results": 2})
+        _, created = self.post("/jobs", {"state": "Ohio", "max_results": 2})
+
+        _, job = self.get(f"/jobs/{created['id']}")
+        self.assertEqual(job["state"], "done")
+        self.assertTrue(job["cached"])
+        self.assertEqual(job["progress"]["found"], 2)
+
+    def test_failed_scrapes_are_not_cached(self):
+        """Test errors are never stored in the cache"""
+        self.httpd.jobs.scraper_path = Path("/nonexistent/run_scraper.py")
+        self.post("/scrape", {})
+
+        self.assertEqual(self.get("/cache")[1]["entries"], 0)
+
+    def test_cache_disabled(self):
+        """Test /cache reports when no cache is configured"""
+        self.httpd.cache.close()
+        self.httpd.cache = None
+        self.assertEqual(self.get("/cache")[1], {"enabled": False})
+
+
+class TestCoalescing(ServerTestCase):
+    """Test cases for single-flight deduplication of identical scrapes"""
+
+    def count_scraper_runs(self):
+        """Wrap Popen so the test can count scraper processes"""
+        launched = []
+        real_popen = thomasnet_server.subprocess.Popen
+
+        def popen(*args, **kwargs):
+            launched.append(args[0])
+            return real_popen(*args, **kwargs)
+
+        patcher = unittest.mock.patch.object(thomasnet_server.subprocess, "Popen", side_effect=popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return launched
+
+    def test_identical_concurrent_scrapes_share_one_process(self):
+        """Test simultaneous identical /scrape calls launch a single scraper"""
+        launched = self.count_scraper_runs()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.post("/scrape", {"max_results": 2})[1]))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(launched), 1)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(self.httpd.jobs.coalesced, 2)
+
+    def test_later_job_attaches_to_running_job(self):
+        """Test a second POST /jobs for the same search returns the same job ID"""
+        _, first = self.post("/jobs", {"state": "Iowa", "max_results": 2})
+        _, second = self.post("/jobs", {"state": "Iowa", "max_results": 2, "delay": 5})
+
+        self.assertEqual(first["id"], second["id"])
+        self.assertEqual(self.get(f"/jobs/{first['id']}")[1]["requests"], 2)
+
+    def test_different_searches_are_not_coalesced(self):
+        """Test searches with different parameters get their own jobs"""
+        _, first = self.post("/jobs", {"state": "Iowa", "max_results": 2})
+        _, second = self.post("/jobs", {"state": "Utah", "max_results": 2})
+
+        self.assertNotEqual(first["id"], second["id"])
+
+    def test_finished_job_is_not_reused(self):
+        """Test a search repeated after the first finished starts a new job"""
+        launched = self.count_scraper_runs()
+        self.post("/scrape", {"max_results": 1})
+        self.post("/scrape", {"max_results": 1})
+
+        self.assertEqual(len(launched), 2)
+
+
+class TestWarmWorkers(ServerTestCase):
+    """Test cases for the warm scraper worker pool"""
+
+    warm_workers = True
+    stub_latency = 0.1
+
+    def test_scrape_on_warm_worker(self):
+        """Test a scrape run on a warm worker returns the scraper's prospects"""
+        status, prospects = self.post("/scrape", {"state": "Maine", "max_results": 3})
+
+        self.assertEqual(status, 200)
+        self.assertEqual([p["company"] for p in prospects], ["Stub Company 0", "Stub Company 1", "Stub Company 2"])
+        self.assertEqual(prospects[0]["state"], "Maine")
+
+    def test_workers_are_reused_between_jobs(self):
+        """Test sequential jobs don't start new processes"""
+        pool = self.httpd.worker_pool
+        for i in range(2):
+            self.post("/scrape", {"state": f"State {i}", "max_results": 1})
+
+        self.assertEqual(pool.started, self.workers)
+        self.assertEqual(pool.recycled, 0)
+
+    def test_worker_recycled_after_max_jobs(self):
+        """Test a worker is replaced once it has run worker_max_jobs jobs"""
+        pool = self.httpd.worker_pool
+        for i in range(4):
+            self.post("/scrape", {"state": f"State {i}", "max_results": 1})
+
+        self.assertEqual(pool.recycled, 1)
+        self.assertEqual(pool.started, self.workers + 1)
+
+    def test_worker_recycled_on_memory_growth(self):
+        """Test a worker over the RSS limit is replaced"""
+        pool = self.httpd.worker_pool
+        pool.max_rss_mb = 0
+        self.post("/scrape", {"max_results": 1})
+
+        self.assertEqual(pool.recycled, 1)
+
+    def test_scraper_failure_on_warm_worker(self):
+        """Test a failing scraper reports its stderr and leaves the worker usable"""
+        self.httpd.worker_pool.close()
+        os.environ["STUB_SCRAPER_EXIT_CODE"] = "3"
+        pool = thomasnet_server.WorkerPool(STUB_SCRAPER, 1)
+        self.httpd.jobs.worker_pool = pool
+        self.addCleanup(pool.close)
+
+        _, result = self.post("/scrape", {"max_results": 1})
+
+        self.assertEqual(result, {"error": "Scraper failed: stub scraper failure\n"})
+        self.assertEqual(pool.recycled, 0)
+
+    def test_dead_worker_is_replaced(self):
+        """Test a job still runs when an idle worker has died"""
+        pool = self.httpd.worker_pool
+        for worker in list(pool._idle):
+            worker.kill()
+            worker.process.wait()
+
+        _, prospects = self.post("/scrape", {"max_results": 1})
+
+        self.assertEqual(len(prospects), 1)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the Prometheus metrics registry"""
+
+    def test_counter_rendering(self):
+        """Test counters render with HELP/TYPE lines and sorted labels"""
+        metrics = thomasnet_server.Metrics()
+        metrics.inc('thomasnet_http_requests_total', route='/health', method='GET', status=200)
+        metrics.inc('thomasnet_http_requests_total', route='/health', method='GET', status=200)
+
+        text = metrics.render()
+        self.assertIn("# TYPE thomasnet_http_requests_total counter", text)
+        self.assertIn('thomasnet_http_requests_total{method="GET",route="/health",status="200"} 2', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test histogram buckets, sum and count"""
+        metrics = thomasnet_server.Metrics(buckets=(0.1, 1))
+        metrics.observe('thomasnet_scrape_phase_seconds', 0.05, phase='spawn')
+        metrics.observe('thomasnet_scrape_phase_seconds', 0.5, phase='spawn')
+        metrics.observe('thomasnet_scrape_phase_seconds', 5, phase='spawn')
+
+        text = metrics.render()
+        self.assertIn('thomasnet_scrape_phase_seconds_bucket{phase="spawn",le="0.1"} 1', text)
+        self.assertIn('thomasnet_scrape_phase_seconds_bucket{phase="spawn",le="1"} 2', text)
+        self.assertIn('thomasnet_scrape_phase_seconds_bucket{phase="spawn",le="+Inf"} 3', text)
+        self.assertIn('thomasnet_scrape_phase_seconds_sum{phase="spawn"} 5.55', text)
+        self.assertIn('thomasnet_scrape_phase_seconds_count{phase="spawn"} 3', text)
+
+    def test_gauges(self):
+        """Test values passed at render time"""
+        text = thomasnet_server.Metrics().render({'thomasnet_jobs_queued': 4})
+        self.assertIn("# TYPE thomasnet_jobs_queued gauge\nthomasnet_jobs_queued 4", text)
+
+    def test_label_values_are_escaped(self):
+        """Test quotes, backslashes and newlines in a label value can't inject samples"""
+        metrics = thomasnet_server.Metrics()
+        metrics.inc('thomasnet_http_requests_total', route='evil"} 1\nfake_metric 99\\')
+
+        text = metrics.render()
+        self.assertIn('thomasnet_http_requests_total{route="evil\\"} 1\\nfake_metric 99\\\\"} 1', text)
+        self.assertFalse(any(line.startswith("fake_metric") for line in text.splitlines()))
+
+    def test_route_label(self):
+        """Test job IDs and unknown paths are collapsed"""
+        self.assertEqual(thomasnet_server.route_label('/jobs/abc123/results?limit=5'), '/jobs/{id}/results')
+        self.assertEqual(thomasnet_server.route_label('/health'), '/health')
+        self.assertEqual(thomasnet_server.route_label('/wp-admin.php'), 'other')
+        self.assertEqual(thomasnet_server.route_label('/leads/export?format=jsonl'), '/leads/export')
+        self.assertEqual(thomasnet_server.route_label('/leads/42'), '/leads/{id}')
+        self.assertEqual(thomasnet_server.route_label('/queues/7/members'), '/queues/{id}/members')
+
+
+class TestMetricsEndpoint(ServerTestCase):
+    """Test cases for GET /metrics"""
+
+    use_cache = True
+    stub_latency = 0.1
+
+    def metrics_text(self):
+        time.sleep(0.05)  # requests are recorded just after their response is flushed
+        with urllib.request.urlopen(self.base_url + "/metrics", timeout=30) as response:
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+            return response.read().decode()
+
+    def test_request_and_scrape_metrics(self):
+        """Test route counters, latency, bytes, phases and cache counters after a scrape"""
+        self.get("/health")
+        self.post("/scrape", {"max_results": 2})
+        self.post("/scrape", {"max_results": 2})
+
+        text = self.metrics_text()
+        self.assertIn('thomasnet_http_requests_total{method="GET",route="/health",status="200"} 1', text)
+        self.assertIn('thomasnet_http_requests_total{method="POST",route="/scrape",status="200"} 2', text)
+        self.assertIn('thomasnet_http_request_duration_seconds_count{route="/scrape"} 2', text)
+        self.assertRegex(text, r'thomasnet_http_response_bytes_total\{route="/scrape"\} [1-9]')
+        for phase in ("spawn", "run", "parse"):
+            self.assertIn(f'thomasnet_scrape_phase_seconds_count{{phase="{phase}"}} 1', text)
+        self.assertIn('thomasnet_jobs_finished_total{state="done"} 1', text)
+        self.assertIn("thomasnet_cache_hits_total 1", text)
+        self.assertIn("thomasnet_cache_misses_total 1", text)
+
+    def test_queue_gauges(self):
+        """Test active and queued job gauges"""
+        os.environ["STUB_SCRAPER_LATENCY"] = "1"
+        for i in range(self.workers + 1):
+            self.post("/jobs", {"state": f"State {i}", "max_results": 1})
+        time.sleep(0.2)
+
+        text = self.metrics_text()
+        self.assertIn(f"thomasnet_jobs_active {self.workers}", text)
+        self.assertIn("thomasnet_jobs_queued 1", text)
+
+    def test_job_routes_are_collapsed(self):
+        """Test per-job routes share one label"""
+        _, created = self.post("/jobs", {"max_results": 1})
+        self.get(f"/jobs/{created['id']}")
+
+        self.assertIn('route="/jobs/{id}"', self.metrics_text())
+        self.assertNotIn(created["id"], self.metrics_text())
+
+
+class TestJobTracing(ServerTestCase):
+    """Test cases for per-job phase spans"""
+
+    use_cache = True
+    stub_latency = 0.1
+
+    def server_options(self):
+        return dict(super().server_options(), trace_path=os.path.join(self.tmpdir.name, "traces.jsonl"))
+
+    def run_job(self, payload):
+        _, created = self.post("/jobs", payload)
+        self.httpd.jobs.get(created["id"]).done.wait(5)
+        return created["id"]
+
+    def test_server_phases_are_traced(self):
+        """Test a scrape records queue, rate limit, spawn, run, parse and job spans under one trace ID"""
+        self.post("/scrape", {"state": "Ohio", "max_results": 2})
+        _, created = self.post("/jobs", {"state": "Ohio", "max_results": 2})
+
+        _, trace = self.get(f"/jobs/{created['id']}/trace")
+        self.assertEqual([span["name"] for span in trace["spans"]], ["cache_lookup", "job"])
+        self.assertTrue(trace["spans"][0]["attrs"]["hit"])
+
+        _, status = self.get(f"/jobs/{created['id']}")
+        self.assertEqual(trace["trace_id"], status["trace_id"])
+
+    def test_scraped_job_spans(self):
+        """Test a job that runs the scraper records every server phase"""
+        job_id = self.run_job({"state": "Iowa", "max_results": 2})
+
+        _, trace = self.get(f"/jobs/{job_id}/trace")
+        names = [span["name"] for span in trace["spans"]]
+        for phase in ("cache_lookup", "queue", "rate_limit", "spawn", "run", "parse", "cache_write", "job"):
+            self.assertIn(phase, names)
+        self.assertEqual({span["trace_id"] for span in trace["spans"]}, {trace["trace_id"]})
+        self.assertGreaterEqual(trace["phases"]["run"], self.stub_latency)
+
+    def test_scraper_spans_are_collected(self):
+        """Test __span__ lines from the scraper are kept and not mistaken for prospects"""
+        os.environ["STUB_SCRAPER_SPANS"] = "1"
+        job_id = self.run_job({"state": "Utah", "max_results": 3})
+
+        _, results = self.get(f"/jobs/{job_id}/results")
+        self.assertEqual(results["count"], 3)
+        _, trace = self.get(f"/jobs/{job_id}/trace")
+        scraper_spans = [span for span in trace["spans"] if span["source"] == "scraper"]
+        self.assertEqual([span["name"] for span in scraper_spans], ["search_page"] + ["company_page"] * 3)
+        self.assertEqual(scraper_spans[1]["attrs"]["url"], "https://stub0.example.com")
+        self.assertGreaterEqual(trace["phases"]["search_page"], self.stub_latency)
+
+    def test_spans_written_as_json_lines(self):
+        """Test every span also lands in the trace log"""
+        job_id = self.run_job({"state": "Maine", "max_results": 1})
+        _, trace = self.get(f"/jobs/{job_id}/trace")
+
+        with open(os.path.join(self.tmpdir.name, "traces.jsonl")) as f:
+            logged = [json.loads(line) for line in f]
+        self.assertEqual([span for span in logged if span["job_id"] == job_id], trace["spans"])
+
+    def test_parse_span(self):
+        """Test scraper span payloads are validated"""
+        span = thomasnet_server.parse_span({"name": "company_page", "start": 10, "duration": 0.5, "url": "x"},
+                                           "trace", "job")
+        self.assertEqual((span["start"], span["duration"], span["attrs"]), (10, 0.5, {"url": "x"}))
+        self.assertIsNone(thomasnet_server.parse_span({"name": "no duration"}, "trace", "job"))
+        self.assertIsNone(thomasnet_server.parse_span({"duration": 1}, "trace", "job"))
+
+    def test_unknown_job_trace(self):
+        """Test the trace of an unknown job is a 404"""
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.get("/jobs/nope/trace")
+        self.assertEqual(ctx.exception.code, 404)
+
+
+class TestProspectMerging(unittest.TestCase):
+    """Test cases for company normalization and de-duplication"""
+
+    def test_normalize_company(self):
+        """Test punctuation, case and legal suffixes are ignored"""
+        self.assertEqual(thomasnet_server.normalize_company("Acme Machining, Inc."), "acme machining")
+        self.assertEqual(thomasnet_server.normalize_company("ACME MACHINING LLC"), "acme machining")
+        self.assertEqual(thomasnet_server.normalize_company("Smith & Sons Co"), "smith and sons")
+        self.assertEqual(thomasnet_server.normalize_company(None), "")
+
+    def test_website_domain(self):
+        """Test scheme, www. and paths are stripped"""
+        self.assertEqual(thomasnet_server.website_domain("https://www.Acme.com/about"), "acme.com")
+        self.assertEqual(thomasnet_server.website_domain("acme.com"), "acme.com")
+        self.assertEqual(thomasnet_server.website_domain(""), "")
+
+    def test_merge_by_name_or_domain(self):
+        """Test duplicates by either company name or domain are dropped"""
+        merged, duplicates = thomasnet_server.merge_prospects([
+            [{"company": "Acme Inc", "website": "https://acme.com"},
+             {"company": "Beta LLC", "website": "https://beta.io"}],
+            [{"company": "ACME", "website": "https://acme-tools.com"},
+             {"company": "Beta Fabrication", "website": "http://www.beta.io"},
+             {"company": "Gamma", "website": ""}],
+        ])
+
+        self.assertEqual([p["company"] for p in merged], ["Acme Inc", "Beta LLC", "Gamma"])
+        self.assertEqual(duplicates, 2)
+
+
+class TestBatchScrape(ServerTestCase):
+    """Test cases for POST /scrape/batch"""
+
+    stub_latency = 0.3
+
+    def wait_for_batch(self, batch_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            _, batch = self.get(f"/batches/{batch_id}")
+            if batch["state"] != "running":
+                return batch
+            time.sleep(0.05)
+        self.fail(f"batch {batch_id} did not finish")
+
+    def test_batch_runs_combinations_and_merges(self):
+        """Test every combination is scraped and results are de-duplicated"""
+        status, created = self.post("/scrape/batch", {
+            "combinations": [
+                {"state": "Ohio", "service": "CNC Machining"},
+                {"state": "Iowa", "service": "Robotic Welding", "max_results": 4},
+            ],
+            "max_results": 2,
+        })
+        self.assertEqual(status, 202)
+        self.assertEqual(created["total"], 2)
+
+        batch = self.wait_for_batch(created["id"])
+        self.assertEqual(batch["state"], "done")
+        self.assertEqual(batch["completed"], 2)
+        self.assertEqual([(c["state"], c["service"], c["found"]) for c in batch["combinations"]],
+                         [("Ohio", "CNC Machining", 2), ("Iowa", "Robotic Welding", 4)])
+
+        _, results = self.get(f"/batches/{created['id']}/results")
+        self.assertEqual(results["count"], 4)
+        self.assertEqual(results["duplicates"], 2)
+
+    def test_batch_runs_in_parallel(self):
+        """Test combinations share the worker pool instead of running serially"""
+        _, created = self.post("/scrape/batch", {"combinations": [{"state": "Ohio"}, {"state": "Iowa"}],
+                                                 "max_results": 1})
+        batch = self.wait_for_batch(created["id"])
+
+        # Each scrape started before the other finished
+        first, second = (self.httpd.jobs.get(c["job_id"]) for c in batch["combinations"])
+        self.assertLess(first.started_at, second.finished_at)
+        self.assertLess(second.started_at, first.finished_at)
+
+    def test_progress_reported_per_combination(self):
+        """Test a running batch shows each combination's job state"""
+        _, created = self.post("/scrape/batch", {"combinations": [{"state": f"State {i}"} for i in range(3)],
+                                                 "max_results": 1})
+
+        _, batch = self.get(f"/batches/{created['id']}")
+        self.assertEqual(batch["state"], "running")
+        self.assertEqual(sorted(c["job_state"] for c in batch["combinations"]), ["queued", "running", "running"])
+
+    def test_failed_combinations_are_reported(self):
+        """Test a batch whose scrapes all fail ends in the failed state"""
+        self.httpd.jobs.scraper_path = Path("/nonexistent/run_scraper.py")
+        _, created = self.post("/scrape/batch", {"combinations": [{"state": "Ohio"}]})
+
+        batch = self.wait_for_batch(created["id"])
+        self.assertEqual(batch["state"], "failed")
+        self.assertEqual(batch["combinations"][0]["error"], "Thomasnet scraper not found")
+
+    def test_invalid_batches(self):
+        """Test missing or oversized combination lists, or invalid combinations, are rejected"""
+        for body in ({}, {"combinations": []},
+                     {"combinations": [{"state": "Ohio"}] * (thomasnet_server.MAX_BATCH_COMBINATIONS + 1)},
+                     {"combinations": [{"state": "Ohio"}, {"state": None}]},
+                     {"combinations": [{"state": "Ohio"}], "max_results": -1}):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.post("/scrape/batch", body)
+            self.assertEqual(ctx.exception.code, 400)
+
+    def test_unknown_batch(self):
+        """Test unknown batch IDs return 404"""
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.get("/batches/nope/results")
+        self.assertEqual(ctx.exception.code, 404)
+
+
+class TestNewOnlyScrapes(ServerTestCase):
+    """Test cases for new_only scrapes that skip companies already in leads.db"""
+
+    use_cache = True
+    stub_latency = 0
+
+    def server_options(self):
+        leads_path = make_leads_db(self.tmpdir.name, [
+            {"company_name": "Stub Company 1, LLC", "website": ""},
+            {"company_name": "Somebody Else Inc", "website": "https://www.stub3.example.com/about"},
+        ])
+        return dict(super().server_options(), leads_path=leads_path)
+
+    def scrape_job(self, payload):
+        _, created = self.post("/jobs", payload)
+        job = self.httpd.jobs.get(created["id"])
+        job.done.wait(10)
+        _, status = self.get(f"/jobs/{job.id}")
+        _, results = self.get(f"/jobs/{job.id}/results")
+        return status, [p["company"] for p in results["prospects"]]
+
+    def test_scraper_skips_known_companies(self):
+        """Test known leads are never visited, so the scrape only pays for new companies"""
+        os.environ["STUB_SCRAPER_COMPANY_LATENCY"] = "0.2"
+        start = time.perf_counter()
+        status, companies = self.scrape_job({"state": "Ohio", "max_results": 5, "new_only": True})
+
+        self.assertEqual(companies, ["Stub Company 0", "Stub Company 2", "Stub Company 4"])
+        self.assertEqual(status["skipped"], 0)
+        self.assertTrue(status["params"]["new_only"])
+        self.assertLess(time.perf_counter() - start, 5 * 0.2)
+
+    def test_server_drops_known_companies_the_scraper_printed(self):
+        """Test a scraper that ignores the skip file still only returns new companies"""
+        with unittest.mock.patch.object(thomasnet_server, "write_skip_file", return_value=None):
+            status, companies = self.scrape_job({"state": "Ohio", "max_results": 5, "new_only": True})
+
+        self.assertEqual(companies, ["Stub Company 0", "Stub Company 2", "Stub Company 4"])
+        self.assertEqual(status["skipped"], 2)
+
+    def test_new_only_bypasses_cache(self):
+        """Test a cached full result is not reused for a new_only search, nor the other way round"""
+        self.post("/scrape", {"state": "Iowa", "max_results": 3})
+        status, companies = self.scrape_job({"state": "Iowa", "max_results": 3, "new_only": True})
+        self.assertFalse(status["cached"])
+        self.assertEqual(companies, ["Stub Company 0", "Stub Company 2"])
+
+        _, prospects = self.post("/scrape", {"state": "Iowa", "max_results": 3})
+        self.assertEqual(len(prospects), 3)
+        self.assertEqual(self.get("/cache")[1]["entries"], 1)
+
+    def test_new_only_without_leads_db_fails(self):
+        """Test new_only is refused when the server has no leads database"""
+        self.httpd.jobs.leads = None
+        status, _ = self.scrape_job({"max_results": 2, "new_only": True})
+        self.assertEqual(status["state"], "failed")
+        self.assertIn("--leads-db", status["error"])
+
+    def test_lead_store_keys(self):
+        """Test leads are indexed by normalized name and domain, and a missing database is empty"""
+        keys = self.httpd.leads.known_keys()
+        self.assertIn(("company", "stub company 1"), keys)
+        self.assertIn(("domain", "stub3.example.com"), keys)
+        empty = thomasnet_server.LeadStore(os.path.join(self.tmpdir.name, "none.db"))
+        self.assertEqual(empty.known_keys(), set())
+        empty.close()
+
+
+class TestLeadsApi(ServerTestCase):
+    """Test cases for the /leads API over leads.db"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        leads = []
+        for i in range(30):
+            leads.append({
+                "company_name": f"Company {i:02d}",
+                "contact_name": f"Contact {i}",
+                "email": f"sales@company{i}.example.com",
+                "industry": "Machining" if i % 3 else "Plastics",
+                "state": ("Ohio", "Texas")[i % 2],
+                # a third were never called, the rest on consecutive days
+                "last_called": None if i % 3 == 0 else f"2024-01-{i:02d}T10:00:00",
+                "notes": "wants 5% off" if i == 7 else "",
+            })
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, leads))
+
+    def fetch_all(self, query):
+        """Follow next_cursor through every page, returning the lead IDs in order"""
+        ids, cursor = [], None
+        while True:
+            _, page = self.get(f"/leads?{query}" + (f"&cursor={cursor}" if cursor else ""))
+            self.assertEqual(page["count"], len(page["leads"]))
+            ids += [lead["id"] for lead in page["leads"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return ids
+
+    def expected(self, predicate=lambda lead: True, key=lambda lead: lead["company_name"], reverse=False):
+        leads = [self.httpd.leads.get(i) for i in range(1, 31)]
+        return [lead["id"] for lead in sorted(filter(predicate, leads), key=key, reverse=reverse)]
+
+    def test_filters(self):
+        """Test state, industry, last_called range and text filters combine"""
+        _, page = self.get("/leads?state=Ohio&industry=Machining")
+        self.assertEqual({(lead["state"], lead["industry"]) for lead in page["leads"]}, {("Ohio", "Machining")})
+        self.assertEqual(page["count"], 10)
+
+        _, page = self.get("/leads?called_after=2024-01-10&called_before=2024-01-14")
+        self.assertEqual([lead["company_name"] for lead in page["leads"]],
+                         ["Company 10", "Company 11", "Company 13"])
+
+        _, page = self.get("/leads?never_called=1&state=Texas")
+        self.assertEqual([lead["company_name"] for lead in page["leads"]],
+                         ["Company 03", "Company 09", "Company 15", "Company 21", "Company 27"])
+
+        _, page = self.get("/leads?q=5%25")
+        self.assertEqual([lead["company_name"] for lead in page["leads"]], ["Company 07"])
+        _, page = self.get("/leads?q=COMPANY12.example")
+        self.assertEqual([lead["company_name"] for lead in page["leads"]], ["Company 12"])
+
+    def test_keyset_pagination(self):
+        """Test paging by cursor visits every lead exactly once in every sort order"""
+        self.assertEqual(self.fetch_all("limit=7"), self.expected())
+        self.assertEqual(self.fetch_all("limit=4&sort=-company_name&state=Texas"),
+                         self.expected(lambda lead: lead["state"] == "Texas", reverse=True))
+        self.assertEqual(self.fetch_all("limit=4&sort=-id"), list(range(30, 0, -1)))
+
+        # NULL last_called sorts first ascending and last descending, ties broken by id
+        def by_call(lead):
+            return (lead["last_called"] is not None, lead["last_called"] or "", lead["id"])
+        self.assertEqual(self.fetch_all("limit=4&sort=last_called"), self.expected(key=by_call))
+        self.assertEqual(self.fetch_all("limit=4&sort=-last_called"), self.expected(key=by_call, reverse=True))
+
+    def test_page_uses_indexes(self):
+        """Test filtered, sorted pages, first or later, are read from an index rather than scanned and sorted"""
+        store = self.httpd.leads
+        # Cursors short of a full page before the NULLs read them as a second range
+        for options, queries in (({"state": "Ohio"}, 1), ({"state": "Ohio", "sort": "last_called"}, 1),
+                                 ({"industry": "Plastics"}, 1), ({"sort": "last_called", "descending": True}, 1),
+                                 ({}, 1), ({"after": ("Company 10", 11)}, 1),
+                                 ({"sort": "last_called", "descending": True, "after": ("2024-01-01", 40)}, 2),
+                                 ({"state": "Ohio", "sort": "last_called", "descending": True,
+                                   "after": ("2024-01-01", 40)}, 2),
+                                 ({"sort": "last_called", "descending": True, "after": (None, 40)}, 1),
+                                 ({"sort": "last_called", "after": (None, 30)}, 2),
+                                 ({"sort": "id", "descending": True, "after": (5, 5)}, 1)):
+            statements = []
+            store._reader.set_trace_callback(statements.append)
+            store.page(**options)
+            store._reader.set_trace_callback(None)
+            self.assertEqual(len(statements), queries, options)
+            for statement in statements:
+                plan = " ".join(row[-1] for row in store._conn.execute("EXPLAIN QUERY PLAN " + statement))
+                # A first page walks an index from its start; a later one seeks to the cursor
+                self.assertIn("SEARCH leads USING" if "after" in options else "USING INDEX", plan, options)
+                self.assertNotIn("TEMP B-TREE", plan, options)
+
+    def test_get_lead(self):
+        """Test a single lead is returned by ID"""
+        _, lead = self.get("/leads/3")
+        self.assertEqual(lead["company_name"], "Company 02")
+        for path in ("/leads/99", "/leads/abc"):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(path)
+            self.assertEqual(ctx.exception.code, 404)
+
+    def test_invalid_queries(self):
+        """Test unknown sorts, bad limits and mismatched or corrupt cursors are rejected"""
+        _, page = self.get("/leads?limit=2")
+        forged = [thomasnet_server.encode_cursor(["company_name", False, value, last_id])
+                  for value, last_id in ((["a"], 1), ({"a": 1}, 1), ("a", 2 ** 63), ("a", "1"), (True, 1))]
+        for query in ("sort=phones", "limit=0", "limit=x", "cursor=!!",
+                      f"sort=-company_name&cursor={page['next_cursor']}", *(f"cursor={c}" for c in forged)):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(f"/leads?{query}")
+            self.assertEqual(ctx.exception.code, 400, query)
+
+    def search(self, text):
+        _, results = self.get("/leads/search?" + urllib.parse.urlencode({"q": text}))
+        self.truncated = results["truncated"]
+        return [lead["company_name"] for lead in results["leads"]]
+
+    def test_search(self):
+        """Test search matches whole words and a prefix of the last one, best matches first"""
+        # sales@company2... and the prefix of sales@company20... to sales@company29...
+        self.assertEqual(set(self.search("sales@company2")), {"Company 02"} | {f"Company 2{i}" for i in range(10)})
+        # A single letter or digit is a whole word, not a prefix
+        self.assertEqual(self.search("contact 1"), ["Company 01"])
+        self.assertEqual(self.search("company12"), ["Company 12"])
+        self.assertEqual(self.search("plastic ohio"), [])
+        self.assertEqual(set(self.search("plast")), {f"Company {i:02d}" for i in range(0, 30, 3)})
+
+        # A company name hit outranks the same word in the notes
+        with sqlite3.connect(self.httpd.leads.path) as conn:
+            conn.execute("UPDATE leads SET notes = 'ask about acme tooling' WHERE id = 1")
+            conn.execute("INSERT INTO leads (company_name) VALUES ('Acme Tooling')")
+        self.assertEqual(self.search("acme"), ["Acme Tooling", "Company 00"])
+
+    def test_search_ranks_newest_candidates_and_name_matches(self):
+        """Test a search matching more than SEARCH_RANK_CANDIDATES leads ranks the newest and any named ones"""
+        conn = sqlite3.connect(self.httpd.leads.path)
+        conn.execute("UPDATE leads SET company_name = 'Plastics Direct' WHERE company_name = 'Company 03'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(len(self.search("plastics")), 10)
+        self.assertFalse(self.truncated)
+
+        with unittest.mock.patch.object(thomasnet_server, "SEARCH_RANK_CANDIDATES", 3):
+            results = self.search("plastics")
+        self.assertTrue(self.truncated)
+        self.assertEqual(results[0], "Plastics Direct")
+        self.assertEqual(sorted(results[1:]), ["Company 21", "Company 24", "Company 27"])
+
+    def test_search_index_follows_writes(self):
+        """Test inserts, edits and deletes by any connection are searchable at once"""
+        conn = sqlite3.connect(self.httpd.leads.path, isolation_level=None)
+        conn.execute("INSERT INTO leads (company_name, contact_name) VALUES ('Zephyr Gears', 'Ann Ng')")
+        self.assertEqual(self.search("zeph"), ["Zephyr Gears"])
+        conn.execute("UPDATE leads SET contact_name = 'Bo Diaz' WHERE company_name = 'Zephyr Gears'")
+        self.assertEqual(self.search("ann ng"), [])
+        self.assertEqual(self.search("diaz"), ["Zephyr Gears"])
+        conn.execute("DELETE FROM leads WHERE company_name = 'Zephyr Gears'")
+        self.assertEqual(self.search("zephyr"), [])
+        conn.close()
+
+    def test_existing_leads_db_is_only_migrated_when_asked(self):
+        """Test an older leads.db is left byte for byte as it was unless migrate is given"""
+        path = os.path.join(self.tmpdir.name, "old.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE leads (id INTEGER PRIMARY KEY AUTOINCREMENT, company_name TEXT UNIQUE, "
+                         "contact_name TEXT, email TEXT, industry TEXT, state TEXT, last_called TEXT, "
+                         "website TEXT, phones TEXT, comments TEXT, notes TEXT)")
+            conn.execute("INSERT INTO leads (company_name) VALUES ('Acme')")
+        conn.close()
+        with open(path, "rb") as f:
+            original = f.read()
+
+        with self.assertRaises(RuntimeError) as ctx:
+            thomasnet_server.LeadStore(path)
+        self.assertIn("--migrate-leads", str(ctx.exception))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), original)
+        self.assertFalse(os.path.exists(path + "-wal"))
+
+        httpd = thomasnet_server.ThomasnetServer(('127.0.0.1', 0), thomasnet_server.ThomasnetHandler,
+                                                 scraper_path=STUB_SCRAPER, leads_path=path)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+        try:
+            self.assertIsNone(httpd.leads)
+            with urllib.request.urlopen(base_url + "/health", timeout=30) as response:
+                self.assertEqual(response.status, 200)
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                urllib.request.urlopen(base_url + "/leads", timeout=30)
+            self.assertEqual(ctx.exception.code, 404)
+            self.assertIn("--migrate-leads", json.loads(ctx.exception.read())["error"])
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), original)
+
+        thomasnet_server.LeadStore(path, migrate=True).close()
+        store = thomasnet_server.LeadStore(path)
+        self.addCleanup(store.close)
+        self.assertEqual(store.get(1)["company_name"], "Acme")
+
+    def test_search_index_built_for_existing_leads(self):
+        """Test a leads.db from before the search index gets one built from its leads"""
+        path = os.path.join(self.tmpdir.name, "old.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE leads (id INTEGER PRIMARY KEY AUTOINCREMENT, company_name TEXT UNIQUE, "
+                         "contact_name TEXT, email TEXT, industry TEXT, state TEXT, last_called TEXT, "
+                         "website TEXT, phones TEXT, comments TEXT, notes TEXT)")
+            conn.execute("INSERT INTO leads (company_name, industry) VALUES ('Café Forge', 'Forging')")
+        store = thomasnet_server.LeadStore(path, migrate=True)
+        self.assertEqual([lead["company_name"] for lead in store.search("cafe forg")[0]], ["Café Forge"])
+        store.close()
+
+    def test_invalid_search(self):
+        """Test a search without words or with a bad limit is rejected"""
+        for query in ("", "q=", "q=%20%2A", "q=acme&limit=0", "q=acme&limit=%C2%B2"):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(f"/leads/search?{query}")
+            self.assertEqual(ctx.exception.code, 400, query)
+
+    def test_disabled_without_leads_db(self):
+        """Test /leads answers 404 when the server has no leads database"""
+        self.httpd.leads = None
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.get("/leads")
+        self.assertEqual(ctx.exception.code, 404)
+
+
+class TestLeadStats(ServerTestCase):
+    """Test cases for the lead_stats aggregates behind /stats"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, []))
+
+    def recount(self, conn, days):
+        """/stats computed the slow way, from every lead"""
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+
+        def counts(expression, where="1"):
+            return dict(conn.execute(f"SELECT {expression}, COUNT(*) FROM leads WHERE {where} AND "
+                                     f"COALESCE({expression}, '') != '' GROUP BY 1").fetchall())
+        return {
+            "total": conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0],
+            "never_called": conn.execute("SELECT COUNT(*) FROM leads WHERE COALESCE(last_called, '') = ''")
+                                .fetchone()[0],
+            "states": counts("state"),
+            "industries": counts("industry"),
+            "call_outcomes": counts("call_outcome"),
+            "called_by_day": counts("date(last_called)", f"date(last_called) >= '{since}'"),
+            "added_by_day": counts("date(date_added)", f"date(date_added) >= '{since}'"),
+        }
+
+    def test_stats_follow_writes(self):
+        """Test the aggregates match a full recount after inserts, updates and deletes"""
+        rng = random.Random(7)
+        conn = sqlite3.connect(self.httpd.leads.path, isolation_level=None)
+
+        def day(offset):
+            return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(time.time() - offset * 86400))
+        for i in range(300):
+            action = rng.random()
+            if action < 0.6 or i < 20:
+                conn.execute("INSERT INTO leads (company_name, state, industry, date_added) VALUES (?, ?, ?, ?)",
+                             (f"Lead {i}", rng.choice(["Ohio", "Iowa", "", None]), rng.choice(["CNC", "Welding"]),
+                              day(rng.randrange(60))))
+            elif action < 0.85:
+                conn.execute("UPDATE leads SET last_called = ?, call_outcome = ? WHERE id = "
+                             "(SELECT id FROM leads ORDER BY random() LIMIT 1)",
+                             (day(rng.randrange(60)), rng.choice(["voicemail", "meeting_set", None])))
+            else:
+                conn.execute("DELETE FROM leads WHERE id = (SELECT id FROM leads ORDER BY random() LIMIT 1)")
+
+        for days in (1, 7, 30, 366):
+            _, stats = self.get(f"/stats?days={days}")
+            self.assertEqual(stats, self.recount(conn, days), days)
+        # Largest first
+        self.assertEqual(list(stats["states"].values()), sorted(stats["states"].values(), reverse=True))
+        conn.close()
+
+    def test_stats_built_for_existing_leads(self):
+        """Test a leads.db from before the aggregates gets the new columns and its counts filled in"""
+        path = os.path.join(self.tmpdir.name, "old.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE leads (id INTEGER PRIMARY KEY AUTOINCREMENT, company_name TEXT UNIQUE, "
+                         "contact_name TEXT, email TEXT, industry TEXT, state TEXT, last_called TEXT, "
+                         "website TEXT, phones TEXT, comments TEXT, notes TEXT)")
+            conn.executemany("INSERT INTO leads (company_name, state, industry) VALUES (?, ?, ?)",
+                             [("A", "FL", "CNC"), ("B", "FL", ""), ("C", "MI", "CNC")])
+        store = thomasnet_server.LeadStore(path, migrate=True)
+        stats = store.stats()
+        self.assertEqual((stats["total"], stats["never_called"]), (3, 3))
+        self.assertEqual(stats["states"], {"FL": 2, "MI": 1})
+        self.assertEqual(stats["industries"], {"CNC": 2})
+        self.assertIn("call_outcome", store.get(1))
+        store.close()
+
+    def test_invalid_days(self):
+        """Test days outside 1 to MAX_STATS_DAYS is rejected"""
+        for days in ("0", "x", "%C2%B2", str(thomasnet_server.MAX_STATS_DAYS + 1)):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(f"/stats?days={days}")
+            self.assertEqual(ctx.exception.code, 400)
+
+
+class TestLeadSync(ServerTestCase):
+    """Test cases for delta sync of leads through /changes"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        leads = [{"company_name": f"Company {i:03d}", "state": "Ohio"} for i in range(250)]
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, leads))
+
+    def pull(self, since, limit=100):
+        """Every change after `since`, following `more`, and the version to pull from next time"""
+        changes = []
+        while True:
+            _, page = self.get(f"/changes?since={since}&limit={limit}")
+            changes += page["changes"]
+            since = page["since"]
+            if not page["more"]:
+                return changes, since
+
+    def push(self, changes, **options):
+        _, result = self.post("/changes", dict(options, changes=changes))
+        return result
+
+    def test_pull_everything_then_nothing(self):
+        """Test a first pull pages through every lead and a second one finds nothing new"""
+        changes, since = self.pull(0)
+        self.assertEqual(len(changes), 250)
+        self.assertEqual([change["version"] for change in changes], sorted(change["version"] for change in changes))
+        self.assertEqual(self.pull(since), ([], since))
+
+    def test_day_of_calling_syncs_only_deltas(self):
+        """Test edits, a delete and a new lead come back as exactly those changes, in a few kilobytes"""
+        _, since = self.pull(0)
+        leads = {lead["id"]: lead for lead in self.pull(0)[0]}
+
+        result = self.push([
+            {"id": 1, "base_version": leads[1]["version"], "ref": "a",
+             "lead": {"last_called": "2024-05-01T10:00:00", "call_outcome": "voicemail"}},
+            {"id": 2, "base_version": leads[2]["version"], "lead": {"notes": "call back Tuesday"}},
+            {"id": 3, "base_version": leads[3]["version"], "deleted": True},
+            {"ref": "local-9", "lead": {"company_name": "Fresh Leads Inc", "state": "Iowa"}},
+        ])
+        self.assertEqual(result["conflicts"], [])
+        self.assertEqual([change.get("ref") for change in result["applied"]], ["a", None, None, "local-9"])
+        new_id = result["applied"][3]["id"]
+
+        request = urllib.request.Request(f"{self.base_url}/changes?since={since}")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            body = response.read()
+        self.assertLess(len(body), 4096)
+        changes = json.loads(body)["changes"]
+        self.assertEqual([(change["id"], change.get("deleted", False)) for change in changes],
+                         [(1, False), (2, False), (3, True), (new_id, False)])
+        self.assertEqual(changes[0]["call_outcome"], "voicemail")
+        self.assertEqual(changes[0]["state"], "Ohio")
+        self.assertEqual(json.loads(body)["since"], result["version"])
+
+    def test_conflicts(self):
+        """Test stale edits, duplicate companies and deleted leads are reported with the server's copy"""
+        lead = self.get("/leads/5")[1]
+        self.push([{"id": 5, "base_version": lead["version"], "lead": {"notes": "first"}}])
+        self.push([{"id": 6, "base_version": self.get("/leads/6")[1]["version"], "deleted": True}])
+
+        result = self.push([
+            {"id": 5, "base_version": lead["version"], "lead": {"notes": "second"}},
+            {"lead": {"company_name": "Company 007"}},
+            {"id": 8, "base_version": self.get("/leads/8")[1]["version"], "lead": {"company_name": "Company 009"}},
+            {"id": 6, "base_version": 1, "lead": {"notes": "too late"}},
+            {"id": 6, "base_version": 1, "deleted": True},
+            {"id": 9999, "base_version": 1, "deleted": True},
+        ])
+        self.assertEqual([(conflict["id"], conflict["reason"]) for conflict in result["conflicts"]],
+                         [(5, "changed"), (8, "exists"), (8, "exists"), (6, "deleted"), (9999, "missing")])
+        self.assertEqual(result["conflicts"][0]["lead"]["notes"], "first")
+        self.assertEqual(result["conflicts"][1]["lead"]["company_name"], "Company 007")
+        self.assertEqual(result["conflicts"][2]["lead"]["company_name"], "Company 009")
+        self.assertEqual(result["applied"], [{"id": 6, "deleted": True, "version": result["applied"][0]["version"]}])
+
+        result = self.push([{"id": 5, "lead": {"notes": "second"}}], force=True)
+        self.assertEqual(result["conflicts"], [])
+        self.assertEqual(self.get("/leads/5")[1]["notes"], "second")
+
+    def test_other_writers_are_versioned(self):
+        """Test writes straight to leads.db show up in the change feed too"""
+        _, since = self.pull(0)
+        conn = sqlite3.connect(self.httpd.leads.path, isolation_level=None)
+        conn.execute("UPDATE leads SET state = 'Texas' WHERE id = 10")
+        conn.execute("DELETE FROM leads WHERE id = 11")
+        conn.close()
+        changes, _ = self.pull(since)
+        self.assertEqual([(change["id"], change.get("state")) for change in changes], [(10, "Texas"), (11, None)])
+
+    def test_versions_for_existing_leads(self):
+        """Test a leads.db from before versioning gets versions in id order"""
+        path = os.path.join(self.tmpdir.name, "old.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE leads (id INTEGER PRIMARY KEY AUTOINCREMENT, company_name TEXT UNIQUE, "
+                         "contact_name TEXT, email TEXT, industry TEXT, state TEXT, last_called TEXT, "
+                         "website TEXT, phones TEXT, comments TEXT, notes TEXT)")
+            conn.executemany("INSERT INTO leads (company_name) VALUES (?)", [("A",), ("B",)])
+        store = thomasnet_server.LeadStore(path, migrate=True)
+        changes, since, more = store.changes(0)
+        self.assertEqual([(change["company_name"], change["version"]) for change in changes], [("A", 1), ("B", 2)])
+        self.assertEqual((since, more), (2, False))
+        store.close()
+
+    def test_invalid_changes(self):
+        """Test malformed pushes and pulls are rejected without applying anything"""
+        for body in ({}, {"changes": []}, {"changes": [{"lead": {}}]},
+                     {"changes": [{"lead": {"company_name": "X", "version": 3}}]},
+                     {"changes": [{"id": 1, "lead": {"notes": "no base version"}}]},
+                     {"changes": [{"deleted": True}]},
+                     {"changes": [{"lead": {"company_name": "Zqx"}}, {"id": "1", "base_version": 1}]},
+                     {"changes": [{"lead": {"company_name": "Zqx"}}, {"id": 2 ** 63, "base_version": 1}]},
+                     {"changes": [{"id": 1, "base_version": 2 ** 64, "lead": {"notes": "x"}}]},
+                     {"changes": [{"lead": {"company_name": "Zqx", "notes": -2 ** 70}}]}):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.post("/changes", body)
+            self.assertEqual(ctx.exception.code, 400, body)
+        self.assertEqual(self.get("/leads?q=Zqx")[1]["count"], 0)
+        for query in ("since=-1", f"since={2 ** 63}", "since=%C2%B2", "limit=%C2%B2"):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(f"/changes?{query}")
+            self.assertEqual(ctx.exception.code, 400)
+
+
+class TestLeadImport(ServerTestCase):
+    """Test cases for bulk CSV import at /leads/import"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        leads = [{"company_name": "Acme Inc.", "state": "OH", "notes": "existing"}]
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, leads))
+
+    def import_csv(self, text, query=""):
+        request = urllib.request.Request(f"{self.base_url}/leads/import{query}", data=text.encode(),
+                                         headers={"Content-Type": "text/csv"})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+
+    def assert_consistent(self):
+        """The search index and aggregates the insert triggers would have kept match the leads"""
+        conn = sqlite3.connect(self.httpd.leads.path)
+        conn.execute("INSERT INTO leads_fts (leads_fts) VALUES ('integrity-check')")
+        self.assertEqual(dict(conn.execute("SELECT value, count FROM lead_stats WHERE dimension = 'state'"
+                                           " AND count > 0")),
+                         dict(conn.execute("SELECT state, COUNT(*) FROM leads WHERE state != '' GROUP BY state")))
+        versions = [row[0] for row in conn.execute("SELECT version FROM leads")]
+        self.assertEqual(len(set(versions)), len(versions))
+        self.assertEqual(conn.execute("SELECT version FROM lead_sync").fetchone()[0], max(versions))
+        names = {row[1] for row in conn.execute("SELECT * FROM sqlite_master WHERE type = 'trigger'")}
+        self.assertTrue(set(thomasnet_server.LEAD_INSERT_TRIGGERS) <= names)
+        conn.close()
+
+    def test_import_scraper_csv(self):
+        """Test a scraper CSV is imported with its columns mapped, searchable and counted"""
+        with open(Path(__file__).resolve().parent.parent / "AL Robotic Welding.csv") as f:
+            result = self.import_csv(f.read())
+        self.assertEqual((result["imported"], result["updated"], result["skipped"], result["rows"]), (8, 0, 0, 8))
+
+        lead = self.get("/leads/search?q=muskogee")[1]["leads"][0]
+        self.assertEqual((lead["state"], lead["website"]), ("AL", "https://muskotech.com"))
+        self.assertEqual(lead["industry"], "cnc|robotic welding|welding")
+        self.assertTrue(lead["phones"].startswith("(251) 368-0818"))
+        self.assertIsNotNone(lead["date_added"])
+        self.assertEqual(self.get("/stats")[1]["states"], {"AL": 8, "OH": 1})
+        self.assertEqual(self.get("/leads?never_called=true")[1]["count"], 9)
+        self.assertEqual(len(self.get("/changes?since=1")[1]["changes"]), 8)
+        self.assert_consistent()
+
+        # The insert triggers are back for everyone else
+        conn = sqlite3.connect(self.httpd.leads.path, isolation_level=None)
+        conn.execute("INSERT INTO leads (company_name, state) VALUES ('Later Co', 'AL')")
+        conn.close()
+        self.assertEqual(self.get("/stats")[1]["states"]["AL"], 9)
+        self.assert_consistent()
+
+    def test_blank_cells_are_null(self):
+        """Test blank and missing cells are stored as NULL, like leads written any other way"""
+        self.import_csv("Company,Contact,Last Called,Notes\nBlank Co,  ,,\nShort Row Co\n")
+        conn = sqlite3.connect(self.httpd.leads.path)
+        rows = conn.execute("SELECT contact_name, last_called, notes FROM leads WHERE company_name LIKE '%Co'"
+                            " ORDER BY id").fetchall()
+        conn.close()
+        self.assertEqual(rows, [(None, None, None), (None, None, None)])
+        self.assertEqual(self.get("/leads?never_called=true")[1]["count"], 3)
+
+    def test_upsert_counts(self):
+        """Test existing companies are updated only by non-empty changed fields, and repeats merge"""
+        csv_text = ("Company,State,Notes,Phone\n"
+                    "Acme Inc.,OH,,555-0100\n"     # adds a phone to the existing lead
+                    "New One,TX,first,\n"
+                    "New One,,,555-0101\n"          # merges into the row above
+                    ",TX,no company,\n"
+                    "Acme Inc.,,,\n")               # nothing new
+        result = self.import_csv(csv_text)
+        self.assertEqual((result["imported"], result["updated"], result["skipped"], result["rows"]), (1, 1, 3, 5))
+        acme = self.get("/leads/1")[1]
+        self.assertEqual((acme["notes"], acme["phones"], acme["state"]), ("existing", "555-0100", "OH"))
+        new_one = self.get("/leads?q=New+One")[1]["leads"][0]
+        self.assertEqual((new_one["state"], new_one["notes"], new_one["phones"]), ("TX", "first", "555-0101"))
+
+        result = self.import_csv(csv_text)
+        self.assertEqual((result["imported"], result["updated"], result["skipped"]), (0, 0, 5))
+        result = self.import_csv("Company,Notes\nAcme Inc.,replaced\nOther,x\n", "?existing=skip")
+        self.assertEqual((result["imported"], result["updated"], result["skipped"]), (1, 0, 1))
+        self.assertEqual(self.get("/leads/1")[1]["notes"], "existing")
+        self.assert_consistent()
+
+    def test_invalid_imports(self):
+        """Test a CSV without a company column, or a bad existing option, is rejected and changes nothing"""
+        for text, query in (("State,Notes\nOH,x\n", ""), ("", ""), ("Company\nX\n", "?existing=merge")):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.import_csv(text, query)
+            self.assertEqual(ctx.exception.code, 400)
+        self.assertEqual(self.get("/stats")[1]["total"], 1)
+
+    def test_reads_dont_wait_behind_blocked_writes(self):
+        """Test reads are answered while a write waits for the write lock an import holds"""
+        importer = sqlite3.connect(self.httpd.leads.path, isolation_level=None)
+        importer.execute("BEGIN IMMEDIATE")
+        called = threading.Thread(target=self.post, args=("/queue/called", {"rep": "ann", "id": 1}))
+        called.start()
+        time.sleep(0.2)
+        try:
+            start = time.perf_counter()
+            self.assertEqual(self.get("/leads")[1]["count"], 1)
+            self.assertEqual(len(self.get("/leads/search?q=acme")[1]["leads"]), 1)
+            self.assertEqual(self.get("/leads/1")[1]["last_called"], None)
+            self.assertEqual(self.get("/stats")[1]["total"], 1)
+            self.assertLess(time.perf_counter() - start, 5)
+            self.assertTrue(called.is_alive())
+        finally:
+            importer.execute("COMMIT")
+            importer.close()
+            called.join()
+        self.assertIsNotNone(self.get("/leads/1")[1]["last_called"])
+
+    def test_header_mapping(self):
+        """Test scraper, extension export and column-name headers all map onto leads columns"""
+        columns = thomasnet_server.lead_csv_columns
+        self.assertEqual(columns(["Lead", "Emails", "Services", "Phones", "Other"]),
+                         ["company_name", "email", "industry", "phones", None])
+        self.assertEqual(columns(["Company", "Last Called", "Phone", "Contact", "Comments"]),
+                         ["company_name", "last_called", "phones", "contact_name", "comments"])
+        self.assertEqual(columns(["company_name", "Phone", "Phones"]), ["company_name", "phones", None])
+
+
+class TestLeadExport(ServerTestCase):
+    """Test cases for streaming exports at /leads/export"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        leads = [{"company_name": f"Company {i}", "state": "OH" if i % 2 else None,
+                  "notes": 'said "call back",\nmaybe' if i == 3 else None} for i in range(25)]
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, leads))
+
+    def export(self, query="", headers=None):
+        request = urllib.request.Request(f"{self.base_url}/leads/export{query}", headers=headers or {})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.headers, response.read()
+
+    def test_csv_round_trip(self):
+        """Test the CSV export is chunked, has every lead, and imports into an empty store unchanged"""
+        with unittest.mock.patch.object(thomasnet_server, 'EXPORT_BATCH_ROWS', 10):
+            headers, body = self.export()
+        self.assertEqual(headers["Transfer-Encoding"], "chunked")
+        self.assertTrue(headers["Content-Type"].startswith("text/csv"))
+        self.assertIn('filename="leads.csv"', headers["Content-Disposition"])
+        self.assertTrue(body.startswith(b"id,company_name,"))
+
+        store = thomasnet_server.LeadStore(os.path.join(self.tmpdir.name, "copy.db"))
+        self.addCleanup(store.close)
+        result = store.import_csv(io.StringIO(body.decode(), newline=""))
+        self.assertEqual(result["imported"], 25)
+        original = self.get("/leads?limit=100")[1]["leads"]
+        copied = store.page(limit=100)[0]
+        columns = set(thomasnet_server.LEAD_WRITABLE_COLUMNS) - {"date_added"}
+        self.assertEqual([{column: lead[column] for column in columns} for lead in copied],
+                         [{column: lead[column] for column in columns} for lead in original])
+
+    def test_jsonl_gzipped(self):
+        """Test JSONL has one lead object per line, gzipped for clients that accept it"""
+        headers, body = self.export("?format=jsonl", {"Accept-Encoding": "gzip"})
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Content-Type"], "application/x-ndjson")
+        lines = gzip.decompress(body).decode().splitlines()
+        leads = [json.loads(line) for line in lines]
+        self.assertEqual([lead["id"] for lead in leads], list(range(1, 26)))
+        self.assertEqual(leads[3]["notes"], 'said "call back",\nmaybe')
+        self.assertEqual(leads[0]["state"], None)
+
+    def test_export_batches(self):
+        """Test the store yields bounded batches from a snapshot taken when reading starts"""
+        store = self.httpd.leads
+        batches = store.export(batch_rows=10)
+        first = next(batches)
+        conn = sqlite3.connect(store.path, isolation_level=None)
+        conn.execute("INSERT INTO leads (company_name) VALUES ('Written Meanwhile')")
+        conn.close()
+        rest = list(batches)
+        self.assertEqual([len(rows) for rows in [first] + rest], [10, 10, 5])
+        self.assertEqual(len(list(store.export())[0]), 26)
+
+    def test_invalid_format(self):
+        """Test an unknown format is rejected"""
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.export("?format=xlsx")
+        self.assertEqual(ctx.exception.code, 400)
+
+
+class TestCallQueue(ServerTestCase):
+    """Test cases for the call queue at /queue"""
+
+    stub_latency = 0
+    workers = 4
+
+    def server_options(self):
+        recent = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 86400))
+        leads = [
+            {"company_name": "Called Long Ago", "state": "OH", "industry": "CNC",
+             "last_called": "2024-01-05T10:00:00Z"},
+            {"company_name": "Never Called", "state": "TX", "industry": "CNC"},
+            {"company_name": "Called Yesterday", "state": "OH", "industry": "CNC", "last_called": recent},
+            {"company_name": "Called Earlier", "state": "OH", "industry": "Welding",
+             "last_called": "2023-11-20T10:00:00Z"},
+            {"company_name": "Also Never Called", "state": "OH", "industry": "Welding"},
+        ]
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, leads))
+
+    def queue(self, query=""):
+        return [lead["company_name"] for lead in self.get(f"/queue{query}")[1]["leads"]]
+
+    def test_queue_order(self):
+        """Test never-called leads come first, then the oldest calls, without recent ones, filtered"""
+        self.assertEqual(self.queue(), ["Never Called", "Also Never Called", "Called Earlier", "Called Long Ago"])
+        self.assertEqual(self.queue("?days=0"), ["Never Called", "Also Never Called", "Called Earlier",
+                                                 "Called Long Ago", "Called Yesterday"])
+        self.assertEqual(self.queue("?state=OH"), ["Also Never Called", "Called Earlier", "Called Long Ago"])
+        self.assertEqual(self.queue("?state=OH&industry=CNC"), ["Called Long Ago"])
+        self.assertEqual(self.queue("?limit=3"), ["Never Called", "Also Never Called", "Called Earlier"])
+
+    def test_next_reserves(self):
+        """Test each rep is handed a different lead, and asking again moves a rep on to the next"""
+        first = self.post("/queue/next", {"rep": "ann"})[1]
+        self.assertEqual(first["lead"]["company_name"], "Never Called")
+        self.assertGreater(first["reserved_until"], time.time() + 60)
+        self.assertEqual(self.post("/queue/next", {"rep": "bo"})[1]["lead"]["company_name"], "Also Never Called")
+        self.assertEqual(self.queue(), ["Called Earlier", "Called Long Ago"])
+
+        # Ann skips her lead: she gets the next free one and hers goes back in the queue
+        self.assertEqual(self.post("/queue/next", {"rep": "ann"})[1]["lead"]["company_name"], "Called Earlier")
+        self.assertEqual(self.queue(), ["Never Called", "Called Long Ago"])
+
+        self.assertEqual(self.post("/queue/release", {"rep": "bo", "id": 5})[1], {"released": True})
+        self.assertEqual(self.post("/queue/release", {"rep": "bo", "id": 5})[1], {"released": False})
+        self.assertEqual(self.queue("?state=OH"), ["Also Never Called", "Called Long Ago"])
+
+        _, body = self.post("/queue/next", {"rep": "ann", "state": "TX", "days": 0})
+        self.assertEqual(body["lead"]["company_name"], "Never Called")
+        _, body = self.post("/queue/next", {"rep": "bo", "state": "TX"})
+        self.assertEqual(body, {"lead": None, "reserved_until": None})
+
+    def test_called(self):
+        """Test marking a call moves the lead to the back, keeps stats and versions, and respects reservations"""
+        lead = self.post("/queue/next", {"rep": "ann"})[1]["lead"]
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.post("/queue/called", {"rep": "bo", "id": lead["id"]})
+        self.assertEqual(ctx.exception.code, 409)
+        self.assertEqual(json.loads(ctx.exception.read())["rep"], "ann")
+
+        called = self.post("/queue/called", {"rep": "ann", "id": lead["id"], "outcome": "voicemail"})[1]["lead"]
+        self.assertEqual(called["call_outcome"], "voicemail")
+        self.assertGreater(called["version"], lead["version"])
+        self.assertEqual(called["last_called"][:10], time.strftime('%Y-%m-%d', time.gmtime()))
+        self.assertNotIn("Never Called", self.queue())
+        self.assertEqual(self.get("/stats")[1]["call_outcomes"], {"voicemail": 1})
+
+        # Anyone can log a call on a lead nobody holds
+        self.assertEqual(self.post("/queue/called", {"rep": "bo", "id": 1})[0], 200)
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.post("/queue/called", {"rep": "bo", "id": 99})
+        self.assertEqual(ctx.exception.code, 404)
+
+    def test_reservations_expire(self):
+        """Test a lead held past its hold is handed to the next rep who asks"""
+        store = self.httpd.leads
+        lead, expires_at = store.reserve_next("ann", hold=60)
+        self.assertEqual(store.reserve_next("bo")[0]["id"], 5)
+        with unittest.mock.patch.object(thomasnet_server.time, "time", return_value=expires_at + 1):
+            self.assertEqual(store.reserve_next("cy")[0]["id"], lead["id"])
+        self.assertEqual(store._conn.execute("SELECT COUNT(*) FROM lead_reservations").fetchone()[0], 2)
+
+    def test_concurrent_next(self):
+        """Test reps asking at the same moment never get the same lead"""
+        results = []
+
+        def ask(rep):
+            results.append(self.post("/queue/next", {"rep": rep, "days": 0})[1]["lead"])
+
+        threads = [threading.Thread(target=ask, args=(f"rep {i}",)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        handed = [lead["id"] for lead in results if lead is not None]
+        self.assertEqual(sorted(handed), [1, 2, 3, 4, 5])
+        self.assertEqual(results.count(None), 3)
+
+    def test_invalid_requests(self):
+        """Test bad queue options and bodies are rejected"""
+        for query in ("?days=-1", "?days=x", "?limit=0", f"?days={thomasnet_server.MAX_QUEUE_DAYS + 1}"):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(f"/queue{query}")
+            self.assertEqual(ctx.exception.code, 400)
+        for path, body in (("/queue/next", {}), ("/queue/next", {"rep": "ann", "hold": 0}),
+                           ("/queue/next", {"rep": "ann", "state": 5}), ("/queue/called", {"rep": "ann"}),
+                           ("/queue/called", {"rep": "ann", "id": 1, "outcome": 3}),
+                           ("/queue/release", {"rep": "ann", "id": "1"}), ("/queue/next", ["ann"]),
+                           ("/queue/called", {"rep": "ann", "id": 2 ** 63}),
+                           ("/queue/release", {"rep": "ann", "id": -2 ** 64})):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.post(path, body)
+            self.assertEqual(ctx.exception.code, 400)
+
+
+class TestCustomQueues(ServerTestCase):
+    """Test cases for custom call queues at /queues"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        leads = [{"company_name": f"Company {i}", "state": "OH" if i % 2 else "TX"} for i in range(1, 31)]
+        return dict(super().server_options(), leads_path=make_leads_db(self.tmpdir.name, leads))
+
+    def delete(self, path):
+        request = urllib.request.Request(self.base_url + path, method="DELETE")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+
+    def members(self, queue_id, limit=100):
+        """Every lead ID in a queue, paging through it `limit` at a time"""
+        ids, cursor = [], ""
+        while True:
+            body = self.get(f"/queues/{queue_id}?limit={limit}{cursor}")[1]
+            ids += [lead["id"] for lead in body["leads"]]
+            if body["next_cursor"] is None:
+                return ids
+            cursor = f"&cursor={body['next_cursor']}"
+
+    def test_create_and_page(self):
+        """Test a queue keeps its leads in the order given, skipping repeats and unknown IDs"""
+        status, queue = self.post("/queues", {"name": " Follow-ups ", "description": "Hot leads",
+                                              "lead_ids": [7, 3, 99, 7, 12, 1]})
+        self.assertEqual(status, 201)
+        self.assertEqual((queue["name"], queue["description"], queue["count"]), ("Follow-ups", "Hot leads", 4))
+        self.assertEqual(self.members(queue["id"]), [7, 3, 12, 1])
+        self.assertEqual(self.members(queue["id"], limit=3), [7, 3, 12, 1])
+        body = self.get(f"/queues/{queue['id']}?limit=4")[1]
+        self.assertEqual((body["count"], body["next_cursor"]), (4, None))
+        self.assertEqual(body["leads"][0]["company_name"], "Company 7")
+
+        self.post("/queues", {"name": "Empty"})
+        self.assertEqual([(q["name"], q["count"]) for q in self.get("/queues")[1]["queues"]],
+                         [("Follow-ups", 4), ("Empty", 0)])
+
+    def test_change_members(self):
+        """Test bulk adds go to the end, removes apply first, and deleted leads and queues disappear"""
+        queue_id = self.post("/queues", {"name": "Q", "lead_ids": [1, 2, 3, 4]})[1]["id"]
+        _, body = self.post(f"/queues/{queue_id}/members", {"add": [9, 2, 1, 8, 404], "remove": [1, 3, 5]})
+        self.assertEqual(body, {"added": 3, "removed": 2, "count": 5})
+        self.assertEqual(self.members(queue_id, limit=2), [2, 4, 9, 1, 8])
+
+        conn = sqlite3.connect(self.httpd.leads.path, isolation_level=None)
+        conn.execute("DELETE FROM leads WHERE id = 9")
+        conn.close()
+        self.assertEqual(self.members(queue_id), [2, 4, 1, 8])
+
+        self.assertEqual(self.delete(f"/queues/{queue_id}")[1], {"id": queue_id, "deleted": True})
+        for request in (lambda: self.get(f"/queues/{queue_id}"), lambda: self.delete(f"/queues/{queue_id}"),
+                        lambda: self.post(f"/queues/{queue_id}/members", {"add": [1]})):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                request()
+            self.assertEqual(ctx.exception.code, 404)
+        count = self.httpd.leads._conn.execute("SELECT COUNT(*) FROM call_queue_members").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_large_queue(self):
+        """Test a queue of thousands of leads is added in one request and paged from its index"""
+        conn = sqlite3.connect(self.httpd.leads.path)
+        with conn:
+            conn.executemany("INSERT INTO leads (company_name) VALUES (?)", ((f"Bulk {i}",) for i in range(12000)))
+        conn.close()
+        lead_ids = list(range(12030, 30, -1))
+        queue_id = self.post("/queues", {"name": "Big", "lead_ids": lead_ids})[1]["id"]
+        self.assertEqual(self.get("/queues")[1]["queues"][0]["count"], 12000)
+        self.assertEqual(self.members(queue_id, limit=1000), lead_ids)
+
+        plan = self.httpd.leads._conn.execute(
+            "EXPLAIN QUERY PLAN SELECT l.id FROM call_queue_members AS m JOIN leads AS l ON l.id = m.lead_id"
+            " WHERE m.queue_id = ? AND m.position > ? ORDER BY m.position LIMIT ?", (queue_id, 0, 100)).fetchall()
+        details = " ".join(row[3] for row in plan)
+        self.assertIn("idx_call_queue_members_position", details)
+        self.assertNotIn("TEMP B-TREE", details)
+
+    def test_call_from_custom_queue(self):
+        """Test /queue and /queue/next work through a custom queue in its order"""
+        queue_id = self.post("/queues", {"name": "Q", "lead_ids": [5, 2, 8, 3]})[1]["id"]
+        self.assertEqual([lead["id"] for lead in self.get(f"/queue?queue={queue_id}&state=TX")[1]["leads"]],
+                         [2, 8])
+        lead = self.post("/queue/next", {"rep": "ann", "queue": queue_id})[1]["lead"]
+        self.assertEqual(lead["id"], 5)
+        self.assertEqual(self.post("/queue/next", {"rep": "bo", "queue": queue_id})[1]["lead"]["id"], 2)
+        self.post("/queue/called", {"rep": "ann", "id": 5})
+        self.assertEqual([lead["id"] for lead in self.get(f"/queue?queue={queue_id}")[1]["leads"]], [8, 3])
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.post("/queue/next", {"rep": "ann", "queue": queue_id + 1})
+        self.assertEqual(ctx.exception.code, 404)
+
+    def test_invalid_requests(self):
+        """Test queues without a name and malformed member lists are rejected"""
+        queue_id = self.post("/queues", {"name": "Q"})[1]["id"]
+        for path, body in (("/queues", {"lead_ids": [1]}), ("/queues", {"name": "Q", "lead_ids": "1,2"}),
+                           ("/queues", {"name": "Q", "description": 5}),
+                           (f"/queues/{queue_id}/members", {"add": [1, "2"]}),
+                           (f"/queues/{queue_id}/members", {"remove": [True]}),
+                           (f"/queues/{queue_id}/members", {"add": [2 ** 63]}),
+                           (f"/queues/{queue_id}/members", []),
+                           (f"/queues/{queue_id}/members",
+                            {"add": [1] * (thomasnet_server.MAX_QUEUE_CHANGE + 1)})):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.post(path, body)
+            self.assertEqual(ctx.exception.code, 400)
+        for path in (f"/queues/{queue_id}?cursor=abc", f"/queues/{queue_id}?limit=0", "/queue?queue=0",
+                     f"/queues/{queue_id}?cursor={thomasnet_server.encode_cursor([2 ** 64])}"):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.get(path)
+            self.assertEqual(ctx.exception.code, 400)
+        for request in (lambda: self.get(f"/queues/{2 ** 63}"), lambda: self.delete(f"/queues/{2 ** 64}"),
+                        lambda: self.post(f"/queues/{2 ** 63}/members", {"add": [1]})):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                request()
+            self.assertEqual(ctx.exception.code, 404)
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Test cases for the token bucket and per-host limiter"""
+
+    def test_burst_then_rate(self):
+        """Test a burst passes immediately and later tokens are spaced by the rate"""
+        bucket = thomasnet_server.TokenBucket(rate=20, burst=2)
+
+        waits = [bucket.reserve() for _ in range(4)]
+
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 0.05, delta=0.01)
+        self.assertAlmostEqual(waits[3], 0.10, delta=0.01)
+
+    def test_tokens_refill(self):
+        """Test tokens come back over time"""
+        bucket = thomasnet_server.TokenBucket(rate=50, burst=1)
+        bucket.acquire()
+        time.sleep(0.05)
+        self.assertEqual(bucket.reserve(), 0.0)
+
+    def test_invalid_bucket(self):
+        """Test non-positive rates are rejected"""
+        with self.assertRaises(ValueError):
+            thomasnet_server.TokenBucket(rate=0, burst=1)
+
+    def test_hosts_have_independent_buckets(self):
+        """Test one host's limit doesn't slow another and overrides apply"""
+        limiter = thomasnet_server.HostRateLimiter(rate=1, burst=1, overrides={"fast.example": (100, 5)})
+        limiter.acquire("www.thomasnet.com")
+
+        self.assertEqual(limiter.bucket("other.example").reserve(), 0.0)
+        self.assertEqual(limiter.bucket("FAST.example").burst, 5)
+        self.assertGreater(limiter.bucket("www.thomasnet.com").reserve(), 0.5)
+
+    def test_least_recently_used_hosts_are_dropped(self):
+        """Test only max_hosts buckets are kept and unconfigured hosts share one metric label"""
+        limiter = thomasnet_server.HostRateLimiter(rate=1, burst=1, overrides={"fast.example": (100, 5)},
+                                                   max_hosts=3)
+        for host in ("a.example", "b.example", "c.example", "a.example", "d.example"):
+            limiter.acquire(host)
+        self.assertEqual(sorted(limiter.limits()["hosts"]), ["a.example", "c.example", "d.example", "fast.example"])
+        self.assertEqual([limiter.label(host) for host in ("WWW.thomasnet.com", "fast.example", "a.example")],
+                         ["www.thomasnet.com", "fast.example", "other"])
+
+    def test_parse_host_rate(self):
+        """Test --host-rate parsing"""
+        self.assertEqual(thomasnet_server.parse_host_rate("Example.com=2:4"), ("example.com", (2.0, 4)))
+        self.assertEqual(thomasnet_server.parse_host_rate("example.com=0.5"),
+                         ("example.com", (0.5, thomasnet_server.DEFAULT_RATE_BURST)))
+
+
+class TestRateLimitedScrapes(ServerTestCase):
+    """Test cases for the shared politeness scheduler"""
+
+    stub_latency = 0
+
+    def server_options(self):
+        return dict(super().server_options(), rate_limit=20, rate_burst=1)
+
+    def test_concurrent_jobs_share_one_host_budget(self):
+        """Test two parallel jobs together stay under the per-host rate"""
+        os.environ["STUB_SCRAPER_RATE_LIMITED"] = "1"
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.post, args=("/scrape", {"state": state, "max_results": 4}))
+                   for state in ("Ohio", "Iowa")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 2 job starts + 8 company pages = 10 tokens at 20/s with a burst of 1
+        self.assertGreaterEqual(time.perf_counter() - start, 9 / 20)
+
+    def test_job_reports_rate_limit_wait(self):
+        """Test the time a job spent waiting for tokens is reported"""
+        os.environ["STUB_SCRAPER_RATE_LIMITED"] = "1"
+        _, created = self.post("/jobs", {"max_results": 3})
+        while self.get(f"/jobs/{created['id']}")[1]["state"] in ("queued", "running"):
+            time.sleep(0.05)
+
+        _, job = self.get(f"/jobs/{created['id']}")
+        self.assertGreater(job["rate_limit_wait"], 0.05)
+
+    def test_acquire_endpoint(self):
+        """Test POST /ratelimit/acquire waits once the burst is used"""
+        self.post("/ratelimit/acquire", {"host": "example.com"})
+        _, body = self.post("/ratelimit/acquire", {"host": "example.com"})
+
+        self.assertEqual(body["host"], "example.com")
+        self.assertGreater(body["waited"], 0)
+        self.assertIn("example.com", self.get("/ratelimit")[1]["hosts"])
+
+    def test_invalid_acquire_requests(self):
+        """Test non-string hosts and job IDs, and host names that aren't, are rejected"""
+        for body in ({"host": 5}, {"host": 'evil"} 1\nfake_metric 99'}, {"host": "x" * 300},
+                     {"job_id": ["x"]}, ["example.com"]):
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                self.post("/ratelimit/acquire", body)
+            self.assertEqual(ctx.exception.code, 400, body)
+        self.assertEqual(self.post("/ratelimit/acquire", {"host": " Example.COM:8080 "})[1]["host"],
+                         "example.com:8080")
+
+
+class TestCancellation(ServerTestCase):
+    """Test cases for cancelling jobs and abandoned requests"""
+
+    stub_latency = 0
+
+    def setUp(self):
+        super().setUp()
+        os.environ["STUB_SCRAPER_FORMAT"] = "ndjson"
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0.3"
+
+    def delete(self, path):
+        request = urllib.request.Request(self.base_url + path, method="DELETE")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+
+    def wait_until(self, predicate, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if predicate():
+                return
+            time.sleep(0.05)
+        self.fail("condition not met in time")
+
+    def only_job(self):
+        jobs = list(self.httpd.jobs._jobs.values())
+        self.assertEqual(len(jobs), 1)
+        return jobs[0]
+
+    def test_cancel_running_job_returns_partial_results(self):
+        """Test DELETE /jobs/{id} stops the scraper and keeps what it found"""
+        _, created = self.post("/jobs", {"max_results": 20})
+        self.wait_until(lambda: self.get(f"/jobs/{created['id']}")[1]["progress"]["found"] >= 2)
+
+        start = time.perf_counter()
+        status, body = self.delete(f"/jobs/{created['id']}")
+
+        self.assertEqual(status, 200)
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(body["state"], "cancelled")
+        self.assertTrue(2 <= body["count"] < 20)
+        self.assertEqual(len(body["prospects"]), body["count"])
+        self.assertEqual(self.get(f"/jobs/{created['id']}")[1]["state"], "cancelled")
+
+    def test_cancel_kills_process_tree(self):
+        """Test the scraper's own child processes die with it"""
+        pidfile = os.path.join(self.tmpdir.name, "child.pid")
+        os.environ["STUB_SCRAPER_CHILD_PIDFILE"] = pidfile
+        _, created = self.post("/jobs", {"max_results": 20})
+        self.wait_until(lambda: os.path.exists(pidfile) and open(pidfile).read())
+        child_pid = int(open(pidfile).read())
+
+        self.delete(f"/jobs/{created['id']}")
+
+        def child_gone():
+            try:
+                os.kill(child_pid, 0)
+            except ProcessLookupError:
+                return True
+            # A killed child lingers as a zombie until init reaps it
+            with open(f"/proc/{child_pid}/stat") as f:
+                return f.read().split()[2] == "Z"
+        self.wait_until(child_gone)
+
+    def test_cancel_queued_job_frees_nothing_and_finishes_at_once(self):
+        """Test a queued job is cancelled without ever starting"""
+        for i in range(self.workers):
+            self.post("/jobs", {"state": f"State {i}", "max_results": 20})
+        _, queued = self.post("/jobs", {"state": "Queued", "max_results": 1})
+
+        _, body = self.delete(f"/jobs/{queued['id']}")
+
+        self.assertEqual(body["state"], "cancelled")
+        self.assertEqual(body["count"], 0)
+
+    def test_cancel_releases_worker_slot(self):
+        """Test a queued job starts once a running one is cancelled"""
+        running = [self.post("/jobs", {"state": f"State {i}", "max_results": 20})[1] for i in range(self.workers)]
+        _, waiting = self.post("/jobs", {"state": "Waiting", "max_results": 1})
+        time.sleep(0.2)
+        self.assertEqual(self.get(f"/jobs/{waiting['id']}")[1]["state"], "queued")
+
+        self.delete(f"/jobs/{running[0]['id']}")
+
+        self.wait_until(lambda: self.get(f"/jobs/{waiting['id']}")[1]["state"] == "done")
+
+    def test_cancelled_search_can_be_rerun(self):
+        """Test a new identical request doesn't attach to the cancelled job"""
+        _, first = self.post("/jobs", {"max_results": 20})
+        self.delete(f"/jobs/{first['id']}")
+        _, second = self.post("/jobs", {"max_results": 20})
+
+        self.assertNotEqual(first["id"], second["id"])
+
+    def test_cancel_finished_job_is_a_no_op(self):
+        """Test cancelling a finished job leaves it done"""
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0"
+        _, created = self.post("/jobs", {"max_results": 1})
+        self.wait_until(lambda: self.get(f"/jobs/{created['id']}")[1]["state"] == "done")
+
+        self.assertEqual(self.delete(f"/jobs/{created['id']}")[1]["state"], "done")
+
+    def test_scrape_client_disconnect_cancels_job(self):
+        """Test hanging up on /scrape kills the scraper"""
+        body = json.dumps({"max_results": 20}).encode()
+        client = socket.create_connection(self.httpd.server_address)
+        client.sendall(b"POST /scrape HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+                       b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        self.wait_until(lambda: len(self.httpd.jobs._jobs) == 1 and self.only_job().state == "running")
+        client.close()
+
+        self.wait_until(lambda: self.only_job().state == "cancelled")
+
+    def test_disconnect_keeps_job_running_for_other_callers(self):
+        """Test a coalesced job survives one of its callers hanging up"""
+        _, created = self.post("/jobs", {"max_results": 5})
+        body = json.dumps({"max_results": 5}).encode()
+        client = socket.create_connection(self.httpd.server_address)
+        client.sendall(b"POST /scrape HTTP/1.1\r\nHost: test\r\nContent-Length: "
+                       + str(len(body)).encode() + b"\r\n\r\n" + body)
+        self.wait_until(lambda: self.only_job().requests == 2)
+        client.close()
+
+        self.wait_until(lambda: self.only_job().finished)
+        self.assertEqual(self.only_job().state, "done")
+
+    def test_stream_client_disconnect_cancels_job(self):
+        """Test closing a /scrape/stream response cancels its job"""
+        request = urllib.request.Request(self.base_url + "/scrape/stream",
+                                         data=json.dumps({"max_results": 20}).encode())
+        response = urllib.request.urlopen(request, timeout=30)
+        response.readline()
+        response.close()
+
+        self.wait_until(lambda: self.only_job().state == "cancelled")
+
+    def test_stalled_stream_client_cancels_job(self):
+        """Test a /scrape/stream client that stops reading past the socket timeout is detached too"""
+        with unittest.mock.patch.object(thomasnet_server.ThomasnetHandler, "write_event",
+                                        side_effect=TimeoutError("timed out")):
+            request = urllib.request.Request(self.base_url + "/scrape/stream",
+                                             data=json.dumps({"max_results": 20}).encode())
+            with urllib.request.urlopen(request, timeout=30) as response:
+                with self.assertRaises(http.client.IncompleteRead):
+                    response.read()
+
+            self.wait_until(lambda: self.only_job().state == "cancelled")
+
+    def test_cancel_batch(self):
+        """Test DELETE /batches/{id} cancels every combination"""
+        _, created = self.post("/scrape/batch", {"combinations": [{"state": "Ohio"}, {"state": "Iowa"}],
+                                                 "max_results": 20})
+
+        status, batch = self.delete(f"/batches/{created['id']}")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(batch["state"], "cancelled")
+
+
+class TestWarmWorkerCancellation(TestCancellation):
+    """Test cases for cancelling jobs running on warm workers"""
+
+    warm_workers = True
+
+    def setUp(self):
+        os.environ["STUB_SCRAPER_FORMAT"] = "ndjson"
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0.3"
+        super().setUp()
+
+    def test_cancelled_worker_is_replaced(self):
+        """Test the pool swaps in a new worker after a cancel"""
+        _, created = self.post("/jobs", {"max_results": 20})
+        self.wait_until(lambda: self.get(f"/jobs/{created['id']}")[1]["progress"]["found"] >= 1)
+
+        self.delete(f"/jobs/{created['id']}")
+
+        self.wait_until(lambda: self.httpd.worker_pool.recycled == 1)
+        _, prospects = self.post("/scrape", {"state": "After", "max_results": 2})
+        self.assertEqual(len(prospects), 2)
+
+    def test_cancel_after_the_worker_is_released_spares_it(self):
+        """Test a cancel arriving once the job has handed its worker back doesn't kill the worker"""
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0"
+        finish = self.httpd.jobs._finish
+
+        def cancel_then_finish(job, error=None):
+            job.request_cancel()
+            finish(job, error)
+
+        with unittest.mock.patch.object(self.httpd.jobs, "_finish", cancel_then_finish):
+            self.post("/scrape", {"max_results": 2})
+        self.assertEqual(self.httpd.worker_pool.recycled, 0)
+        self.assertTrue(all(worker.alive for worker in self.httpd.worker_pool._idle))
+        _, prospects = self.post("/scrape", {"state": "After", "max_results": 2})
+        self.assertEqual(len(prospects), 2)
+
+    def test_cancel_kills_process_tree(self):
+        """Test covered by the spawn-mode case; workers share kill_process_tree"""
+
+
+class TestJobStore(unittest.TestCase):
+    """Test cases for the SQLite job store"""
+
+    params = {"state": "Ohio", "service": "CNC Machining", "sort_order": "Ascending",
+              "max_results": 10, "delay": 2}
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "jobs.db")
+        self.store = thomasnet_server.JobStore(self.path, max_finished=2)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def reopen(self):
+        self.store.close()
+        self.store = thomasnet_server.JobStore(self.path, max_finished=2)
+        return {job.id: job for job in self.store.load()}
+
+    def test_unfinished_job_reloads_from_checkpoint(self):
+        """Test a running job comes back queued with its checkpoint and prospects"""
+        job = thomasnet_server.ScrapeJob(self.params)
+        self.store.add(job)
+        job.start()
+        self.store.start(job)
+        job.add_prospect({"company": "Acme"})
+        self.store.checkpoint(job, {"page": 1, "visited": ["acme.com"]}, job.save_checkpoint({"page": 1}))
+        job.add_prospect({"company": "Not Checkpointed"})
+
+        loaded = self.reopen()[job.id]
+        self.assertEqual(loaded.state, "queued")
+        self.assertTrue(loaded.resumed)
+        self.assertFalse(loaded.finished)
+        self.assertEqual(loaded.checkpoint, {"page": 1, "visited": ["acme.com"]})
+        self.assertEqual(loaded.prospects, [{"company": "Acme"}])
+        self.assertEqual(loaded.params, self.params)
+
+    def test_finished_job_reloads_finished(self):
+        """Test a finished job keeps its state and every prospect"""
+        job = thomasnet_server.ScrapeJob(self.params)
+        self.store.add(job)
+        job.add_prospect({"company": "Acme"})
+        job.finish()
+        self.store.finish(job)
+
+        loaded = self.reopen()[job.id]
+        self.assertTrue(loaded.finished)
+        self.assertEqual(loaded.state, "done")
+        self.assertFalse(loaded.resumed)
+        self.assertEqual(loaded.prospects, [{"company": "Acme"}])
+
+    def test_checkpoint_writes_only_new_prospects(self):
+        """Test each checkpoint appends the prospects found since the last instead of rewriting them all"""
+        job = thomasnet_server.ScrapeJob(self.params)
+        self.store.add(job)
+        job.add_prospect({"company": "Acme"})
+        self.store.checkpoint(job, {"page": 1}, job.save_checkpoint({"page": 1}))
+        job.add_prospect({"company": "Bolt"})
+        job.add_prospect({"company": "Cog"})
+        written = []
+        self.store._conn.set_trace_callback(written.append)
+        self.store.checkpoint(job, {"page": 2}, job.save_checkpoint({"page": 2}))
+        self.store._conn.set_trace_callback(None)
+
+        inserts = [sql for sql in written if "INSERT INTO job_prospects" in sql]
+        self.assertEqual(len(inserts), 2)
+        self.assertFalse(any("Acme" in sql for sql in written))
+        self.assertEqual(self.reopen()[job.id].prospects,
+                         [{"company": "Acme"}, {"company": "Bolt"}, {"company": "Cog"}])
+
+    def test_finished_job_pages_from_store(self):
+        """Test a reloaded finished job reads its pages back from the store"""
+        job = thomasnet_server.ScrapeJob(self.params)
+        self.store.add(job)
+        for company in ("Acme", "Bolt", "Cog"):
+            job.add_prospect({"company": company})
+        job.finish()
+        self.store.finish(job)
+
+        loaded = self.reopen()[job.id]
+        self.assertEqual(loaded.found, 3)
+        self.assertEqual(loaded.page(1, 1), ([{"company": "Bolt"}], 3, True))
+        self.assertEqual(loaded.page(2, 5), ([{"company": "Cog"}], 3, True))
+        self.assertEqual(list(loaded.follow()), [{"company": "Acme"}, {"company": "Bolt"}, {"company": "Cog"}])
+
+    def test_stores_with_a_prospects_column_are_migrated(self):
+        """Test jobs saved with the whole prospect list in one column keep their prospects"""
+        self.store.close()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute("""
+            CREATE TABLE scrape_jobs (id TEXT PRIMARY KEY, params TEXT NOT NULL, state TEXT NOT NULL,
+                created_at REAL NOT NULL, started_at REAL, finished_at REAL, error TEXT,
+                cached INTEGER NOT NULL DEFAULT 0, checkpoint TEXT, prospects TEXT NOT NULL DEFAULT '[]')
+        """)
+        conn.execute("INSERT INTO scrape_jobs (id, params, state, created_at, finished_at, prospects)"
+                     " VALUES ('old', ?, 'done', 1, 2, ?)",
+                     (json.dumps(self.params), json.dumps([{"company": "Acme"}])))
+        conn.commit()
+        conn.close()
+        self.store = thomasnet_server.JobStore(self.path, max_finished=2)
+
+        loaded = self.reopen()["old"]
+        self.assertEqual(loaded.prospects, [{"company": "Acme"}])
+        job = thomasnet_server.ScrapeJob(self.params)
+        self.store.add(job)
+        job.finish()
+        self.assertTrue(self.store.finish(job))
+
+    def test_oldest_finished_jobs_are_pruned(self):
+        """Test only max_finished finished jobs are kept"""
+        jobs = [thomasnet_server.ScrapeJob(self.params) for _ in range(3)]
+        for job in jobs:
+            self.store.add(job)
+            job.add_prospect({"company": "Acme"})
+            job.finish()
+            self.store.finish(job)
+            time.sleep(0.01)
+
+        self.assertEqual(set(self.reopen()), {jobs[1].id, jobs[2].id})
+        self.assertEqual(self.store.prospects(jobs[0].id), [])
+
+    def test_writes_after_close_are_dropped(self):
+        """Test a job finishing during shutdown stays resumable"""
+        job = thomasnet_server.ScrapeJob(self.params)
+        self.store.add(job)
+        self.store.close()
+        job.finish("interrupted")
+        self.store.finish(job)
+
+        self.store = thomasnet_server.JobStore(self.path)
+        self.assertFalse(self.store.load()[0].finished)
+
+
+class TestJobResume(ServerTestCase):
+    """Test cases for resuming interrupted jobs after a restart"""
+
+    stub_latency = 0
+    use_job_store = True
+
+    def setUp(self):
+        super().setUp()
+        self.start_log = os.path.join(self.tmpdir.name, "starts.log")
+        os.environ["STUB_SCRAPER_FORMAT"] = "ndjson"
+        os.environ["STUB_SCRAPER_INTERVAL"] = "0.3"
+        os.environ["STUB_SCRAPER_PAGE_SIZE"] = "3"
+        os.environ["STUB_SCRAPER_START_LOG"] = self.start_log
+
+    def restart(self):
+        """Stop the server the way Ctrl-C does and start a new one on the same job store"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd = thomasnet_server.ThomasnetServer(
+            ('127.0.0.1', 0), thomasnet_server.ThomasnetHandler,
+            workers=self.workers, scraper_path=STUB_SCRAPER, **self.server_options())
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def wait_for(self, job_id, predicate, timeout=15):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            _, status = self.get(f"/jobs/{job_id}")
+            if predicate(status):
+                return status
+            time.sleep(0.05)
+        self.fail("condition not met in time")
+
+    def test_interrupted_job_resumes_from_checkpoint(self):
+        """Test a job cut off mid-scrape finishes after a restart without re-crawling"""
+        _, created = self.post("/jobs", {"max_results": 10})
+        self.wait_for(created["id"], lambda status: (status["checkpoint"] or {}).get("page") == 2)
+
+        self.restart()
+        self.assertEqual(self.httpd.resumed_jobs, 1)
+        status = self.wait_for(created["id"], lambda status: status["state"] == "done")
+        _, results = self.get(f"/jobs/{created['id']}/results")
+
+        self.assertTrue(status["resumed"])
+        self.assertEqual([p["company"] for p in results["prospects"]],
+                         [f"Stub Company {i}" for i in range(10)])
+        with open(self.start_log) as f:
+            starts = [int(line) for line in f]
+        self.assertEqual(starts[0], 0)
+        self.assertGreaterEqual(starts[1], 6)
+
+    def test_finished_jobs_survive_restart(self):
+        """Test a finished job's results are still served, page by page, after a restart"""
+        _, created = self.post("/jobs", {"max_results": 3})
+        self.wait_for(created["id"], lambda status: status["state"] == "done")
+        _, before = self.get(f"/jobs/{created['id']}/results?limit=2")
+
+        self.restart()
+        self.assertEqual(self.httpd.resumed_jobs, 0)
+        _, results = self.get(f"/jobs/{created['id']}/results")
+        self.assertEqual(results["count"], 3)
+        _, first = self.get(f"/jobs/{created['id']}/results?limit=2")
+        _, second = self.get(f"/jobs/{created['id']}/results?limit=2&cursor={first['next_cursor']}")
+        self.assertEqual(first, before)
+        self.assertEqual([p["company"] for p in first["prospects"] + second["prospects"]],
+                         [f"Stub Company {i}" for i in range(3)])
+        self.assertIsNone(second["next_cursor"])
+        _, past_end = self.get(f"/jobs/{created['id']}/results?cursor={2 ** 64}")
+        self.assertEqual((past_end["prospects"], past_end["count"]), ([], 3))
+
+    def test_cancelled_job_is_not_resumed(self):
+        """Test a job cancelled before the restart stays cancelled"""
+        _, created = self.post("/jobs", {"max_results": 10})
+        self.wait_for(created["id"], lambda status: status["progress"]["found"] >= 1)
+        request = urllib.request.Request(f"{self.base_url}/jobs/{created['id']}", method="DELETE")
+        urllib.request.urlopen(request, timeout=30).close()
+
+        self.restart()
+        self.assertEqual(self.httpd.resumed_jobs, 0)
+        self.assertEqual(self.get(f"/jobs/{created['id']}")[1]["state"], "cancelled")
+
+
+class TestParseArgs(unittest.TestCase):
+    """Test cases for command line parsing"""
+
+    def test_defaults(self):
+        """Test the positional port and default worker count"""
+        args = thomasnet_server.parse_args([])
+        self.assertEqual(args.port, 8080)
+        self.assertEqual(args.workers, thomasnet_server.DEFAULT_WORKERS)
+        self.assertIsNone(args.trace_log)
+        self.assertFalse(args.migrate_leads)
+
+    def test_port_and_workers(self):
+        """Test the port and --workers option"""
+        args = thomasnet_server.parse_args(["9090", "--workers", "8"])
+        self.assertEqual(args.port, 9090)
+        self.assertEqual(args.workers, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
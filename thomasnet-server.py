@@ -4,154 +4,3669 @@ Thomasnet Scraper Web Server
 This server provides an HTTP API to run the Thomasnet scraper
 """
 
+import gzip
+import hashlib
+import heapq
 import json
-import sys
 import os
+import select
+import signal
+import socket
+import sqlite3
 import subprocess
+import tempfile
+import uuid
 from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import argparse
+import base64
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
+import re
 import threading
 import time
+import zlib
+
+DEFAULT_SCRAPER_PATH = Path(__file__).parent / "thomasnet-scraper" / "run_scraper.py"
+DEFAULT_WORKERS = 4
+MAX_FINISHED_JOBS = 200
+SCRAPER_TIMEOUT = 300  # 5 minute timeout
+KILL_GRACE_SECONDS = 5
+DISCONNECT_POLL_SECONDS = 1
+SSE_HEARTBEAT_SECONDS = 15
+KEEPALIVE_TIMEOUT = 30  # seconds an idle persistent connection is kept open
+GZIP_MIN_BYTES = 1024  # smaller bodies aren't worth compressing
+GZIP_LEVEL = 6
+DEFAULT_CACHE_PATH = Path(__file__).parent / "scrape_cache.db"
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_ENTRIES = 500
+DEFAULT_JOBS_PATH = Path(__file__).parent / "scrape_jobs.db"
+DEFAULT_LEADS_PATH = Path(__file__).parent / "leads.db"
+CHECKPOINT_TAG = "__checkpoint__"
+SPAN_TAG = "__span__"
+RESUME_ENV = "THOMASNET_RESUME"
+TRACE_ENV = "THOMASNET_TRACE_ID"
+SKIP_FILE_ENV = "THOMASNET_SKIP_FILE"
+WORKER_SCRIPT = Path(__file__).parent / "scraper-worker.py"
+WORKER_STATUS_PREFIX = '{"__worker__"'
+DEFAULT_WORKER_MAX_JOBS = 25
+DEFAULT_WORKER_MAX_RSS_MB = 1024
+MAX_BATCH_COMBINATIONS = 500
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+JSON_WRITE_CHUNK = 200  # prospects serialized per write when sending a whole list
+THOMASNET_HOST = "www.thomasnet.com"
+DEFAULT_RATE_LIMIT = 0.5  # requests per second per host, the old 2 second delay
+DEFAULT_RATE_BURST = 3
+MAX_RATE_LIMIT_HOSTS = 1000  # host buckets kept before the least recently used is dropped
+HOST_NAME = re.compile(r'(?=.{1,253}$)[a-z0-9-]+(\.[a-z0-9-]+)*(:[0-9]{1,5})?')
+KNOWN_ROUTES = {
+    '/health', '/metrics', '/cache', '/scrape', '/scrape/stream', '/scrape/batch',
+    '/jobs', '/jobs/{id}', '/jobs/{id}/results', '/jobs/{id}/stream', '/jobs/{id}/trace',
+    '/batches/{id}', '/batches/{id}/results', '/ratelimit', '/ratelimit/acquire',
+    '/leads', '/leads/search', '/leads/import', '/leads/export', '/leads/{id}', '/stats', '/changes',
+    '/queue', '/queue/next', '/queue/called', '/queue/release', '/queues', '/queues/{id}', '/queues/{id}/members',
+}
+# First path segments followed by an ID, and the routes under them that aren't IDs
+ID_ROUTE_PREFIXES = ('jobs', 'batches', 'leads', 'queues')
+FIXED_SUBROUTES = ('leads/search', 'leads/import', 'leads/export')
+COMPANY_SUFFIXES = {'inc', 'incorporated', 'llc', 'ltd', 'co', 'corp', 'corporation', 'company', 'lp', 'llp'}
+
+
+def parse_scrape_params(data):
+    """
+    Pull the scrape parameters out of a request body, filling in defaults.
+    Raises ValueError for values the scraper can't be started with.
+    """
+    try:
+        max_results = int(data.get('max_results', 100))
+    except (TypeError, ValueError):
+        raise ValueError("'max_results' must be a positive integer") from None
+    if max_results < 1:
+        raise ValueError("'max_results' must be a positive integer")
+    params = {
+        'state': data.get('state', 'California'),
+        'service': data.get('service', 'CNC Machining'),
+        'sort_order': data.get('sort_order', 'Ascending'),
+        'max_results': max_results,
+        'delay': data.get('delay', 2),
+        'new_only': bool(data.get('new_only', False)),
+    }
+    for name in ('state', 'service', 'sort_order'):
+        if not isinstance(params[name], str) or not params[name].strip():
+            raise ValueError(f"'{name}' must be a non-empty string")
+    return params
+
+
+def parse_page_params(query):
+    """
+    Read `cursor` and `limit` from a parsed query string. The cursor is the
+    opaque `next_cursor` from the previous page (really the prospect offset).
+    """
+    cursor = query.get('cursor', ['0'])[0] or '0'
+    limit = query.get('limit', [str(DEFAULT_PAGE_LIMIT)])[0]
+    if not cursor.isdigit():
+        raise ValueError(f"invalid cursor {cursor!r}")
+    if not limit.isdigit() or int(limit) < 1:
+        raise ValueError("limit must be a positive integer")
+    return int(cursor), min(int(limit), MAX_PAGE_LIMIT)
+
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding header allows gzip (and doesn't give it q=0)"""
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def content_etag(body):
+    """Weak ETag from a hash of a response body (weak, since gzip changes the bytes sent)"""
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header lists `etag` (weak comparison) or is *"""
+    if if_none_match.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == bare:
+            return True
+    return False
+
+
+def kill_process_tree(process, grace=KILL_GRACE_SECONDS):
+    """
+    Stop a process started with start_new_session=True together with
+    everything it spawned (browser, driver): SIGTERM to the whole process
+    group, then SIGKILL if it hasn't exited after `grace` seconds.
+    """
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def normalize_company(name):
+    """Lower-case a company name and drop punctuation and suffixes like Inc. or LLC"""
+    words = re.sub(r'[^a-z0-9 ]+', ' ', (name or '').lower().replace('&', ' and ')).split()
+    while words and words[-1] in COMPANY_SUFFIXES:
+        words.pop()
+    return ' '.join(words)
+
+
+def website_domain(url):
+    """The bare host of a website URL, without scheme or www."""
+    url = (url or '').strip().lower()
+    if not url:
+        return ''
+    if '//' not in url:
+        url = '//' + url
+    host = urlparse(url).hostname or ''
+    return host[4:] if host.startswith('www.') else host
+
+
+def prospect_keys(prospect):
+    """Identity keys used to spot the same company in different results"""
+    keys = []
+    name = normalize_company(prospect.get('company') or prospect.get('company_name'))
+    if name:
+        keys.append(('company', name))
+    domain = website_domain(prospect.get('website'))
+    if domain:
+        keys.append(('domain', domain))
+    return keys
+
+
+def merge_prospects(prospect_lists):
+    """
+    Concatenate prospect lists, keeping the first of any prospects that share
+    a normalized company name or website domain. Returns (merged, duplicates).
+    """
+    seen = set()
+    merged = []
+    duplicates = 0
+    for prospects in prospect_lists:
+        for prospect in prospects:
+            keys = prospect_keys(prospect)
+            if any(key in seen for key in keys):
+                duplicates += 1
+                continue
+            seen.update(keys)
+            merged.append(prospect)
+    return merged, duplicates
+
+
+def parse_prospect_line(line):
+    """
+    Return the JSON object on one line of scraper output, or None if it
+    isn't one. Checkpoint and span lines come back as {"__checkpoint__": {...}}
+    and {"__span__": {...}}.
+    """
+    line = line.strip()
+    if not line.startswith('{'):
+        return None
+    try:
+        prospect = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    return prospect if isinstance(prospect, dict) else None
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# name -> (type, help) for every metric the server exports
+METRIC_DEFINITIONS = {
+    'thomasnet_http_requests_total': ('counter', "HTTP requests by route, method and status"),
+    'thomasnet_http_request_duration_seconds': ('histogram', "HTTP request latency by route"),
+    'thomasnet_http_response_bytes_total': ('counter', "Response body bytes sent by route"),
+    'thomasnet_scrape_phase_seconds': ('histogram', "Scraper time split into spawn, run and parse phases"),
+    'thomasnet_jobs_finished_total': ('counter', "Scrape jobs finished by final state"),
+    'thomasnet_jobs_coalesced_total': ('counter', "Requests attached to an identical in-flight job"),
+    'thomasnet_jobs_active': ('gauge', "Scrape jobs currently running"),
+    'thomasnet_jobs_queued': ('gauge', "Scrape jobs waiting for a worker"),
+    'thomasnet_cache_hits_total': ('counter', "Scrapes answered from the result cache"),
+    'thomasnet_cache_misses_total': ('counter', "Scrapes not found in the result cache"),
+    'thomasnet_cache_evictions_total': ('counter', "Cache entries evicted by the LRU limit"),
+    'thomasnet_rate_limit_wait_seconds': ('histogram', "Time spent waiting for a per-host rate limit token"),
+    'thomasnet_warm_workers_started_total': ('counter', "Warm scraper worker processes started"),
+    'thomasnet_warm_workers_recycled_total': ('counter', "Warm scraper workers replaced"),
+}
+
+
+def _escape_label(value):
+    """A label value with the text format's escapes, so it can't break out of its quotes"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self, gauges=None):
+        """
+        Prometheus exposition text. `gauges` maps metric names to values read
+        at scrape time, e.g. queue depth or counters kept elsewhere.
+        """
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {round(histogram[-2], 6)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram[-1]}")
+        for name, value in (gauges or {}).items():
+            samples[name] = [f"{name} {value}"]
+
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = METRIC_DEFINITIONS.get(name, ('untyped', name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return how long the caller must wait before using it.
+        Tokens may go negative, which queues callers in the order they asked.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """Block until a token is available; returns the seconds waited"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class HostRateLimiter:
+    """
+    One token bucket per target host, shared by every scrape job so the
+    total request rate to a host stays under its limit however many
+    workers are running. `overrides` maps hosts to their own (rate, burst).
+    Buckets are kept for the `max_hosts` most recently used hosts only.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_RATE_BURST, overrides=None,
+                 max_hosts=MAX_RATE_LIMIT_HOSTS):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = dict(overrides or {})
+        self.max_hosts = max_hosts
+        self._buckets = {}  # least recently used first
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        host = host.lower()
+        with self._lock:
+            bucket = self._buckets.pop(host, None)
+            if bucket is None:
+                rate, burst = self.overrides.get(host, (self.rate, self.burst))
+                bucket = TokenBucket(rate, burst)
+                if len(self._buckets) >= self.max_hosts:
+                    # Callers already waiting on the dropped bucket still get their turn
+                    del self._buckets[next(iter(self._buckets))]
+            self._buckets[host] = bucket
+            return bucket
+
+    def acquire(self, host):
+        return self.bucket(host).acquire()
+
+    def label(self, host):
+        """`host` as a metric label; hosts without a limit of their own share 'other'"""
+        host = host.lower()
+        return host if host == THOMASNET_HOST or host in self.overrides else 'other'
+
+    def limits(self):
+        with self._lock:
+            hosts = set(self._buckets) | set(self.overrides)
+        return {
+            "default": {"rate": self.rate, "burst": self.burst},
+            "hosts": {host: {"rate": self.bucket(host).rate, "burst": self.bucket(host).burst}
+                      for host in sorted(hosts)},
+        }
+
+
+def parse_host_rate(value):
+    """Parse a --host-rate option of the form host=rate or host=rate:burst"""
+    host, _, limit = value.partition('=')
+    rate, _, burst = limit.partition(':')
+    if not host or not rate:
+        raise argparse.ArgumentTypeError(f"expected host=rate[:burst], got {value!r}")
+    return host.lower(), (float(rate), int(burst) if burst else DEFAULT_RATE_BURST)
+
+
+def cache_key(params):
+    """Searches that return the same prospects share a key; delay doesn't matter"""
+    key = [params['state'], params['service'], params['sort_order'], params['max_results']]
+    if params.get('new_only'):
+        key.append('new_only')
+    return json.dumps(key)
+
+
+LEAD_COLUMNS = ('id', 'company_name', 'contact_name', 'email', 'industry', 'state', 'last_called',
+                'website', 'phones', 'comments', 'notes', 'call_outcome', 'date_added', 'version')
+LEAD_WRITABLE_COLUMNS = tuple(column for column in LEAD_COLUMNS if column not in ('id', 'version'))
+# Columns added to the CRM's original leads table, for databases that predate them
+LEAD_ADDED_COLUMNS = {'call_outcome': 'TEXT', 'date_added': 'TEXT', 'version': 'INTEGER'}
+# PRAGMA user_version of a leads.db with everything LeadStore adds; older ones need --migrate-leads
+LEAD_SCHEMA_VERSION = 1
+LEAD_SORT_COLUMNS = ('company_name', 'state', 'industry', 'last_called', 'id')
+LEAD_TEXT_COLUMNS = ('company_name', 'contact_name', 'email', 'website', 'phones', 'comments', 'notes')
+# Every filter/sort combination /leads serves walks one of these instead of the whole table
+LEAD_INDEXES = {
+    'idx_leads_company_id': '(company_name, id)',
+    'idx_leads_state_company': '(state, company_name, id)',
+    'idx_leads_state_last_called': '(state, last_called, id)',
+    'idx_leads_industry_company': '(industry, company_name, id)',
+    'idx_leads_industry_last_called': '(industry, last_called, id)',
+    'idx_leads_last_called': '(last_called, id)',
+    'idx_leads_last_called_company': '(last_called, company_name, id)',
+    'idx_leads_version': '(version)',
+}
+# Full-text search columns and their bm25 weights: a hit in the company name
+# outranks one in the website or email, which outranks one in the notes
+LEAD_SEARCH_WEIGHTS = {
+    'company_name': 10.0, 'contact_name': 5.0, 'industry': 3.0, 'notes': 1.0,
+    'comments': 1.0, 'website': 4.0, 'email': 4.0,
+}
+DEFAULT_SEARCH_LIMIT = 20
+# lead_stats dimension -> the value a lead (`{row}`, new or old) counts under;
+# NULL means it isn't counted. Calls per day are by each lead's latest call,
+# which is all leads.db records.
+LEAD_STATS_DIMENSIONS = {
+    'total': "''",
+    'never_called': "CASE WHEN {row}.last_called IS NULL OR {row}.last_called = '' THEN '' END",
+    'state': "NULLIF({row}.state, '')",
+    'industry': "NULLIF({row}.industry, '')",
+    'call_outcome': "NULLIF({row}.call_outcome, '')",
+    'called_day': "date({row}.last_called)",
+    'added_day': "date({row}.date_added)",
+}
+DEFAULT_STATS_DAYS = 30
+MAX_STATS_DAYS = 366
+DEFAULT_SYNC_LIMIT = 500
+MAX_SYNC_CHANGES = 1000  # per POST /changes
+# Normalized CSV header -> leads column: the scraper's CSVs (Lead, Emails,
+# Services, ...), the extension's export (Company, Last Called, ...) and
+# leads.db's own column names. Other headers are ignored.
+CSV_HEADER_COLUMNS = {
+    'lead': 'company_name', 'company': 'company_name', 'company_name': 'company_name',
+    'contact': 'contact_name', 'contact_name': 'contact_name',
+    'email': 'email', 'emails': 'email',
+    'industry': 'industry', 'service': 'industry', 'services': 'industry',
+    'state': 'state', 'website': 'website',
+    'phone': 'phones', 'phones': 'phones',
+    'last_called': 'last_called', 'call_outcome': 'call_outcome', 'date_added': 'date_added',
+    'comments': 'comments', 'notes': 'notes',
+}
+IMPORT_BATCH_ROWS = 10000
+# The call queue: leads never called, then those last called more than
+# `days` ago, oldest first. /queue/next reserves a lead for one rep for
+# `hold` seconds, the extension's 7 day callQueueDays being the default.
+DEFAULT_QUEUE_DAYS = 7
+MAX_QUEUE_DAYS = 3650
+DEFAULT_QUEUE_HOLD = 15 * 60
+MAX_QUEUE_HOLD = 24 * 60 * 60
+CUSTOM_QUEUE_COLUMNS = ('id', 'name', 'description', 'created_at', 'count')
+MAX_QUEUE_CHANGE = 100000  # lead IDs added plus removed per custom queue request
+EXPORT_BATCH_ROWS = 1000  # rows read and written per chunk of /leads/export
+LEAD_EXPORT_TYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson'}
+# Per-row triggers cost more than the inserts themselves, so a bulk import
+# swaps these for one set-based statement each (see LeadStore.import_csv)
+LEAD_INSERT_TRIGGERS = ('lead_stats_insert', 'lead_version_insert', 'leads_fts_insert')
+# Scoring is the expensive part of a search, so only the newest this many
+# matches, and the newest this many company name matches, are ranked: exact
+# for specific searches, and a word on half the leads still answers in
+# milliseconds
+SEARCH_RANK_CANDIDATES = 2000
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def is_sqlite_int(value):
+    """True for an int SQLite can bind: not a bool, and within 64 bits"""
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+
+
+def is_path_id(text):
+    """True for a URL path segment that is a row ID SQLite can bind"""
+    return text.isascii() and text.isdigit() and is_sqlite_int(int(text))
+
+
+def decode_cursor(cursor):
+    """The list encode_cursor() was given; ValueError for anything else"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor {cursor!r}") from e
+    if not isinstance(values, list):
+        raise ValueError(f"invalid cursor {cursor!r}")
+    return values
+
+
+def fts_query(text):
+    """
+    FTS5 MATCH expression for a search box string: every word must match,
+    the last one as a prefix so results keep up as the user types. A single
+    letter is matched as a word, since as a prefix it would expand to a
+    good share of the vocabulary. None if the text has no words.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if len(words[-1]) > 1:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def lead_csv_columns(header):
+    """The leads column for each CSV field (None to ignore it); ValueError without a company column"""
+    columns, seen = [], set()
+    for name in header:
+        column = CSV_HEADER_COLUMNS.get(re.sub(r'\s+', '_', name.strip().lower()))
+        columns.append(column if column not in seen else None)
+        seen.add(column)
+    if 'company_name' not in seen:
+        raise ValueError("the CSV needs a Company, Lead or company_name column")
+    return columns
+
+
+class BodyReader(io.RawIOBase):
+    """The next `length` bytes of a stream, so a request body can be parsed as it arrives"""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        data = self.stream.read(min(len(buffer), self.remaining))
+        self.remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def parse_lead_changes(data):
+    """
+    Check a POST /changes body and return (changes, force). Each change is
+    {"lead": {...}} for a new lead, {"id", "base_version", "lead": {...}}
+    for an edit of some columns, or {"id", "base_version", "deleted": true};
+    any of them may carry a "ref" that is echoed back.
+    """
+    changes = data.get('changes')
+    if not isinstance(changes, list) or not changes:
+        raise ValueError("'changes' must be a non-empty list")
+    if len(changes) > MAX_SYNC_CHANGES:
+        raise ValueError(f"at most {MAX_SYNC_CHANGES} changes per request")
+    force = bool(data.get('force', False))
+    for change in changes:
+        if not isinstance(change, dict):
+            raise ValueError("each change must be an object")
+        fields = change.get('lead', {})
+        if not isinstance(fields, dict):
+            raise ValueError("'lead' must be an object")
+        unknown = set(fields) - set(LEAD_WRITABLE_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown lead fields {', '.join(sorted(unknown))}")
+        if any(value is not None and not isinstance(value, (str, int, float)) for value in fields.values()):
+            raise ValueError("lead fields must be strings, numbers or null")
+        if any(isinstance(value, int) and not is_sqlite_int(value) for value in fields.values()):
+            raise ValueError("lead fields must fit in 64 bits")
+        lead_id = change.get('id')
+        if lead_id is None:
+            if change.get('deleted'):
+                raise ValueError("a deleted change needs the lead's id")
+            if not isinstance(fields.get('company_name'), str) or not fields['company_name'].strip():
+                raise ValueError("a new lead needs a company_name")
+            continue
+        if not is_sqlite_int(lead_id):
+            raise ValueError("'id' must be a 64-bit integer")
+        if 'company_name' in fields and not (isinstance(fields['company_name'], str)
+                                             and fields['company_name'].strip()):
+            raise ValueError("company_name can't be empty")
+        if not force and not is_sqlite_int(change.get('base_version')):
+            raise ValueError("an edit or delete needs the base_version it was made from")
+    return changes, force
+
+
+def parse_lead_query(query):
+    """
+    Turn a /leads query string into LeadStore.page() arguments. `sort` is a
+    column name, prefixed with - for descending order.
+    """
+    def value(name):
+        return query.get(name, [''])[0].strip() or None
+
+    sort = value('sort') or 'company_name'
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in LEAD_SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(LEAD_SORT_COLUMNS)}")
+    limit = value('limit') or str(DEFAULT_PAGE_LIMIT)
+    if not limit.isdigit() or int(limit) < 1:
+        raise ValueError("limit must be a positive integer")
+    after = None
+    if value('cursor'):
+        cursor_sort, descending_cursor, *after = decode_cursor(value('cursor'))
+        if (cursor_sort, descending_cursor) != (sort, descending) or len(after) != 2:
+            raise ValueError("cursor belongs to a different sort order")
+        sort_value, last_id = after
+        if not is_sqlite_int(last_id) or not (sort_value is None or isinstance(sort_value, str)
+                                              or is_sqlite_int(sort_value)):
+            raise ValueError(f"invalid cursor {query['cursor'][0]!r}")
+    return {
+        'state': value('state'),
+        'industry': value('industry'),
+        'called_after': value('called_after'),
+        'called_before': value('called_before'),
+        'never_called': value('never_called') in ('1', 'true', 'yes'),
+        'text': value('q'),
+        'sort': sort,
+        'descending': descending,
+        'after': after,
+        'limit': min(int(limit), MAX_PAGE_LIMIT),
+    }
+
+
+def parse_queue_options(data):
+    """
+    The call queue's filters from a POST body or a /queue query string (one
+    value per name): days since a lead's last call before it is due again,
+    and optionally a state, an industry and the custom queue to call from.
+    """
+    options = {'days': queue_number(data, 'days', DEFAULT_QUEUE_DAYS, 0, MAX_QUEUE_DAYS),
+               'queue_id': queue_number(data, 'queue', None, 1, 2 ** 63 - 1) if 'queue' in data else None}
+    for name in ('state', 'industry'):
+        value = data.get(name)
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"'{name}' must be a string")
+        options[name] = (value or '').strip() or None
+    return options
+
+
+def parse_custom_queue_change(data, new=False):
+    """
+    Check a custom queue POST body: {"add": [lead IDs], "remove": [lead
+    IDs]} for a change of members, or with `new`, {"name", "description",
+    "lead_ids"} for a new queue. Returns the body.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("the body must be a JSON object")
+    lists = ('lead_ids',) if new else ('add', 'remove')
+    if new:
+        if not isinstance(data.get('name'), str) or not data['name'].strip():
+            raise ValueError("a queue needs a name")
+        if data.get('description') is not None and not isinstance(data['description'], str):
+            raise ValueError("'description' must be a string")
+    for name in lists:
+        ids = data.setdefault(name, [])
+        if not isinstance(ids, list) or not all(is_sqlite_int(i) for i in ids):
+            raise ValueError(f"'{name}' must be a list of lead IDs")
+    if sum(len(data[name]) for name in lists) > MAX_QUEUE_CHANGE:
+        raise ValueError(f"at most {MAX_QUEUE_CHANGE} lead IDs per request")
+    return data
+
+
+def queue_number(data, name, default, low, high):
+    """data[name] as an int from low to high, digits in a string included"""
+    value = data.get(name, default)
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+        raise ValueError(f"'{name}' must be an integer from {low} to {high}")
+    return value
+
+
+class LeadStore:
+    """
+    The CRM's leads.db. Creates the leads table if it is missing and adds
+    the secondary indexes that let page() read one page of leads in index
+    order, whatever the filters, instead of scanning and sorting them all.
+    Also supplies the identity keys that new_only scrapes skip.
+
+    search() runs on leads_fts, an FTS5 index over LEAD_SEARCH_WEIGHTS'
+    columns that triggers keep in step with every write to leads, whoever
+    makes it. It is built from the existing leads the first time a
+    database is opened. `searchable` is False on SQLite builds without FTS5.
+
+    The call queue is read straight off the (filter, last_called, id)
+    indexes too, and lead_reservations keeps two reps from being handed
+    the same lead.
+
+    A new file gets all of this at once. An existing leads.db from before
+    LEAD_SCHEMA_VERSION is only upgraded in place with `migrate`, and
+    otherwise left untouched with a RuntimeError.
+
+    Writes share one connection under `_lock`, reads another under
+    `_read_lock`. A write can wait minutes for SQLite's write lock behind
+    an import, and reads must not queue behind it meanwhile.
+    """
+
+    def __init__(self, path, migrate=False):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        if not migrate:
+            self._check_schema()
+        self._conn = self._connect()
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS leads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                company_name TEXT UNIQUE,
+                contact_name TEXT,
+                email TEXT,
+                industry TEXT,
+                state TEXT,
+                last_called TEXT,
+                website TEXT,
+                phones TEXT,
+                comments TEXT,
+                notes TEXT,
+                call_outcome TEXT,
+                date_added TEXT,
+                version INTEGER
+            )
+        """)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(leads)")}
+        for column, column_type in LEAD_ADDED_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE leads ADD COLUMN {column} {column_type}")
+        for name, columns in LEAD_INDEXES.items():
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON leads{columns}")
+        self._conn.commit()
+        self._create_stats()
+        self._create_sync()
+        self._create_queue()
+        self.searchable = self._create_search_index()
+        self._conn.execute(f"PRAGMA user_version = {LEAD_SCHEMA_VERSION}")
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        self._reader.execute("PRAGMA query_only = ON")
+
+    def _check_schema(self):
+        # Read only, so a refused leads.db isn't even switched to WAL
+        if not os.path.exists(self.path):
+            return
+        conn = sqlite3.connect(f"{Path(self.path).resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            leads = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leads'").fetchone()
+        finally:
+            conn.close()
+        if leads and version < LEAD_SCHEMA_VERSION:
+            raise RuntimeError(f"{self.path} needs its tables, indexes and triggers upgrading; "
+                               "back it up and start once with --migrate-leads")
+
+    def _connect(self):
+        # WAL lets /leads and /leads/search keep reading while an import writes.
+        # A long import holds the write lock, so other writers wait rather than fail;
+        # reads go through their own connection so they don't wait with them.
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=300)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _create_sync(self):
+        """
+        Every write to leads takes the next number from lead_sync as the
+        lead's version, and deletes leave a tombstone in deleted_leads, so
+        changes() can list everything since a version from two indexes.
+        Leads from before versioning get versions in id order.
+        """
+        data_columns = ', '.join(LEAD_WRITABLE_COLUMNS)
+        bump = "UPDATE lead_sync SET version = version + 1;"
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lead_sync"
+                               " (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS deleted_leads (
+                    id INTEGER PRIMARY KEY,
+                    company_name TEXT,
+                    version INTEGER NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_deleted_leads_version ON deleted_leads(version)")
+            self._conn.execute("UPDATE leads SET version = id + (SELECT COALESCE(MAX(version), 0) FROM leads)"
+                               " WHERE version IS NULL")
+            self._conn.execute("INSERT OR IGNORE INTO lead_sync (id, version) VALUES (0, 0)")
+            self._conn.execute("UPDATE lead_sync SET version = MAX(version,"
+                               " (SELECT COALESCE(MAX(version), 0) FROM leads),"
+                               " (SELECT COALESCE(MAX(version), 0) FROM deleted_leads))")
+            # Setting version fires no trigger: each listens for its own columns only
+            self._conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS lead_version_insert AFTER INSERT ON leads BEGIN
+                    {bump}
+                    UPDATE leads SET version = (SELECT version FROM lead_sync) WHERE id = new.id;
+                END
+            """)
+            self._conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS lead_version_update AFTER UPDATE OF id, {data_columns} ON leads BEGIN
+                    {bump}
+                    UPDATE leads SET version = (SELECT version FROM lead_sync) WHERE id = new.id;
+                END
+            """)
+            self._conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS lead_version_delete AFTER DELETE ON leads BEGIN
+                    {bump}
+                    INSERT OR REPLACE INTO deleted_leads (id, company_name, version)
+                    VALUES (old.id, old.company_name, (SELECT version FROM lead_sync));
+                END
+            """)
+
+    def _create_queue(self):
+        # One row per lead a rep is working; expired rows are ignored and
+        # cleared out by the next reservation. Custom queues keep their
+        # leads in call_queue_members, ordered by position.
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS lead_reservations (
+                    lead_id INTEGER PRIMARY KEY,
+                    rep TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_lead_reservations_rep ON lead_reservations(rep)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_lead_reservations_expires ON lead_reservations(expires_at)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS call_queues (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    description TEXT,
+                    created_at TEXT
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS call_queue_members (
+                    queue_id INTEGER NOT NULL,
+                    lead_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    PRIMARY KEY (queue_id, lead_id)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_call_queue_members_position"
+                               " ON call_queue_members(queue_id, position)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_call_queue_members_lead ON call_queue_members(lead_id)")
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS call_queue_members_delete AFTER DELETE ON leads BEGIN
+                    DELETE FROM call_queue_members WHERE lead_id = old.id;
+                END
+            """)
+
+    def _create_stats(self):
+        """
+        lead_stats holds a count per LEAD_STATS_DIMENSIONS value, adjusted by
+        triggers on every insert, delete and counted-column update, so the
+        dashboard reads a few dozen rows instead of counting every lead.
+        """
+        def count(row, change):
+            statements = []
+            for dimension, value in LEAD_STATS_DIMENSIONS.items():
+                value = value.format(row=row)
+                if change > 0:
+                    statements.append(
+                        f"INSERT INTO lead_stats (dimension, value, count)"
+                        f" SELECT '{dimension}', value, 1 FROM (SELECT {value} AS value) WHERE value IS NOT NULL"
+                        f" ON CONFLICT (dimension, value) DO UPDATE SET count = count + 1;")
+                else:
+                    statements.append(f"UPDATE lead_stats SET count = count - 1"
+                                      f" WHERE dimension = '{dimension}' AND value = {value};")
+            return '\n'.join(statements)
+
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lead_stats'").fetchone()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS lead_stats (
+                    dimension TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (dimension, value)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS lead_stats_insert AFTER INSERT ON leads BEGIN
+                    {count('new', 1)}
+                END
+            """)
+            self._conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS lead_stats_delete AFTER DELETE ON leads BEGIN
+                    {count('old', -1)}
+                END
+            """)
+            self._conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS lead_stats_update
+                AFTER UPDATE OF state, industry, call_outcome, last_called, date_added ON leads BEGIN
+                    {count('old', -1)}
+                    {count('new', 1)}
+                END
+            """)
+            if not exists:
+                for dimension, value in LEAD_STATS_DIMENSIONS.items():
+                    self._conn.execute(
+                        f"INSERT INTO lead_stats (dimension, value, count)"
+                        f" SELECT '{dimension}', value, COUNT(*) FROM (SELECT {value.format(row='leads')} AS value"
+                        f" FROM leads) WHERE value IS NOT NULL GROUP BY value")
+
+    def _create_search_index(self):
+        columns = ', '.join(LEAD_SEARCH_WEIGHTS)
+        new_values = ', '.join(f"new.{column}" for column in LEAD_SEARCH_WEIGHTS)
+        old_values = ', '.join(f"old.{column}" for column in LEAD_SEARCH_WEIGHTS)
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leads_fts'").fetchone()
+        try:
+            with self._conn:
+                # External content: the index stores only tokens, reading the text back from leads.
+                # Prefix indexes make 2 and 3 character prefixes, the slow ones, a single lookup.
+                self._conn.execute(f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS leads_fts USING fts5(
+                        {columns}, content='leads', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                    )
+                """)
+                self._conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS leads_fts_insert AFTER INSERT ON leads BEGIN
+                        INSERT INTO leads_fts (rowid, {columns}) VALUES (new.id, {new_values});
+                    END
+                """)
+                self._conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS leads_fts_delete AFTER DELETE ON leads BEGIN
+                        INSERT INTO leads_fts (leads_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+                    END
+                """)
+                # Logging a call only touches last_called, which leaves the index alone
+                self._conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS leads_fts_update AFTER UPDATE OF id, {columns} ON leads BEGIN
+                        INSERT INTO leads_fts (leads_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+                        INSERT INTO leads_fts (rowid, {columns}) VALUES (new.id, {new_values});
+                    END
+                """)
+                if not exists:
+                    self._conn.execute("INSERT INTO leads_fts (leads_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            if 'fts5' not in str(e):
+                raise
+            print(f"SQLite has no FTS5, lead search is disabled: {e}")
+            return False
+        return True
+
+    def known_keys(self):
+        """Identity keys (normalized company name and website domain) of every lead"""
+        with self._read_lock:
+            rows = self._reader.execute("SELECT company_name, website FROM leads").fetchall()
+        keys = set()
+        for company_name, website in rows:
+            keys.update(prospect_keys({'company': company_name, 'website': website}))
+        return keys
+
+    def stats(self, days=DEFAULT_STATS_DAYS):
+        """
+        Lead counts from lead_stats: the total, never called, and by state,
+        industry and call outcome (largest first), plus leads last called
+        and added on each of the last `days` days (UTC, oldest first).
+        """
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT dimension, value, count FROM lead_stats WHERE count > 0"
+                " AND (dimension NOT IN ('called_day', 'added_day') OR value >= ?)", (since,)).fetchall()
+        grouped = {dimension: {} for dimension in LEAD_STATS_DIMENSIONS}
+        for dimension, value, count in rows:
+            grouped[dimension][value] = count
+
+        def largest_first(counts):
+            return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+        return {
+            "total": grouped['total'].get('', 0),
+            "never_called": grouped['never_called'].get('', 0),
+            "states": largest_first(grouped['state']),
+            "industries": largest_first(grouped['industry']),
+            "call_outcomes": largest_first(grouped['call_outcome']),
+            "called_by_day": dict(sorted(grouped['called_day'].items())),
+            "added_by_day": dict(sorted(grouped['added_day'].items())),
+        }
+
+    def get(self, lead_id):
+        with self._read_lock:
+            return self._get(self._reader, lead_id)
+
+    @staticmethod
+    def _get(conn, lead_id, column='id'):
+        row = conn.execute(f"SELECT {', '.join(LEAD_COLUMNS)} FROM leads WHERE {column} = ?",
+                                 (lead_id,)).fetchone()
+        return dict(zip(LEAD_COLUMNS, row)) if row else None
+
+    def import_csv(self, stream, existing='update'):
+        """
+        Upsert the leads in a CSV text stream on company_name. New companies
+        are inserted; for known ones the CSV's non-empty fields overwrite the
+        lead's, or with existing='skip' they are left alone. Returns counts
+        of leads imported and updated, and of rows skipped: rows without a
+        company name or that changed nothing (repeats in the file included).
+
+        Rows are parsed and merged by company into a temporary table in
+        batches, so memory use doesn't grow with the file. The merge into
+        leads is then one statement in one transaction on a connection of
+        its own. The per-row insert triggers are dropped for that
+        transaction and their work done set-based for all new leads at once;
+        updates still go through the triggers, but only for leads that
+        actually change. Nobody else can write meanwhile, so nothing misses
+        the triggers.
+        """
+        reader = csv.reader(stream)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError("the CSV is empty")
+        columns = lead_csv_columns(header)
+        fields = [(index, column) for index, column in enumerate(columns) if column]
+        names = [column for _, column in fields]
+        company = names.index('company_name')
+        rows = 0
+
+        conn = self._connect()
+        try:
+            conn.execute(f"CREATE TEMP TABLE lead_import ({', '.join(f'{name} TEXT' for name in names)},"
+                         f" PRIMARY KEY (company_name))")
+            merge = ', '.join(f"{name} = COALESCE(NULLIF(excluded.{name}, ''), {name})"
+                              for name in names if name != 'company_name')
+            stage = (f"INSERT INTO lead_import ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+                     f" ON CONFLICT (company_name) DO " + (f"UPDATE SET {merge}" if merge else "NOTHING"))
+            while True:
+                batch = []
+                for row in reader:
+                    rows += 1
+                    # Empty cells are NULL, as they are for leads written any other way
+                    values = [(row[index].strip() or None) if index < len(row) else None for index, _ in fields]
+                    if values[company]:
+                        batch.append(values)
+                    if len(batch) == IMPORT_BATCH_ROWS:
+                        break
+                if not batch:
+                    break
+                with conn:
+                    conn.executemany(stage, batch)
+            imported, updated = self._merge_import(conn, names, existing)
+        finally:
+            conn.close()
+        return {"imported": imported, "updated": updated, "skipped": rows - imported - updated, "rows": rows}
+
+    def _merge_import(self, conn, names, existing):
+        """Upsert lead_import into leads (see import_csv); returns (imported, updated)"""
+        insert_names = names + ([] if 'date_added' in names else ['date_added'])
+        values = ', '.join(names + ([] if 'date_added' in names else ['?']))
+        data = [name for name in names if name != 'company_name']
+        if existing == 'update' and data:
+            changed = ' OR '.join(f"(NULLIF(excluded.{name}, '') IS NOT NULL AND excluded.{name} IS NOT leads.{name})"
+                                  for name in data)
+            merge = ', '.join(f"{name} = COALESCE(NULLIF(excluded.{name}, ''), leads.{name})" for name in data)
+            conflict = f"DO UPDATE SET {merge} WHERE {changed}"
+        else:
+            conflict = "DO NOTHING"
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            triggers = conn.execute(
+                f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'leads'"
+                f" AND name IN ({', '.join('?' * len(LEAD_INSERT_TRIGGERS))})", LEAD_INSERT_TRIGGERS).fetchall()
+            for name, _ in triggers:
+                conn.execute(f"DROP TRIGGER {name}")
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM leads").fetchone()[0]
+            cursor = conn.execute(
+                f"INSERT INTO leads ({', '.join(insert_names)}) SELECT {values} FROM lead_import WHERE true"
+                f" ORDER BY company_name ON CONFLICT (company_name) {conflict}", [] if 'date_added' in names else [now])
+            imported = conn.execute("SELECT COUNT(*) FROM leads WHERE id > ?", (last_id,)).fetchone()[0]
+            updated = cursor.rowcount - imported
+
+            dropped = {name for name, _ in triggers}
+            if 'lead_version_insert' in dropped:
+                conn.execute("UPDATE leads SET version = (SELECT version FROM lead_sync) + id - ? WHERE id > ?",
+                             (last_id, last_id))
+                conn.execute("UPDATE lead_sync SET version = version + COALESCE((SELECT MAX(id) FROM leads), ?) - ?",
+                             (last_id, last_id))
+            if 'lead_stats_insert' in dropped:
+                for dimension, value in LEAD_STATS_DIMENSIONS.items():
+                    conn.execute(
+                        f"INSERT INTO lead_stats (dimension, value, count)"
+                        f" SELECT '{dimension}', value, COUNT(*) FROM (SELECT {value.format(row='leads')} AS value"
+                        f" FROM leads WHERE id > ?) WHERE value IS NOT NULL GROUP BY value"
+                        f" ON CONFLICT (dimension, value) DO UPDATE SET count = count + excluded.count", (last_id,))
+            if 'leads_fts_insert' in dropped:
+                conn.execute(f"INSERT INTO leads_fts (rowid, {', '.join(LEAD_SEARCH_WEIGHTS)})"
+                             f" SELECT id, {', '.join(LEAD_SEARCH_WEIGHTS)} FROM leads WHERE id > ?", (last_id,))
+            for _, sql in triggers:
+                conn.execute(sql)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return imported, updated
+
+    def changes(self, since, limit=DEFAULT_SYNC_LIMIT):
+        """
+        Up to `limit` changes after version `since`, oldest first: changed
+        leads as from get(), deleted ones as {"id", "deleted": True, "version"}.
+        Returns (changes, next_since, more); pass next_since back for the rest.
+        """
+        with self._read_lock:
+            rows = self._reader.execute(f"SELECT {', '.join(LEAD_COLUMNS)} FROM leads WHERE version > ?"
+                                        f" ORDER BY version LIMIT ?", (since, limit + 1)).fetchall()
+            deleted = self._reader.execute("SELECT id, version FROM deleted_leads WHERE version > ?"
+                                           " ORDER BY version LIMIT ?", (since, limit + 1)).fetchall()
+        changes = [dict(zip(LEAD_COLUMNS, row)) for row in rows]
+        changes += [{"id": lead_id, "deleted": True, "version": version} for lead_id, version in deleted]
+        changes.sort(key=lambda change: change['version'])
+        more = len(changes) > limit
+        changes = changes[:limit]
+        return changes, changes[-1]['version'] if changes else since, more
+
+    def apply_changes(self, changes, force=False):
+        """
+        Apply changes from parse_lead_changes() in one transaction. An edit
+        or delete only applies if the lead is still at the client's
+        base_version (or with `force`), and a new lead only if no lead has
+        its company name. Returns (applied, conflicts, version): each applied
+        change's id and new version, and for each conflict a `reason` and
+        the server's copy of the lead for the client to merge and retry.
+        """
+        applied, conflicts = [], []
+        with self._lock, self._conn:
+            for change in changes:
+                result = self._apply_change(change, force)
+                (conflicts if 'reason' in result else applied).append(result)
+            version = self._conn.execute("SELECT version FROM lead_sync").fetchone()[0]
+        return applied, conflicts, version
+
+    def _apply_change(self, change, force):
+        result = {'ref': change['ref']} if 'ref' in change else {}
+        fields = change.get('lead', {})
+        lead_id = change.get('id')
+
+        if lead_id is None:
+            existing = self._get(self._conn, fields['company_name'], column='company_name')
+            if existing is not None:
+                return dict(result, id=existing['id'], reason='exists', lead=existing)
+            cursor = self._conn.execute(
+                f"INSERT INTO leads ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                list(fields.values()))
+            return dict(result, id=cursor.lastrowid, version=self._get(self._conn, cursor.lastrowid)['version'])
+
+        result['id'] = lead_id
+        current = self._get(self._conn, lead_id)
+        if current is None:
+            tombstone = self._conn.execute("SELECT version FROM deleted_leads WHERE id = ?", (lead_id,)).fetchone()
+            if tombstone is None:
+                return dict(result, reason='missing')
+            if change.get('deleted'):
+                return dict(result, deleted=True, version=tombstone[0])
+            return dict(result, reason='deleted')
+        if not force and change.get('base_version') != current['version']:
+            return dict(result, reason='changed', lead=current)
+
+        if change.get('deleted'):
+            self._conn.execute("DELETE FROM leads WHERE id = ?", (lead_id,))
+            return dict(result, deleted=True,
+                        version=self._conn.execute("SELECT version FROM lead_sync").fetchone()[0])
+        if fields:
+            try:
+                self._conn.execute(f"UPDATE leads SET {', '.join(f'{column} = ?' for column in fields)}"
+                                   f" WHERE id = ?", list(fields.values()) + [lead_id])
+            except sqlite3.IntegrityError:
+                existing = self._get(self._conn, fields['company_name'], column='company_name')
+                return dict(result, reason='exists', lead=existing)
+        return dict(result, version=self._get(self._conn, lead_id)['version'])
+
+    def page(self, state=None, industry=None, called_after=None, called_before=None, never_called=False,
+             text=None, sort='company_name', descending=False, after=None, limit=DEFAULT_PAGE_LIMIT):
+        """
+        One page of leads matching the filters, ordered by `sort` then id.
+        `after` is the (sort value, id) of the last lead on the previous page.
+        Returns (leads, next_after), next_after being None on the last page.
+        `last_called` bounds compare ISO timestamps; `called_before` is exclusive.
+        """
+        where, args = [], []
+        for column, wanted in (('state', state), ('industry', industry)):
+            if wanted is not None:
+                where.append(f"{column} = ?")
+                args.append(wanted)
+        if called_after is not None:
+            where.append("last_called >= ?")
+            args.append(called_after)
+        if called_before is not None:
+            where.append("last_called < ?")
+            args.append(called_before)
+        if never_called:
+            where.append("last_called IS NULL")
+        if text:
+            pattern = '%' + re.sub(r'([\\%_])', r'\\\1', text) + '%'
+            where.append('(' + ' OR '.join(f"{column} LIKE ? ESCAPE '\\'" for column in LEAD_TEXT_COLUMNS) + ')')
+            args.extend([pattern] * len(LEAD_TEXT_COLUMNS))
+        direction = 'DESC' if descending else 'ASC'
+        order = f"id {direction}" if sort == 'id' else f"{sort} {direction}, id {direction}"
+        rows = []
+        with self._read_lock:
+            for clause, keyset_args in self._keyset(sort, descending, *after) if after is not None else [(None, [])]:
+                conditions = where + [clause] if clause else where
+                sql = (f"SELECT {', '.join(LEAD_COLUMNS)} FROM leads"
+                       f"{' WHERE ' + ' AND '.join(conditions) if conditions else ''} ORDER BY {order} LIMIT ?")
+                rows += self._reader.execute(sql, args + keyset_args + [limit + 1 - len(rows)]).fetchall()
+                if len(rows) > limit:
+                    break
+        leads = [dict(zip(LEAD_COLUMNS, row)) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return leads, None
+        return leads, (leads[-1][sort], leads[-1]['id'])
+
+    def search(self, text, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Up to `limit` leads matching every word of `text` (the last as a
+        prefix), best first by bm25 with LEAD_SEARCH_WEIGHTS, and whether
+        matches went unranked. When more than SEARCH_RANK_CANDIDATES leads
+        match, only the newest that many are ranked, plus the newest that
+        many matching in the company name, so an older lead the search names
+        is still found; older leads matching only elsewhere are left out.
+        """
+        match = fts_query(text)
+        if match is None:
+            return [], False
+        weights = ', '.join(str(weight) for weight in LEAD_SEARCH_WEIGHTS.values())
+        # Rank inside the FTS index first so only the returned rows are read from leads
+        newest = (f"SELECT rowid, bm25(leads_fts, {weights}) FROM leads_fts"
+                  f" WHERE leads_fts MATCH ? ORDER BY rowid DESC LIMIT ?")
+        with self._read_lock:
+            window = self._reader.execute(newest, (match, SEARCH_RANK_CANDIDATES + 1)).fetchall()
+            truncated = len(window) > SEARCH_RANK_CANDIDATES
+            scores = {}
+            if truncated:
+                # Scored on the name alone, which can only undersell a lead; one in both keeps its full score
+                scores.update(self._reader.execute(
+                    newest, (f"company_name : ({match})", SEARCH_RANK_CANDIDATES)).fetchall())
+            scores.update(window[:SEARCH_RANK_CANDIDATES])
+            best = [rowid for rowid, _ in heapq.nsmallest(limit, scores.items(), key=lambda hit: (hit[1], hit[0]))]
+            rows = self._reader.execute(f"SELECT {', '.join(LEAD_COLUMNS)} FROM leads"
+                                        f" WHERE id IN ({', '.join('?' * len(best))})", best).fetchall()
+        leads = {row[0]: dict(zip(LEAD_COLUMNS, row)) for row in rows}
+        return [leads[rowid] for rowid in best if rowid in leads], truncated
+
+    def export(self, batch_rows=EXPORT_BATCH_ROWS):
+        """
+        Every lead as a tuple of LEAD_COLUMNS values in id order, yielded in
+        lists of `batch_rows` so memory use doesn't grow with the table. The
+        rows come from a single statement on a connection of its own: a
+        consistent snapshot however long the reader takes, that doesn't hold
+        the store's lock or block writers meanwhile. Close the generator if
+        it isn't run to the end.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute(f"SELECT {', '.join(LEAD_COLUMNS)} FROM leads ORDER BY id")
+            rows = cursor.fetchmany(batch_rows)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(batch_rows)
+        finally:
+            conn.close()
+
+    def queue(self, days=DEFAULT_QUEUE_DAYS, state=None, industry=None, queue_id=None, limit=DEFAULT_PAGE_LIMIT):
+        """The first `limit` leads of the call queue, or of a custom queue, that nobody has reserved"""
+        with self._read_lock:
+            return self._due(self._reader, days, state, industry, limit, time.time(), queue_id)
+
+    def reserve_next(self, rep, days=DEFAULT_QUEUE_DAYS, state=None, industry=None, queue_id=None,
+                     hold=DEFAULT_QUEUE_HOLD):
+        """
+        Reserve the first unreserved lead of the call queue for `rep` for
+        `hold` seconds and return (lead, expires_at), or (None, None) if the
+        queue is empty. A rep works one lead at a time, so the one they held
+        before is released, after the pick so that asking again skips it.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            leads = self._due(self._conn, days, state, industry, 1, now, queue_id)
+            self._conn.execute("DELETE FROM lead_reservations WHERE rep = ?", (rep,))
+            self._conn.execute("DELETE FROM lead_reservations WHERE expires_at <= ?", (now,))
+            if not leads:
+                return None, None
+            self._conn.execute("INSERT INTO lead_reservations (lead_id, rep, expires_at) VALUES (?, ?, ?)",
+                               (leads[0]['id'], rep, now + hold))
+        return leads[0], now + hold
+
+    def record_call(self, lead_id, rep, outcome=None):
+        """
+        Set a lead's last_called to now and its call_outcome, and release its
+        reservation, which moves it to the back of the queue. Returns (lead,
+        holder): the updated lead, or None if there is no such lead, and
+        with no update, the rep holding it if that is someone else.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            holder = self._conn.execute("SELECT rep FROM lead_reservations WHERE lead_id = ? AND expires_at > ?",
+                                        (lead_id, now)).fetchone()
+            if holder is not None and holder[0] != rep:
+                return self._get(self._conn, lead_id), holder[0]
+            called = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
+            cursor = self._conn.execute("UPDATE leads SET last_called = ?, call_outcome = ? WHERE id = ?",
+                                        (called, outcome, lead_id))
+            if cursor.rowcount == 0:
+                return None, None
+            self._conn.execute("DELETE FROM lead_reservations WHERE lead_id = ?", (lead_id,))
+            return self._get(self._conn, lead_id), None
+
+    def release(self, lead_id, rep):
+        """Put a lead `rep` reserved back in the queue uncalled; False if they didn't hold it"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM lead_reservations WHERE lead_id = ? AND rep = ?",
+                                        (lead_id, rep))
+        return cursor.rowcount > 0
+
+    def custom_queues(self):
+        """Every custom queue with its member count, oldest first"""
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT id, name, description, created_at,"
+                " (SELECT COUNT(*) FROM call_queue_members WHERE queue_id = call_queues.id)"
+                " FROM call_queues ORDER BY id").fetchall()
+        return [dict(zip(CUSTOM_QUEUE_COLUMNS, row)) for row in rows]
+
+    def custom_queue(self, queue_id):
+        with self._read_lock:
+            return self._custom_queue(self._reader, queue_id)
+
+    @staticmethod
+    def _custom_queue(conn, queue_id):
+        row = conn.execute(
+            "SELECT id, name, description, created_at,"
+            " (SELECT COUNT(*) FROM call_queue_members WHERE queue_id = call_queues.id)"
+            " FROM call_queues WHERE id = ?", (queue_id,)).fetchone()
+        return dict(zip(CUSTOM_QUEUE_COLUMNS, row)) if row else None
+
+    def create_custom_queue(self, name, description=None, lead_ids=()):
+        """Create a custom queue holding `lead_ids` in that order and return it"""
+        created = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        with self._lock, self._conn:
+            cursor = self._conn.execute("INSERT INTO call_queues (name, description, created_at) VALUES (?, ?, ?)",
+                                        (name, description, created))
+            self._add_members(cursor.lastrowid, lead_ids)
+            return self._custom_queue(self._conn, cursor.lastrowid)
+
+    def delete_custom_queue(self, queue_id):
+        """Delete a custom queue and its membership; False if there was no such queue"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM call_queue_members WHERE queue_id = ?", (queue_id,))
+            return self._conn.execute("DELETE FROM call_queues WHERE id = ?", (queue_id,)).rowcount > 0
+
+    def change_custom_queue(self, queue_id, add=(), remove=()):
+        """
+        Remove then add members of a custom queue in one transaction. Added
+        leads go to the end in the order given; leads already in the queue
+        and IDs of no lead are skipped. Returns counts of leads added and
+        removed with the queue's new size, or None if there is no such queue.
+        """
+        with self._lock, self._conn:
+            if self._custom_queue(self._conn, queue_id) is None:
+                return None
+            removed = self._conn.executemany("DELETE FROM call_queue_members WHERE queue_id = ? AND lead_id = ?",
+                                             ((queue_id, lead_id) for lead_id in remove)).rowcount
+            added = self._add_members(queue_id, add)
+            count = self._conn.execute("SELECT COUNT(*) FROM call_queue_members WHERE queue_id = ?",
+                                       (queue_id,)).fetchone()[0]
+        return {"added": added, "removed": removed, "count": count}
+
+    def _add_members(self, queue_id, lead_ids):
+        last = self._conn.execute("SELECT COALESCE(MAX(position), 0) FROM call_queue_members WHERE queue_id = ?",
+                                  (queue_id,)).fetchone()[0]
+        # Positions only order members, so gaps left by skipped IDs don't matter
+        return self._conn.executemany(
+            "INSERT INTO call_queue_members (queue_id, lead_id, position) SELECT ?, id, ? FROM leads WHERE id = ?"
+            " ON CONFLICT (queue_id, lead_id) DO NOTHING",
+            ((queue_id, last + offset, lead_id) for offset, lead_id in enumerate(lead_ids, 1))).rowcount
+
+    def custom_queue_page(self, queue_id, after=None, limit=DEFAULT_PAGE_LIMIT):
+        """
+        One page of a custom queue's leads in queue order, starting after
+        position `after`, and the position to continue from (None on the
+        last page). A page is a range of the (queue_id, position) index
+        joined to leads by id, so page 500 of a queue costs what page 1 does.
+        """
+        columns = ', '.join('l.' + column for column in LEAD_COLUMNS)
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT {columns}, m.position FROM call_queue_members AS m JOIN leads AS l ON l.id = m.lead_id"
+                f" WHERE m.queue_id = ? AND m.position > ? ORDER BY m.position LIMIT ?",
+                (queue_id, after or 0, limit + 1)).fetchall()
+        leads = [dict(zip(LEAD_COLUMNS, row)) for row in rows[:limit]]
+        return leads, (rows[limit - 1][-1] if len(rows) > limit else None)
+
+    @staticmethod
+    def _due(conn, days, state, industry, limit, now, queue_id=None):
+        """
+        Up to `limit` unreserved leads due a call: those never called in id
+        order, then those last called before `days` ago, oldest call first.
+        Each is a range of an index on (last_called, id), after the state or
+        industry, so the next lead costs one index seek plus a step for each
+        reserved lead ahead of it, however many leads there are. With a
+        custom queue, it's that queue's leads due a call in queue order,
+        read along its (queue_id, position) index.
+        """
+        threshold = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now - days * 24 * 60 * 60))
+        where, args = [], []
+        for column, wanted in (('state', state), ('industry', industry)):
+            if wanted is not None:
+                where.append(f"l.{column} = ?")
+                args.append(wanted)
+        where.append("NOT EXISTS (SELECT 1 FROM lead_reservations AS r WHERE r.lead_id = l.id AND r.expires_at > ?)")
+        args.append(now)
+        columns = ', '.join('l.' + column for column in LEAD_COLUMNS)
+        if queue_id is not None:
+            rows = conn.execute(
+                f"SELECT {columns} FROM call_queue_members AS m JOIN leads AS l ON l.id = m.lead_id"
+                f" WHERE m.queue_id = ? AND (l.last_called IS NULL OR l.last_called < ?) AND {' AND '.join(where)}"
+                f" ORDER BY m.position LIMIT ?", [queue_id, threshold] + args + [limit]).fetchall()
+            return [dict(zip(LEAD_COLUMNS, row)) for row in rows]
+        leads = []
+        for due, due_args, order in (("l.last_called IS NULL", [], "l.id"),
+                                     ("l.last_called < ?", [threshold], "l.last_called, l.id")):
+            rows = conn.execute(
+                f"SELECT {columns} FROM leads AS l WHERE {due} AND {' AND '.join(where)}"
+                f" ORDER BY {order} LIMIT ?", due_args + args + [limit - len(leads)]).fetchall()
+            leads += [dict(zip(LEAD_COLUMNS, row)) for row in rows]
+            if len(leads) == limit:
+                break
+        return leads
+
+    @staticmethod
+    def _keyset(sort, descending, value, last_id):
+        """
+        The rows after (value, last_id) in ORDER BY sort, id, as (WHERE
+        clause, args) ranges to read in turn. SQLite sorts NULLs first
+        ascending and last descending, and a row value compared with NULL is
+        never true, so the NULLs are a range of their own: ORing them into
+        one clause would scan the table instead of seeking the index.
+        """
+        if sort == 'id':
+            return [("id < ?" if descending else "id > ?", [last_id])]
+        if value is None:
+            if descending:
+                return [(f"{sort} IS NULL AND id < ?", [last_id])]
+            return [(f"{sort} IS NULL AND id > ?", [last_id]), (f"{sort} IS NOT NULL", [])]
+        if descending:
+            return [(f"({sort}, id) < (?, ?)", [value, last_id]), (f"{sort} IS NULL", [])]
+        return [(f"({sort}, id) > (?, ?)", [value, last_id])]
+
+    def close(self):
+        with self._lock, self._read_lock:
+            self._conn.close()
+            self._reader.close()
+
+
+def write_skip_file(keys, directory=None):
+    """
+    Write known lead keys to a temporary JSON file for the scraper:
+    {"companies": [normalized names], "domains": [bare domains]}. Returns its path.
+    """
+    skip = {
+        "companies": sorted(value for kind, value in keys if kind == 'company'),
+        "domains": sorted(value for kind, value in keys if kind == 'domain'),
+    }
+    fd, path = tempfile.mkstemp(prefix='thomasnet-skip-', suffix='.json', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(skip, f)
+    return path
+
+
+class ResultCache:
+    """
+    SQLite cache of finished scrape results, keyed by search parameters.
+    Entries expire `ttl` seconds after they were scraped, and once more than
+    `max_entries` are stored the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrape_cache (
+                key TEXT PRIMARY KEY,
+                prospects TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scrape_cache_last_used ON scrape_cache(last_used)")
+        self._conn.commit()
+
+    def get(self, params):
+        """Return the cached prospects for a search, or None on a miss"""
+        key = cache_key(params)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT prospects, created_at FROM scrape_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM scrape_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE scrape_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, params, prospects):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scrape_cache (key, prospects, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (cache_key(params), json.dumps(prospects), now, now))
+            self._conn.execute("DELETE FROM scrape_cache WHERE created_at < ?", (now - self.ttl,))
+            evicted = self._conn.execute("""
+                DELETE FROM scrape_cache WHERE key IN (
+                    SELECT key FROM scrape_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,)).rowcount
+            self._conn.commit()
+            self.evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM scrape_cache").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobStore:
+    """
+    SQLite record of scrape jobs so they survive a server restart. Unfinished
+    jobs keep the scraper's latest checkpoint together with the prospects
+    found up to it, so they resume from there instead of from page one.
+    Prospects live one row each in job_prospects and are only appended, so a
+    checkpoint writes just the ones found since the last. Writes after
+    close() are dropped, leaving interrupted jobs resumable.
+    """
+
+    def __init__(self, path, max_finished=MAX_FINISHED_JOBS):
+        self.path = str(path)
+        self.max_finished = max_finished
+        self._closed = False
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrape_jobs (
+                id TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                state TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                error TEXT,
+                cached INTEGER NOT NULL DEFAULT 0,
+                checkpoint TEXT
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scrape_jobs_state ON scrape_jobs(state, finished_at)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_prospects (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                prospect TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            ) WITHOUT ROWID
+        """)
+        self._migrate_prospects()
+        self._conn.commit()
+
+    def _migrate_prospects(self):
+        # Stores from before job_prospects kept each job's list as one JSON column
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(scrape_jobs)")]
+        if 'prospects' not in columns:
+            return
+        for job_id, prospects in self._conn.execute(
+                "SELECT id, prospects FROM scrape_jobs WHERE prospects != '[]'").fetchall():
+            self._conn.executemany("INSERT OR REPLACE INTO job_prospects (job_id, seq, prospect) VALUES (?, ?, ?)",
+                                   ((job_id, seq, json.dumps(p)) for seq, p in enumerate(json.loads(prospects))))
+        self._conn.execute("UPDATE scrape_jobs SET prospects = '[]'")
+
+    def _write(self, sql, args):
+        with self._lock:
+            if self._closed:
+                return
+            self._conn.execute(sql, args)
+            self._conn.commit()
+
+    def _append_prospects(self, job, found):
+        """Insert the job's prospects from the last stored one up to `found`"""
+        stored = self._conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM job_prospects WHERE job_id = ?",
+                                    (job.id,)).fetchone()[0]
+        if found > stored:
+            prospects = job.page(stored, found - stored)[0]
+            self._conn.executemany("INSERT INTO job_prospects (job_id, seq, prospect) VALUES (?, ?, ?)",
+                                   ((job.id, seq, json.dumps(p)) for seq, p in enumerate(prospects, stored)))
+
+    def add(self, job):
+        with self._lock:
+            if self._closed:
+                return
+            self._conn.execute("""
+                INSERT OR REPLACE INTO scrape_jobs
+                    (id, params, state, created_at, started_at, finished_at, error, cached, checkpoint)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (job.id, json.dumps(job.params), job.state, job.created_at, job.started_at, job.finished_at,
+                  job.error, int(job.cached), json.dumps(job.checkpoint) if job.checkpoint else None))
+            self._conn.execute("DELETE FROM job_prospects WHERE job_id = ?", (job.id,))
+            self._append_prospects(job, job.found)
+            self._conn.commit()
+
+    def start(self, job):
+        self._write("UPDATE scrape_jobs SET state = ?, started_at = ? WHERE id = ?",
+                    (job.state, job.started_at, job.id))
+
+    def checkpoint(self, job, checkpoint, found):
+        """Store a checkpoint and the prospects found before it that aren't stored yet, in one write"""
+        with self._lock:
+            if self._closed:
+                return
+            self._append_prospects(job, found)
+            self._conn.execute("UPDATE scrape_jobs SET checkpoint = ? WHERE id = ?", (json.dumps(checkpoint), job.id))
+            self._conn.commit()
+
+    def finish(self, job):
+        """Store the job's outcome and its remaining prospects; False if the store is closed"""
+        with self._lock:
+            if self._closed:
+                return False
+            self._append_prospects(job, job.found)
+            self._conn.execute("""
+                UPDATE scrape_jobs SET state = ?, finished_at = ?, error = ?, checkpoint = NULL WHERE id = ?
+            """, (job.state, job.finished_at, job.error, job.id))
+            pruned = [row[0] for row in self._conn.execute("""
+                SELECT id FROM scrape_jobs WHERE finished_at IS NOT NULL
+                ORDER BY finished_at DESC LIMIT -1 OFFSET ?
+            """, (self.max_finished,))]
+            self._conn.executemany("DELETE FROM job_prospects WHERE job_id = ?", ((i,) for i in pruned))
+            self._conn.executemany("DELETE FROM scrape_jobs WHERE id = ?", ((i,) for i in pruned))
+            self._conn.commit()
+            return True
+
+    def prospects(self, job_id, start=0, end=None):
+        """A stored job's prospects [start, end), by sequence number"""
+        with self._lock:
+            if self._closed:
+                return []
+            rows = self._conn.execute("""
+                SELECT prospect FROM job_prospects WHERE job_id = ? AND seq >= ? ORDER BY seq LIMIT ?
+            """, (job_id, start, -1 if end is None else max(0, end - start))).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def load(self):
+        """
+        Rebuild every stored job, oldest first; unfinished ones come back
+        queued with their checkpointed prospects, finished ones read theirs
+        from the store when asked
+        """
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT id, params, state, created_at, started_at, finished_at, error, cached, checkpoint,
+                       (SELECT COALESCE(MAX(seq) + 1, 0) FROM job_prospects WHERE job_id = scrape_jobs.id)
+                FROM scrape_jobs ORDER BY created_at
+            """).fetchall()
+        jobs = []
+        for job_id, params, state, created_at, started_at, finished_at, error, cached, checkpoint, found in rows:
+            job = ScrapeJob(json.loads(params), job_id=job_id)
+            job.created_at = created_at
+            job.cached = bool(cached)
+            if state in ('queued', 'running'):
+                job.prospects = self.prospects(job_id)
+                job.checkpoint = json.loads(checkpoint) if checkpoint else None
+                job.resumed = True
+            else:
+                job.state = state
+                job.started_at = started_at
+                job.finished_at = finished_at
+                job.updated_at = finished_at or created_at
+                job.error = error
+                job.done.set()
+                job.release_prospects(self, found)
+            jobs.append(job)
+        return jobs
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._conn.close()
+
+
+class TraceLog:
+    """
+    Append-only JSON lines file of finished spans, one per line, so a slow
+    scrape can be taken apart afterwards with grep or jq by `trace_id`.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, span):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(json.dumps(span) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def make_span(trace_id, job_id, name, start, duration, source='server', attrs=None):
+    """One span record; `start` is a time.time() and `duration` is in seconds"""
+    return {
+        "trace_id": trace_id,
+        "job_id": job_id,
+        "name": name,
+        "source": source,
+        "start": round(start, 6),
+        "duration": round(max(0.0, duration), 6),
+        "attrs": attrs or {},
+    }
+
+
+def parse_span(span, trace_id, job_id):
+    """
+    Turn a scraper's {"__span__": {...}} payload into a span record, or None
+    if it has no name or duration. `start` defaults to `duration` ago.
+    """
+    if not isinstance(span, dict) or not isinstance(span.get('name'), str):
+        return None
+    try:
+        duration = float(span['duration'])
+        start = float(span.get('start', time.time() - duration))
+    except (KeyError, TypeError, ValueError):
+        return None
+    attrs = {key: value for key, value in span.items() if key not in ('name', 'start', 'duration')}
+    return make_span(trace_id, job_id, span['name'], start, duration, 'scraper', attrs)
+
+
+class ScrapeJob:
+    """A single scrape run: its parameters, lifecycle state and output"""
+
+    def __init__(self, params, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.params = params
+        self.state = 'queued'  # queued -> running -> done | failed | cancelled
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.updated_at = self.created_at  # last change to the state or prospects
+        self._prospects = []
+        self._store = None  # once set, the finished job's prospects are read back from this JobStore
+        self.found = 0
+        self.error = None
+        self.cached = False
+        self.requests = 1  # callers attached to this job, including coalesced ones
+        self.rate_limit_wait = 0.0
+        self.cancelled = False
+        self.checkpoint = None  # the scraper's last {"page": ..., "visited": [...]}
+        self.resumed = False
+        self.trace_id = uuid.uuid4().hex
+        self.known_leads = None  # keys of existing leads, for a new_only job once it starts
+        self.skipped = 0  # prospects dropped because they were already leads
+        self.spans = []  # timed phases of this run, from the server and the scraper
+        self.done = threading.Event()
+        self._changed = threading.Condition()
+        self._cancel_hook = None
+
+    @property
+    def finished(self):
+        return self.done.is_set()
+
+    @property
+    def prospects(self):
+        """Every prospect found so far"""
+        return self.page(0)[0]
+
+    @prospects.setter
+    def prospects(self, prospects):
+        with self._changed:
+            self._prospects = prospects
+            self._store = None
+            self.found = len(prospects)
+
+    def release_prospects(self, store, found=None):
+        """Drop the in-memory prospects of a job whose store now holds them all, and page from there"""
+        with self._changed:
+            self._store = store
+            self._prospects = None
+            if found is not None:
+                self.found = found
+
+    def add_prospect(self, prospect):
+        """Publish a prospect; returns False if a new_only job dropped it as an existing lead"""
+        with self._changed:
+            if self.known_leads and any(key in self.known_leads for key in prospect_keys(prospect)):
+                self.skipped += 1
+                return False
+            self._prospects.append(prospect)
+            self.found += 1
+            self.updated_at = time.time()
+            self._changed.notify_all()
+            return True
+
+    def save_checkpoint(self, checkpoint):
+        """Record a scraper checkpoint; returns how many prospects were found up to it"""
+        with self._changed:
+            self.checkpoint = checkpoint
+            return self.found
+
+    def add_span(self, span):
+        with self._changed:
+            self.spans.append(span)
+
+    def trace(self):
+        """The job's spans plus the total seconds spent in each phase"""
+        with self._changed:
+            spans = list(self.spans)
+        phases = {}
+        for span in spans:
+            phases[span['name']] = round(phases.get(span['name'], 0.0) + span['duration'], 6)
+        return {"id": self.id, "trace_id": self.trace_id, "state": self.state, "phases": phases, "spans": spans}
+
+    def version(self):
+        """
+        Validator for the job's results: prospects are only ever appended, so
+        the ID, state and count pin down the whole list without hashing it
+        """
+        with self._changed:
+            return f'W/"{self.id}-{self.state}-{self.found}"', self.updated_at
+
+    def page(self, offset, limit=None):
+        """
+        Prospects [offset, offset + limit) plus the number found so far and
+        whether that number is final. Prospects are only ever appended, so a
+        page never changes once it is full. A released job reads the page
+        from its store.
+        """
+        with self._changed:
+            store, found, finished = self._store, self.found, self.finished
+            end = found if limit is None else min(found, offset + limit)
+            if store is None:
+                return self._prospects[offset:end], found, finished
+        if offset >= end:  # also keeps cursors past the end out of SQLite's 64-bit integers
+            return [], found, finished
+        return store.prospects(self.id, offset, end), found, finished
+
+    def start(self):
+        """Move a queued job to running; False if it was cancelled while queued"""
+        with self._changed:
+            if self.cancelled or self.finished:
+                return False
+            self.state = 'running'
+            self.started_at = self.updated_at = time.time()
+            return True
+
+    def set_cancel_hook(self, hook):
+        """Register how to stop the job's scraper; runs at once if already cancelled"""
+        with self._changed:
+            self._cancel_hook = hook
+            cancelled = self.cancelled
+        if cancelled and hook is not None:
+            hook()
+
+    def request_cancel(self):
+        """
+        Flag the job as cancelled and stop its scraper. Returns the state the
+        job was in, or None if it had already finished.
+        """
+        with self._changed:
+            if self.finished:
+                return None
+            self.cancelled = True
+            previous = self.state
+            hook = self._cancel_hook
+        if hook is not None:
+            hook()
+        return previous
+
+    def finish(self, error=None):
+        """Mark the job done, failed or cancelled and wake anyone following it"""
+        with self._changed:
+            if self.finished:
+                return
+            self.error = None if self.cancelled else error
+            if self.cancelled:
+                self.state = 'cancelled'
+            else:
+                self.state = 'failed' if error else 'done'
+            self.finished_at = self.updated_at = time.time()
+            self._cancel_hook = None
+            self.known_leads = None  # only needed while the scraper runs
+            self.done.set()
+            self._changed.notify_all()
+
+    def follow(self, heartbeat=None):
+        """
+        Yield every prospect, from the first, as it is found until the job
+        ends. With `heartbeat`, yields None after that many idle seconds so
+        the caller can check on its client.
+        """
+        index = 0
+        while True:
+            with self._changed:
+                if index >= self.found and not self.finished:
+                    self._changed.wait(heartbeat)
+            batch, found, finished = self.page(index)
+            if not batch and not finished:
+                yield None
+                continue
+            index += len(batch)
+            yield from batch
+            if finished and index >= found:
+                return
+
+    def result(self):
+        """The job output in the shape /scrape has always returned"""
+        if self.error:
+            return {"error": self.error}
+        return self.prospects
+
+    def elapsed(self):
+        """Seconds since the job was submitted, frozen once it finishes"""
+        end = self.finished_at or time.time()
+        return round(end - self.created_at, 3)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "params": self.params,
+            "progress": {
+                "found": self.found,
+                "max_results": self.params['max_results'],
+            },
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed": self.elapsed(),
+            "cached": self.cached,
+            "requests": self.requests,
+            "rate_limit_wait": round(self.rate_limit_wait, 3),
+            "skipped": self.skipped,
+            "resumed": self.resumed,
+            "trace_id": self.trace_id,
+            "checkpoint": {
+                "page": self.checkpoint.get('page'),
+                "visited": len(self.checkpoint.get('visited', [])),
+            } if self.checkpoint else None,
+            "error": self.error,
+        }
+
+
+class BatchJob:
+    """A set of scrape jobs, one per state/service combination, merged into one result"""
+
+    def __init__(self, jobs):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.created_at = time.time()
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def request_cancel(self):
+        """Flag the batch as cancelled; False if that already happened"""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            return True
+
+    @property
+    def finished(self):
+        return all(job.finished for job in self.jobs)
+
+    @property
+    def state(self):
+        if not self.finished:
+            return 'running'
+        for state in ('failed', 'cancelled'):
+            if all(job.state == state for job in self.jobs):
+                return state
+        return 'done'
+
+    def results(self):
+        return merge_prospects(job.prospects for job in self.jobs if job.state == 'done')
+
+    def version(self):
+        """Validator for the merged results, built from each job's version"""
+        versions = [job.version() for job in self.jobs]
+        digest = hashlib.blake2b(''.join(etag for etag, _ in versions).encode(), digest_size=16).hexdigest()
+        return f'W/"{digest}"', max(updated for _, updated in versions)
+
+    def to_dict(self):
+        finished_at = max((job.finished_at for job in self.jobs), default=None) if self.finished else None
+        return {
+            "id": self.id,
+            "state": self.state,
+            "combinations": [{
+                "state": job.params['state'],
+                "service": job.params['service'],
+                "job_id": job.id,
+                "job_state": job.state,
+                "found": job.found,
+                "cached": job.cached,
+                "error": job.error,
+            } for job in self.jobs],
+            "completed": sum(1 for job in self.jobs if job.finished),
+            "total": len(self.jobs),
+            "created_at": self.created_at,
+            "elapsed": round((finished_at or time.time()) - self.created_at, 3),
+        }
+
+
+class JobManager:
+    """
+    Runs scrape jobs on a bounded pool of background threads.
+    Each pool thread drives one scraper subprocess, so `workers` is also the
+    maximum number of scrapers running at once; extra jobs wait in the queue.
+    Searches found in the result cache finish immediately without a scrape,
+    and a search identical to one already queued or running attaches to
+    that job instead of starting a second scraper. With a `worker_pool`,
+    jobs run on warm worker processes instead of a fresh python3 each.
+    With a `store`, jobs and scraper checkpoints are written to SQLite and
+    resume() picks up whatever a previous server left unfinished. Every job
+    records timed spans for its phases, which also go to `trace_log`.
+    With `leads`, a LeadStore, new_only searches skip companies already in
+    the CRM; they never use the cache, since their results depend on it.
+    """
+
+    def __init__(self, scraper_path, workers=DEFAULT_WORKERS, cache=None, worker_pool=None, metrics=None,
+                 rate_limiter=None, store=None, trace_log=None, leads=None):
+        self.scraper_path = scraper_path
+        self.workers = workers
+        self.cache = cache
+        self.store = store
+        self.trace_log = trace_log
+        self.leads = leads
+        self.worker_pool = worker_pool
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.rate_limiter = rate_limiter
+        self.rate_limit_url = None  # set by the server once it knows its port
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scrape-worker')
+        self._jobs = {}
+        self._inflight = {}  # cache_key(params) -> unfinished job
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def submit(self, params, refresh=False):
+        """
+        Queue a scrape and return its job straight away. `refresh` skips the
+        cache but still attaches to an identical in-flight scrape, whose
+        results are fresh anyway.
+        """
+        key = cache_key(params)
+        with self._lock:
+            running = self._inflight.get(key)
+            if running is not None:
+                running.requests += 1
+                self.coalesced += 1
+                return running
+
+            job = ScrapeJob(params)
+            self._prune()
+            self._jobs[job.id] = job
+            cached = None
+            lookup = None
+            if self.cache is not None and not refresh and not params.get('new_only'):
+                lookup_start = time.time()
+                cached = self.cache.get(params)
+                lookup = (lookup_start, time.time())
+            if cached is None:
+                self._inflight[key] = job
+
+        if lookup is not None:
+            self.record_span(job, 'cache_lookup', *lookup, hit=cached is not None)
+        if cached is None:
+            self._record('add', job)
+            self._executor.submit(self._run, job)
+        else:
+            job.cached = True
+            job.started_at = job.created_at
+            job.prospects = cached
+            job.finish()
+            self._record('add', job)
+            self.record_span(job, 'job', job.created_at, job.finished_at, state=job.state, cached=True)
+        return job
+
+    def resume(self):
+        """
+        Reload the job store: finished jobs become visible again and jobs a
+        previous server left queued or running are queued again, continuing
+        from their last checkpoint. Returns the number of resumed jobs.
+        """
+        if self.store is None:
+            return 0
+        resumed = []
+        with self._lock:
+            for job in self.store.load():
+                self._jobs[job.id] = job
+                if not job.finished:
+                    self._inflight.setdefault(cache_key(job.params), job)
+                    resumed.append(job)
+            self._prune()
+        for job in resumed:
+            page = job.checkpoint.get('page') if job.checkpoint else None
+            print(f"Resuming job {job.id} from page {page or 1} ({job.found} prospects so far)")
+            self._executor.submit(self._run, job)
+        return len(resumed)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job):
+        """
+        Stop a job and kill its scraper process tree. Prospects found so far
+        are kept. A queued job finishes straight away; a running one finishes
+        as soon as its scraper has exited.
+        """
+        previous = job.request_cancel()
+        if previous is None:
+            return job
+        print(f"Cancelling job {job.id} ({previous})")
+        with self._lock:
+            if self._inflight.get(cache_key(job.params)) is job:
+                del self._inflight[cache_key(job.params)]
+        if previous == 'queued':
+            self._finish(job)
+        return job
+
+    def detach(self, job):
+        """A caller waiting on the job went away; cancel the job if nobody else is attached"""
+        with self._lock:
+            job.requests -= 1
+            abandoned = job.requests <= 0
+        if abandoned:
+            self.cancel(job)
+
+    def submit_batch(self, params_list, refresh=False):
+        """Queue one job per parameter set; they share the pool, cache and coalescing"""
+        batch = BatchJob([self.submit(params, refresh=refresh) for params in params_list])
+        with self._lock:
+            finished = [b for b in self._batches.values() if b.finished]
+            for old in sorted(finished, key=lambda b: b.created_at)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self._batches[old.id]
+            self._batches[batch.id] = batch
+        return batch
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def counts(self):
+        """Number of known jobs in each state"""
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0, 'cancelled': 0}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job.state] = counts.get(job.state, 0) + 1
+        return counts
+
+    def shutdown(self):
+        # Close the store first so the jobs interrupted below stay resumable
+        if self.store is not None:
+            self.store.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            running = [job for job in self._jobs.values() if job.state == 'running']
+        for job in running:
+            job.request_cancel()  # don't leave scrapers and their browsers behind
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+
+    def _record(self, action, job, *args):
+        """
+        Write a job change to the store; a failing store never fails the job.
+        Returns what the store did, or None without a store or on an error.
+        """
+        if self.store is None:
+            return None
+        try:
+            return getattr(self.store, action)(job, *args)
+        except sqlite3.Error as e:
+            print(f"Error saving job {job.id}: {e}")
+            return None
+
+    def _prune(self):
+        # Forget the oldest finished jobs so the registry doesn't grow forever
+        finished = [job for job in self._jobs.values() if job.finished]
+        for job in sorted(finished, key=lambda j: j.finished_at)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+    def record_span(self, job, name, start, end=None, **attrs):
+        """Record a server-side span of a job from `start` to `end` (default now), both time.time()"""
+        end = time.time() if end is None else end
+        self._add_span(job, make_span(job.trace_id, job.id, name, start, end - start, attrs=attrs))
+
+    def _add_span(self, job, span):
+        job.add_span(span)
+        if self.trace_log is not None:
+            try:
+                self.trace_log.write(span)
+            except (OSError, ValueError) as e:
+                print(f"Error writing span for job {job.id}: {e}")
+
+    def _phase(self, job, phase, start, perf_start):
+        """End a scraper phase: observe its metric and record it as a span"""
+        duration = time.perf_counter() - perf_start
+        self.metrics.observe('thomasnet_scrape_phase_seconds', duration, phase=phase)
+        self.record_span(job, phase, start, start + duration)
+
+    def wait_for_host(self, job, host):
+        """Take a rate limit token for `host` on behalf of a job, recording the wait"""
+        if self.rate_limiter is None:
+            return 0.0
+        start = time.time()
+        waited = self.rate_limiter.acquire(host)
+        if job is not None:
+            job.rate_limit_wait += waited
+            self.record_span(job, 'rate_limit', start, host=host.lower())
+        self.metrics.observe('thomasnet_rate_limit_wait_seconds', waited, host=self.rate_limiter.label(host))
+        return waited
+
+    def scraper_env(self, job, skip_file=None):
+        """
+        Environment telling the scraper where to ask for rate limit tokens,
+        for a resumed job the checkpoint to continue from, and for a new_only
+        job the file listing companies it shouldn't visit
+        """
+        env = {'THOMASNET_JOB_ID': job.id, TRACE_ENV: job.trace_id}
+        if self.rate_limit_url:
+            env['THOMASNET_RATE_LIMIT_URL'] = self.rate_limit_url
+        if job.checkpoint:
+            env[RESUME_ENV] = json.dumps(job.checkpoint)
+        if skip_file:
+            env[SKIP_FILE_ENV] = skip_file
+        return env
+
+    def load_known_leads(self, job):
+        """Read the existing leads for a new_only job; returns an error message or None"""
+        if self.leads is None:
+            return "new_only needs a leads database (--leads-db)"
+        start = time.time()
+        try:
+            job.known_leads = self.leads.known_keys()
+        except sqlite3.Error as e:
+            return f"Could not read leads database: {e}"
+        self.record_span(job, 'load_leads', start, keys=len(job.known_leads))
+        return None
+
+    def _run(self, job):
+        if not job.start():
+            return
+        self._record('start', job)
+        self.record_span(job, 'queue', job.created_at, job.started_at)
+        error = None
+        try:
+            if job.params.get('new_only'):
+                error = self.load_known_leads(job)
+            if error is None:
+                # The search results page is the first request every scrape makes
+                self.wait_for_host(job, THOMASNET_HOST)
+            if error is None and not job.cancelled:
+                error = self.run_scraper(job)
+        except Exception as e:
+            error = f"Scraper failed: {str(e)}"
+        if error is None and not job.cancelled and self.cache is not None and not job.params.get('new_only'):
+            cache_start = time.time()
+            try:
+                self.cache.put(job.params, job.prospects)
+            except sqlite3.Error as e:
+                print(f"Error caching results for job {job.id}: {e}")
+            self.record_span(job, 'cache_write', cache_start)
+        self._finish(job, error)
+
+    def _finish(self, job, error=None):
+        with self._lock:
+            if self._inflight.get(cache_key(job.params)) is job:
+                del self._inflight[cache_key(job.params)]
+        job.finish(error)
+        if self._record('finish', job):
+            job.release_prospects(self.store)  # results pages come from the store from now on
+        self.metrics.inc('thomasnet_jobs_finished_total', state=job.state)
+        self.record_span(job, 'job', job.created_at, job.finished_at, state=job.state, resumed=job.resumed)
+
+    def run_scraper(self, job):
+        """
+        Run the actual Thomasnet scraper, publishing prospects to the job as
+        the scraper prints them. Returns an error message, or None on success.
+
+        The scraper may print one JSON object per line, which is streamed as
+        each line arrives, or a single JSON list at the end, which is parsed
+        once the process exits.
+        """
+        params = job.params
+
+        # Get the path to the command-line scraper
+        scraper_path = self.scraper_path
+
+        if not scraper_path.exists():
+            return "Thomasnet scraper not found"
+
+        args = [
+            params['state'],
+            params['service'],
+            params['sort_order'],
+            str(params['max_results'])
+        ]
+
+        skip_file = write_skip_file(job.known_leads) if job.known_leads else None
+        try:
+            if self.worker_pool is not None:
+                return self._run_in_worker(job, args, skip_file)
+            return self._run_in_subprocess(job, scraper_path, args, skip_file)
+        finally:
+            if skip_file:
+                os.unlink(skip_file)
+
+    def _run_in_subprocess(self, job, scraper_path, args, skip_file=None):
+        """Spawn a fresh scraper process for the job"""
+        cmd = ["python3", str(scraper_path)] + args
+
+        print(f"Running scraper command: {' '.join(cmd)}")
+        print(f"Working directory: {scraper_path.parent}")
+
+        spawn_start, spawn_perf = time.time(), time.perf_counter()
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            cwd=str(scraper_path.parent),
+            env=dict(os.environ, **self.scraper_env(job, skip_file)),
+            start_new_session=True  # own process group, so cancelling can kill its browser too
+        )
+        self._phase(job, 'spawn', spawn_start, spawn_perf)
+        run_start, run_perf = time.time(), time.perf_counter()
+        job.set_cancel_hook(lambda: kill_process_tree(process))
+
+        # Drain stderr on the side so a chatty scraper can't fill the pipe
+        stderr_lines = []
+        stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr), daemon=True)
+        stderr_reader.start()
+
+        timed_out = threading.Event()
+
+        def kill_on_timeout():
+            timed_out.set()
+            kill_process_tree(process)
+
+        timer = threading.Timer(SCRAPER_TIMEOUT, kill_on_timeout)
+        timer.start()
+
+        try:
+            streamed, buffered = self._read_output(job, process.stdout)
+            process.wait()
+        finally:
+            timer.cancel()
+            stderr_reader.join()
+            self._phase(job, 'run', run_start, run_perf)
+
+        stderr = ''.join(stderr_lines)
+        print(f"Scraper return code: {process.returncode}")
+        print(f"Scraper stderr: {stderr}")
+
+        if job.cancelled:
+            return None
+
+        if timed_out.is_set():
+            return "Scraper timed out after 5 minutes"
+
+        if process.returncode != 0:
+            return f"Scraper failed: {stderr}"
+
+        if streamed:
+            return None
+        return self._parse_buffered(job, buffered)
+
+    def _run_in_worker(self, job, args, skip_file=None):
+        """Run the job on a warm worker from the pool"""
+        spawn_start, spawn_perf = time.time(), time.perf_counter()
+        worker = self.worker_pool.acquire()
+        self._phase(job, 'spawn', spawn_start, spawn_perf)
+        run_start, run_perf = time.time(), time.perf_counter()
+        print(f"Running scraper in warm worker {worker.pid}: {' '.join(args)}")
+        timed_out = threading.Event()
+        # Once the worker is back in the pool it may be running another job, so a late cancel mustn't kill it
+        held = threading.Lock()
+        running = True
+
+        def kill():
+            with held:
+                if running:
+                    worker.kill()
+
+        def kill_on_timeout():
+            timed_out.set()
+            kill()
+
+        job.set_cancel_hook(kill)
+        timer = threading.Timer(SCRAPER_TIMEOUT, kill_on_timeout)
+        timer.start()
+
+        try:
+            streamed, buffered = self._read_output(job, worker.run(args, self.scraper_env(job, skip_file)))
+        finally:
+            timer.cancel()
+            job.set_cancel_hook(None)
+            with held:
+                running = False
+            status = worker.last_status
+            self._phase(job, 'run', run_start, run_perf)
+            self.worker_pool.release(worker)
+
+        if job.cancelled:
+            return None
+
+        if timed_out.is_set():
+            return "Scraper timed out after 5 minutes"
+
+        if status is None:
+            return "Scraper worker exited unexpectedly"
+
+        print(f"Scraper return code: {status['returncode']}")
+        print(f"Scraper stderr: {status['stderr']}")
+
+        if status['returncode'] != 0:
+            return f"Scraper failed: {status['stderr']}"
+
+        if streamed:
+            return None
+        return self._parse_buffered(job, buffered)
+
+    def _read_output(self, job, lines):
+        """
+        Publish prospects printed one per line as they arrive, store
+        checkpoints and record the scraper's own spans. Returns (streamed,
+        buffered): until the first prospect line every line is kept in
+        `buffered` in case the scraper prints a single JSON list instead.
+        """
+        buffered = []
+        streamed = False
+        for line in lines:
+            prospect = parse_prospect_line(line)
+            if prospect is not None and CHECKPOINT_TAG in prospect:
+                checkpoint = prospect[CHECKPOINT_TAG]
+                self._record('checkpoint', job, checkpoint, job.save_checkpoint(checkpoint))
+            elif prospect is not None and SPAN_TAG in prospect:
+                span = parse_span(prospect[SPAN_TAG], job.trace_id, job.id)
+                if span is not None:
+                    self._add_span(job, span)
+            elif prospect is not None:
+                job.add_prospect(prospect)
+                streamed = True
+            elif not streamed:
+                buffered.append(line)
+        return streamed, buffered
+
+    def _parse_buffered(self, job, buffered):
+        """Parse a scraper's single-JSON-list output into the job"""
+        parse_start, parse_perf = time.time(), time.perf_counter()
+        try:
+            return self._parse_output(job, ''.join(buffered))
+        finally:
+            self._phase(job, 'parse', parse_start, parse_perf)
+
+    def _parse_output(self, job, output):
+        if not output.strip():
+            return "Scraper returned empty output"
+        try:
+            prospects = json.loads(output)
+        except json.JSONDecodeError as e:
+            return f"Failed to parse scraper output: {e}. Output: {output[:200]}"
+        if not isinstance(prospects, list):
+            return "Invalid scraper output format"
+        for prospect in prospects:
+            job.add_prospect(prospect)
+        return None
+
+
+class WarmWorker:
+    """One scraper-worker.py process that runs jobs sent over its stdin"""
+
+    def __init__(self, scraper_path):
+        self.process = subprocess.Popen(
+            ["python3", "-u", str(WORKER_SCRIPT), str(scraper_path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            cwd=str(scraper_path.parent),
+            start_new_session=True
+        )
+        self.jobs_run = 0
+        self.rss_mb = 0.0
+        self.last_status = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, args, env=None):
+        """
+        Send one job and yield the scraper's output lines. The worker's
+        closing status line is kept in `last_status` (None if it died).
+        """
+        self.last_status = None
+        self.process.stdin.write(json.dumps({"argv": args, "env": env or {}}) + "\n")
+        self.process.stdin.flush()
+        for line in self.process.stdout:
+            if line.startswith(WORKER_STATUS_PREFIX):
+                self.last_status = json.loads(line)
+                self.jobs_run += 1
+                self.rss_mb = self.last_status.get('rss_mb', 0.0)
+                return
+            yield line
+
+    def kill(self):
+        """Kill the worker and anything it started; the pool replaces it on release"""
+        kill_process_tree(self.process)
+
+    def stop(self):
+        """Ask the worker to exit by closing its stdin, killing it if it hangs"""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class WorkerPool:
+    """
+    Warm scraper worker processes shared by the job threads. `size` workers
+    are started up front; a worker is replaced with a fresh one after
+    `max_jobs` jobs, once its memory grows past `max_rss_mb`, or if it dies.
+    """
+
+    def __init__(self, scraper_path, size, max_jobs=DEFAULT_WORKER_MAX_JOBS, max_rss_mb=DEFAULT_WORKER_MAX_RSS_MB):
+        self.scraper_path = scraper_path
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.started = 0
+        self.recycled = 0
+        self._idle = []
+        self._closed = False
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.append(self._start())
+
+    def _start(self):
+        self.started += 1
+        return WarmWorker(self.scraper_path)
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive:
+                    return worker
+            return self._start()
+
+    def release(self, worker):
+        """Return a worker after a job, swapping in a fresh one if it is worn out"""
+        worn_out = worker.jobs_run >= self.max_jobs or worker.rss_mb > self.max_rss_mb
+        # No status line means the job never completed (killed, crashed or cancelled)
+        healthy = worker.last_status is not None and worker.alive
+        with self._lock:
+            if self._closed:
+                pass
+            elif healthy and not worn_out:
+                self._idle.append(worker)
+                return
+            else:
+                self.recycled += 1
+                self._idle.append(self._start())
+        worker.stop()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+
+class ThomasnetServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server for the scraper API.
+    Every connection gets its own thread so cheap routes like /health never
+    queue behind a scrape; the scrapes themselves run on the job manager's
+    pool of `workers` threads. Results are cached in `cache_path` when given,
+    `warm_workers` keeps that many scraper processes running between jobs,
+    `jobs_path` keeps jobs in SQLite so unfinished ones resume after a restart,
+    job spans are appended to `trace_path` as JSON lines, and new_only
+    searches skip the companies already in `leads_path`, which is also
+    served by the /leads API and upgraded in place if `migrate_leads`. A
+    leads.db that needs upgrading leaves the leads API off, not the server.
+    """
+
+    daemon_threads = True
+    # The default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS, scraper_path=None,
+                 cache_path=None, cache_ttl=DEFAULT_CACHE_TTL, cache_entries=DEFAULT_CACHE_ENTRIES,
+                 warm_workers=False, worker_max_jobs=DEFAULT_WORKER_MAX_JOBS,
+                 worker_max_rss_mb=DEFAULT_WORKER_MAX_RSS_MB, rate_limit=DEFAULT_RATE_LIMIT,
+                 rate_burst=DEFAULT_RATE_BURST, host_rates=None, jobs_path=None, trace_path=None,
+                 leads_path=None, migrate_leads=False):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.scraper_path = Path(scraper_path) if scraper_path else DEFAULT_SCRAPER_PATH
+        self.cache = ResultCache(cache_path, cache_ttl, cache_entries) if cache_path else None
+        self.worker_pool = None
+        if warm_workers:
+            self.worker_pool = WorkerPool(self.scraper_path, workers, worker_max_jobs, worker_max_rss_mb)
+        self.metrics = Metrics()
+        self.rate_limiter = HostRateLimiter(rate_limit, rate_burst, host_rates)
+        self.job_store = JobStore(jobs_path) if jobs_path else None
+        self.leads = None
+        self.leads_disabled = "no --leads-db"
+        if leads_path:
+            try:
+                self.leads = LeadStore(leads_path, migrate=migrate_leads)
+            except RuntimeError as e:
+                self.leads_disabled = str(e)
+                print(f"Warning: {e}; the leads API is off until then")
+        self.trace_log = TraceLog(trace_path) if trace_path else None
+        self.jobs = JobManager(self.scraper_path, workers, cache=self.cache, worker_pool=self.worker_pool,
+                               metrics=self.metrics, rate_limiter=self.rate_limiter, store=self.job_store,
+                               trace_log=self.trace_log, leads=self.leads)
+        self.jobs.rate_limit_url = f"http://127.0.0.1:{self.server_address[1]}/ratelimit/acquire"
+        self.resumed_jobs = self.jobs.resume()
+
+    def render_metrics(self):
+        """The /metrics page: recorded metrics plus values read from the job manager, cache and pool"""
+        counts = self.jobs.counts()
+        gauges = {
+            'thomasnet_jobs_active': counts['running'],
+            'thomasnet_jobs_queued': counts['queued'],
+            'thomasnet_jobs_coalesced_total': self.jobs.coalesced,
+        }
+        if self.cache is not None:
+            stats = self.cache.stats()
+            gauges['thomasnet_cache_hits_total'] = stats['hits']
+            gauges['thomasnet_cache_misses_total'] = stats['misses']
+            gauges['thomasnet_cache_evictions_total'] = stats['evictions']
+        if self.worker_pool is not None:
+            gauges['thomasnet_warm_workers_started_total'] = self.worker_pool.started
+            gauges['thomasnet_warm_workers_recycled_total'] = self.worker_pool.recycled
+        return self.metrics.render(gauges)
+
+    def server_close(self):
+        super().server_close()
+        self.jobs.shutdown()
+        if self.cache is not None:
+            self.cache.close()
+        if self.trace_log is not None:
+            self.trace_log.close()
+        if self.leads is not None:
+            self.leads.close()
+
+
+def route_label(path):
+    """Collapse a request path to its route so job IDs don't explode metric labels"""
+    parts = urlparse(path).path.strip('/').split('/')
+    if parts[0] in ID_ROUTE_PREFIXES and len(parts) >= 2 and '/'.join(parts) not in FIXED_SUBROUTES:
+        parts[1] = '{id}'
+    route = '/' + '/'.join(parts)
+    return route if route in KNOWN_ROUTES else 'other'
+
 
 class ThomasnetHandler(BaseHTTPRequestHandler):
+    """
+    Speaks HTTP/1.1 so clients can keep a connection open across requests.
+    Whole responses carry a Content-Length; streamed ones use chunked
+    transfer encoding. Bodies are gzipped when the client accepts it.
+    Successful GETs carry an ETag and are answered with 304 Not Modified
+    when the client already has that version.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out as separate writes; with Nagle on, a reused
+    # connection stalls on the client's delayed ACK (~40ms per request)
+    disable_nagle_algorithm = True
+
+    def handle_one_request(self):
+        # Time each request and record it once the handler is done with it
+        self._started = time.perf_counter()
+        self._status = None
+        self._bytes_sent = 0
+        self._chunked = False
+        self._compressor = None
+        self._body_unread = False
+        super().handle_one_request()
+        if self._status is not None:
+            route = route_label(self.path)
+            metrics = self.server.metrics
+            metrics.inc('thomasnet_http_requests_total', route=route, method=self.command, status=self._status)
+            metrics.observe('thomasnet_http_request_duration_seconds', time.perf_counter() - self._started, route=route)
+            metrics.inc('thomasnet_http_response_bytes_total', self._bytes_sent, route=route)
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # Until a handler reads it, the body would be parsed as the next request on this connection
+        self._body_unread = (self.headers.get('Content-Length', '0').strip() != '0'
+                             or 'Transfer-Encoding' in self.headers)
+        return True
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+        if self._body_unread:
+            # Answered without reading the request body (an error, or a route that takes none)
+            self.send_header('Connection', 'close')
+
+    def write_body(self, body):
+        self.wfile.write(body)
+        self._bytes_sent += len(body)
+
+    def wants_gzip(self):
+        return accepts_gzip(self.headers.get('Accept-Encoding'))
+
+    def validator_headers(self, etag, last_modified=None):
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache',
+                   'Access-Control-Expose-Headers': 'ETag, Last-Modified'}
+        if last_modified is not None:
+            headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+        return headers
+
+    def not_modified(self, etag, last_modified=None):
+        """
+        Answer a GET with 304 if the client's If-None-Match (or, without one,
+        If-Modified-Since) shows it already has this version. True if it did.
+        """
+        if self.command != 'GET':
+            return False
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_none_match is not None:
+            fresh = etag_matches(if_none_match, etag)
+        elif if_modified_since is not None and last_modified is not None:
+            try:
+                fresh = int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                fresh = False
+        else:
+            fresh = False
+        if not fresh:
+            return False
+        self.send_response(304)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in self.validator_headers(etag, last_modified).items():
+            self.send_header(name, value)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        return True
+
+    def send_body(self, status, content_type, body, headers=None, etag=None, last_modified=None):
+        """
+        Send a complete response with its Content-Length, gzipped if the
+        client accepts it and it's big enough. A successful GET gets an ETag,
+        hashed from the body unless one is given, and may become a 304.
+        """
+        if status == 200 and self.command == 'GET':
+            etag = etag or content_etag(body)
+            if self.not_modified(etag, last_modified):
+                return
+            headers = dict(headers or {}, **self.validator_headers(etag, last_modified))
+        gzipped = len(body) >= GZIP_MIN_BYTES and self.wants_gzip()
+        if gzipped:
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write_body(body)
+
+    def start_chunked(self, status, content_type, headers=None, compress=False):
+        """
+        Start a response whose length isn't known up front. HTTP/1.1 clients
+        get chunked transfer encoding; HTTP/1.0 ones get the body followed by
+        a closed connection. With `compress`, chunks are gzipped on the fly.
+        """
+        self._chunked = self.request_version != 'HTTP/1.0'
+        self._compressor = None
+        if compress and self.wants_gzip():
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self._compressor is not None:
+            self.send_header('Content-Encoding', 'gzip')
+        if compress:
+            self.send_header('Vary', 'Accept-Encoding')
+        if self._chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        elif not self._body_unread:  # otherwise send_response already said so
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def write_chunk(self, data, flush=False):
+        """Write part of a response started with start_chunked; `flush` pushes it to the client now"""
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+            if flush:
+                data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            self._write_framed(data)
+        if flush:
+            self.wfile.flush()
+
+    def end_chunked(self):
+        if self._compressor is not None:
+            tail = self._compressor.flush()
+            self._compressor = None
+            if tail:
+                self._write_framed(tail)
+        if self._chunked:
+            self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _write_framed(self, data):
+        if self._chunked:
+            self.wfile.write(f'{len(data):x}\r\n'.encode())
+        self.write_body(data)
+        if self._chunked:
+            self.wfile.write(b'\r\n')
+
     def do_OPTIONS(self):
         # Handle CORS preflight requests
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def do_POST(self):
-        if self.path == '/scrape':
+        path = urlparse(self.path).path
+        if path == '/scrape':
             self.handle_scrape()
+        elif path == '/scrape/stream':
+            self.handle_scrape_stream()
+        elif path == '/scrape/batch':
+            self.handle_scrape_batch()
+        elif path == '/jobs':
+            self.handle_create_job()
+        elif path == '/ratelimit/acquire':
+            self.handle_rate_limit_acquire()
+        elif path == '/changes':
+            self.handle_push_changes()
+        elif path == '/leads/import':
+            self.handle_import_leads()
+        elif path == '/queue/next':
+            self.handle_queue_next()
+        elif path == '/queue/called':
+            self.handle_queue_called()
+        elif path == '/queue/release':
+            self.handle_queue_release()
+        elif path == '/queues':
+            self.handle_create_custom_queue()
+        elif re.fullmatch(r'/queues/\d+/members', path) and is_path_id(path.split('/')[2]):
+            self.handle_change_custom_queue(int(path.split('/')[2]))
+        else:
+            self.send_error(404, "Not Found")
+
+    def do_DELETE(self):
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            self.handle_cancel_job(parts[1])
+        elif len(parts) == 2 and parts[0] == 'batches':
+            self.handle_cancel_batch(parts[1])
+        elif len(parts) == 2 and parts[0] == 'queues' and is_path_id(parts[1]):
+            self.handle_delete_custom_queue(int(parts[1]))
         else:
             self.send_error(404, "Not Found")
 
     def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok"}).encode())
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts == ['health']:
+            self.send_json(200, {"status": "ok"})
+        elif parts == ['metrics']:
+            self.handle_metrics()
+        elif parts == ['cache']:
+            self.handle_cache_stats()
+        elif parts == ['ratelimit']:
+            self.send_json(200, self.server.rate_limiter.limits())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            self.handle_job_status(parts[1])
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'results':
+            self.handle_job_results(parts[1])
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'stream':
+            self.handle_job_stream(parts[1])
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'trace':
+            self.handle_job_trace(parts[1])
+        elif len(parts) == 2 and parts[0] == 'batches':
+            self.handle_batch_status(parts[1])
+        elif len(parts) == 3 and parts[0] == 'batches' and parts[2] == 'results':
+            self.handle_batch_results(parts[1])
+        elif parts == ['leads']:
+            self.handle_list_leads()
+        elif parts == ['stats']:
+            self.handle_lead_stats()
+        elif parts == ['changes']:
+            self.handle_pull_changes()
+        elif parts == ['queue']:
+            self.handle_queue()
+        elif parts == ['queues']:
+            self.handle_custom_queues()
+        elif len(parts) == 2 and parts[0] == 'queues' and is_path_id(parts[1]):
+            self.handle_custom_queue_page(int(parts[1]))
+        elif parts == ['leads', 'search']:
+            self.handle_search_leads()
+        elif parts == ['leads', 'export']:
+            self.handle_export_leads()
+        elif len(parts) == 2 and parts[0] == 'leads':
+            self.handle_get_lead(parts[1])
         else:
             self.send_error(404, "Not Found")
 
+    def send_json(self, status, payload, etag=None, last_modified=None):
+        """Write a JSON response with the CORS header"""
+        self.send_body(status, 'application/json', json.dumps(payload).encode(), etag=etag,
+                       last_modified=last_modified)
+
+    def send_json_list(self, status, payload, key, items, headers=None):
+        """
+        Like send_json, with `items` added to the payload as `key`. The list is
+        serialized and written a chunk at a time rather than as one string.
+        """
+        self.start_chunked(status, 'application/json', headers, compress=True)
+        head = json.dumps(payload)[:-1]
+        self.write_chunk(f'{head}, {json.dumps(key)}: ['.encode())
+        for start in range(0, len(items), JSON_WRITE_CHUNK):
+            chunk = ', '.join(json.dumps(item) for item in items[start:start + JSON_WRITE_CHUNK])
+            self.write_chunk((', ' if start else '').encode() + chunk.encode())
+        self.write_chunk(b']}')
+        self.end_chunked()
+
+    def client_disconnected(self):
+        """True once the client has closed its end of the connection"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if not readable:
+                return False
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+
+    def read_scrape_request(self):
+        """Read a scrape request body; returns (params, refresh)"""
+        data = self.read_json_body()
+        return parse_scrape_params(data), bool(data.get('refresh', False))
+
+    def read_json_body(self):
+        """The request's JSON body; ValueError, for a 400, if it has no valid Content-Length"""
+        length = self.headers['Content-Length']
+        if length is None or not length.strip().isdigit():
+            raise ValueError("the JSON body needs a Content-Length")
+        post_data = self.rfile.read(int(length))
+        self._body_unread = False
+        return json.loads(post_data.decode('utf-8'))
+
     def handle_scrape(self):
         try:
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract parameters
-            state = data.get('state', 'California')
-            service = data.get('service', 'CNC Machining')
-            sort_order = data.get('sort_order', 'Ascending')
-            max_results = data.get('max_results', 100)
-            delay = data.get('delay', 2)
-            
-            print(f"Scraping request: {state}, {service}, {sort_order}, {max_results}")
-            
-            # Run the scraper
-            prospects = self.run_scraper(state, service, sort_order, max_results, delay)
-            
-            # Send response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(prospects).encode())
-            
+            params, refresh = self.read_scrape_request()
+        except Exception as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        try:
+            print(f"Scraping request: {params['state']}, {params['service']}, "
+                  f"{params['sort_order']}, {params['max_results']}")
+
+            # Run the scraper on the worker pool (or answer from the cache) and wait for it,
+            # giving the job up if the client hangs up first
+            job = self.server.jobs.submit(params, refresh=refresh)
+            while not job.done.wait(DISCONNECT_POLL_SECONDS):
+                if self.client_disconnected():
+                    print(f"Scrape client for job {job.id} disconnected")
+                    self.server.jobs.detach(job)
+                    return
+
+            self.send_json(200, job.result())
+
         except Exception as e:
             print(f"Error handling scrape request: {e}")
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            error_response = {"error": str(e)}
-            self.wfile.write(json.dumps(error_response).encode())
-
-    def run_scraper(self, state, service, sort_order, max_results, delay):
-        """Run the actual Thomasnet scraper"""
-        try:
-            # Get the path to the command-line scraper
-            scraper_path = Path(__file__).parent / "thomasnet-scraper" / "run_scraper.py"
-            
-            if not scraper_path.exists():
-                return {"error": "Thomasnet scraper not found"}
-            
-            # Run the actual scraper
-            import subprocess
-            import json
-            
-            cmd = [
-                "python3",
-                str(scraper_path),
-                state,
-                service,
-                sort_order,
-                str(max_results)
-            ]
-            
-            print(f"Running scraper command: {' '.join(cmd)}")
-            print(f"Working directory: {scraper_path.parent}")
-            
-            result = subprocess.run(
-                cmd, 
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True, 
-                cwd=str(scraper_path.parent),
-                timeout=300  # 5 minute timeout
-            )
-            
-            print(f"Scraper return code: {result.returncode}")
-            print(f"Scraper stdout: {result.stdout[:500]}...")
-            print(f"Scraper stderr: {result.stderr}")
-            
-            if result.returncode != 0:
-                return {"error": f"Scraper failed: {result.stderr}"}
-            
-            # Parse the JSON output
-            try:
-                if not result.stdout.strip():
-                    return {"error": "Scraper returned empty output"}
-                    
-                prospects = json.loads(result.stdout)
-                if isinstance(prospects, list):
-                    return prospects
+            self.send_json(500, {"error": str(e)})
+
+    def handle_scrape_stream(self):
+        try:
+            params, refresh = self.read_scrape_request()
+        except Exception as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        print(f"Streaming scrape request: {params['state']}, {params['service']}, "
+              f"{params['sort_order']}, {params['max_results']}")
+        self.stream_job(self.server.jobs.submit(params, refresh=refresh), attached=True)
+
+    def handle_job_stream(self, job_id):
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "Job not found"})
+            return
+        self.stream_job(job)
+
+    def stream_job(self, job, attached=False):
+        """
+        Send a job's prospects as they are found: Server-Sent Events when the
+        client accepts text/event-stream, NDJSON otherwise. A final `done`
+        event carries the job state, count and any error. If an `attached`
+        client (one that started or joined the job) disconnects, it is
+        detached from the job, which is cancelled when nobody else is left.
+        """
+        sse = 'text/event-stream' in self.headers.get('Accept', '')
+        self.start_chunked(200, 'text/event-stream' if sse else 'application/x-ndjson',
+                           {'Cache-Control': 'no-cache', 'X-Job-Id': job.id})
+
+        try:
+            for prospect in job.follow(heartbeat=SSE_HEARTBEAT_SECONDS if sse else DISCONNECT_POLL_SECONDS):
+                if prospect is not None:
+                    self.write_event('prospect', prospect, sse)
+                elif self.client_disconnected():
+                    raise ConnectionResetError("client closed the stream")
+                elif sse:
+                    self.write_chunk(b": keepalive\n\n", flush=True)
+            self.write_event('done', {
+                "id": job.id,
+                "state": job.state,
+                "count": job.found,
+                "error": job.error,
+            }, sse)
+            self.end_chunked()
+        except OSError:  # gone, or stalled past the socket timeout
+            print(f"Stream client for job {job.id} disconnected")
+            self.close_connection = True
+            if attached:
+                self.server.jobs.detach(job)
+
+    def write_event(self, event, data, sse):
+        if sse:
+            message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        elif event == 'prospect':
+            message = json.dumps({"event": event, "prospect": data}) + "\n"
+        else:
+            message = json.dumps(dict(data, event=event)) + "\n"
+        self.write_chunk(message.encode(), flush=True)
+
+    def handle_create_job(self):
+        try:
+            params, refresh = self.read_scrape_request()
+        except Exception as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        job = self.server.jobs.submit(params, refresh=refresh)
+        print(f"Queued scrape job {job.id}: {params['state']}, {params['service']}")
+        self.send_json(202, {
+            "id": job.id,
+            "state": job.state,
+            "status_url": f"/jobs/{job.id}",
+            "results_url": f"/jobs/{job.id}/results",
+            "stream_url": f"/jobs/{job.id}/stream",
+        })
+
+    def handle_job_status(self, job_id):
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "Job not found"})
+            return
+        self.send_json(200, job.to_dict())
+
+    def handle_job_results(self, job_id):
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "Job not found"})
+            return
+        query = parse_qs(urlparse(self.path).query)
+        if 'cursor' not in query and 'limit' not in query:
+            # Check the version before touching the list, so a 304 costs no serialization
+            etag, updated_at = job.version()
+            if self.not_modified(etag, updated_at):
+                return
+            prospects, count, _ = job.page(0)
+            self.send_json_list(200, {"id": job.id, "state": job.state, "count": count, "error": job.error},
+                                'prospects', prospects, self.validator_headers(etag, updated_at))
+            return
+        try:
+            offset, limit = parse_page_params(query)
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        prospects, count, finished = job.page(offset, limit)
+        end = offset + len(prospects)
+        self.send_json(200, {
+            "id": job.id,
+            "state": job.state,
+            "count": count,
+            "prospects": prospects,
+            # A running job may still add prospects past the end, so keep a cursor for polling
+            "next_cursor": None if finished and end >= count else str(end),
+            "error": job.error,
+        }, last_modified=job.updated_at)
+
+    def handle_job_trace(self, job_id):
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "Job not found"})
+            return
+        self.send_json(200, job.trace())
+
+    def handle_cancel_job(self, job_id):
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "Job not found"})
+            return
+        self.server.jobs.cancel(job)
+        # Give a running scraper a moment to die so the partial results are final
+        job.done.wait(KILL_GRACE_SECONDS + 1)
+        self.send_json(200, {
+            "id": job.id,
+            "state": job.state,
+            "count": job.found,
+            "prospects": job.prospects,
+        })
+
+    def handle_cancel_batch(self, batch_id):
+        batch = self.server.jobs.get_batch(batch_id)
+        if batch is None:
+            self.send_json(404, {"error": "Batch not found"})
+            return
+        # Jobs shared with other callers through coalescing keep running for them
+        if batch.request_cancel():
+            for job in batch.jobs:
+                self.server.jobs.detach(job)
+        for job in batch.jobs:
+            job.done.wait(KILL_GRACE_SECONDS + 1)
+        self.send_json(200, batch.to_dict())
+
+    def handle_scrape_batch(self):
+        try:
+            data = self.read_json_body()
+            combinations = data.get('combinations')
+            if not isinstance(combinations, list) or not combinations:
+                raise ValueError("'combinations' must be a non-empty list of {state, service}")
+            if len(combinations) > MAX_BATCH_COMBINATIONS:
+                raise ValueError(f"at most {MAX_BATCH_COMBINATIONS} combinations per batch")
+            # Shared options apply to every combination unless it overrides them
+            shared = {key: value for key, value in data.items() if key != 'combinations'}
+            params_list = [parse_scrape_params(dict(shared, **combination)) for combination in combinations]
+        except Exception as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        batch = self.server.jobs.submit_batch(params_list, refresh=bool(data.get('refresh', False)))
+        print(f"Queued batch {batch.id} with {len(batch.jobs)} combinations")
+        self.send_json(202, {
+            "id": batch.id,
+            "total": len(batch.jobs),
+            "status_url": f"/batches/{batch.id}",
+            "results_url": f"/batches/{batch.id}/results",
+        })
+
+    def handle_batch_status(self, batch_id):
+        batch = self.server.jobs.get_batch(batch_id)
+        if batch is None:
+            self.send_json(404, {"error": "Batch not found"})
+            return
+        self.send_json(200, batch.to_dict())
+
+    def handle_batch_results(self, batch_id):
+        batch = self.server.jobs.get_batch(batch_id)
+        if batch is None:
+            self.send_json(404, {"error": "Batch not found"})
+            return
+        # Merging is the expensive part, so skip it when the client is up to date
+        etag, updated_at = batch.version()
+        if self.not_modified(etag, updated_at):
+            return
+        prospects, duplicates = batch.results()
+        self.send_json(200, {
+            "id": batch.id,
+            "state": batch.state,
+            "count": len(prospects),
+            "duplicates": duplicates,
+            "prospects": prospects,
+        }, etag=etag, last_modified=updated_at)
+
+    def handle_rate_limit_acquire(self):
+        """
+        Block until the caller may make one request to `host`. Scrapers call
+        this before each page load, passing the THOMASNET_JOB_ID they were
+        started with so the wait is charged to their job.
+        """
+        try:
+            data = self.read_json_body()
+            if not isinstance(data, dict):
+                raise ValueError("the body must be a JSON object")
+            host = data.get('host') or THOMASNET_HOST
+            job_id = data.get('job_id') or ''
+            if not isinstance(host, str) or not HOST_NAME.fullmatch(host.strip().lower()):
+                raise ValueError("'host' must be a host name")
+            if not isinstance(job_id, str):
+                raise ValueError("'job_id' must be a string")
+        except Exception as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        host = host.strip().lower()
+        job = self.server.jobs.get(job_id)
+        waited = self.server.jobs.wait_for_host(job, host)
+        self.send_json(200, {"host": host.lower(), "waited": round(waited, 3)})
+
+    def leads_or_404(self):
+        """The server's LeadStore, or None after answering 404 when it has none"""
+        if self.server.leads is None:
+            self.send_json(404, {"error": f"Leads API is disabled ({self.server.leads_disabled})"})
+        return self.server.leads
+
+    def handle_list_leads(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        try:
+            options = parse_lead_query(parse_qs(urlparse(self.path).query))
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        page, after = leads.page(**options)
+        self.send_json(200, {
+            "leads": page,
+            "count": len(page),
+            "next_cursor": encode_cursor([options['sort'], options['descending'], *after]) if after else None,
+        })
+
+    def handle_search_leads(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        if not leads.searchable:
+            self.send_json(501, {"error": "Lead search needs SQLite with FTS5"})
+            return
+        query = parse_qs(urlparse(self.path).query)
+        text = query.get('q', [''])[0]
+        limit = query.get('limit', [str(DEFAULT_SEARCH_LIMIT)])[0]
+        if fts_query(text) is None or not (limit.isascii() and limit.isdigit()) or int(limit) < 1:
+            self.send_json(400, {"error": "Invalid request: q needs a word to search for and limit must be positive"})
+            return
+        results, truncated = leads.search(text, min(int(limit), MAX_PAGE_LIMIT))
+        self.send_json(200, {"query": text, "leads": results, "count": len(results), "truncated": truncated})
+
+    def handle_export_leads(self):
+        """
+        Stream every lead as CSV (with leads.db's column names as the header,
+        so the file can go back in through /leads/import) or JSONL, a batch of
+        rows per chunk, gzipped when the client accepts it.
+        """
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        export_format = parse_qs(urlparse(self.path).query).get('format', ['csv'])[0]
+        if export_format not in LEAD_EXPORT_TYPES:
+            self.send_json(400, {"error": f"Invalid request: format must be one of {', '.join(LEAD_EXPORT_TYPES)}"})
+            return
+        self.start_chunked(200, LEAD_EXPORT_TYPES[export_format],
+                           {'Content-Disposition': f'attachment; filename="leads.{export_format}"'}, compress=True)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(LEAD_COLUMNS)
+        batches = leads.export()
+        try:
+            for rows in batches:
+                if export_format == 'csv':
+                    writer.writerows(rows)
                 else:
-                    return {"error": "Invalid scraper output format"}
-            except json.JSONDecodeError as e:
-                return {"error": f"Failed to parse scraper output: {e}. Output: {result.stdout[:200]}"}
-            
-        except subprocess.TimeoutExpired:
-            return {"error": "Scraper timed out after 5 minutes"}
+                    buffer.write(''.join(json.dumps(dict(zip(LEAD_COLUMNS, row))) + '\n' for row in rows))
+                self.write_chunk(buffer.getvalue().encode())
+                buffer.seek(0)
+                buffer.truncate()
+            self.write_chunk(buffer.getvalue().encode())
+            self.end_chunked()
+        except OSError:  # gone, or stalled past the socket timeout
+            print("Lead export client disconnected")
+            self.close_connection = True
+        finally:
+            batches.close()
+
+    def handle_lead_stats(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        days = parse_qs(urlparse(self.path).query).get('days', [str(DEFAULT_STATS_DAYS)])[0]
+        if not (days.isascii() and days.isdigit()) or not 1 <= int(days) <= MAX_STATS_DAYS:
+            self.send_json(400, {"error": f"Invalid request: days must be between 1 and {MAX_STATS_DAYS}"})
+            return
+        self.send_json(200, leads.stats(int(days)))
+
+    def handle_pull_changes(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        query = parse_qs(urlparse(self.path).query)
+        since = query.get('since', ['0'])[0]
+        limit = query.get('limit', [str(DEFAULT_SYNC_LIMIT)])[0]
+        if not is_path_id(since) or not (limit.isascii() and limit.isdigit()) or int(limit) < 1:
+            self.send_json(400, {"error": "Invalid request: since must be a version and limit a positive integer"})
+            return
+        changes, next_since, more = leads.changes(int(since), min(int(limit), MAX_PAGE_LIMIT))
+        self.send_json(200, {"changes": changes, "since": next_since, "more": more})
+
+    def handle_push_changes(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        try:
+            changes, force = parse_lead_changes(self.read_json_body())
         except Exception as e:
-            return {"error": f"Scraper failed: {str(e)}"}
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        applied, conflicts, version = leads.apply_changes(changes, force)
+        self.send_json(200, {"applied": applied, "conflicts": conflicts, "version": version})
 
+    def handle_queue(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        query = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+        try:
+            options = parse_queue_options(query)
+            limit = queue_number(query, 'limit', DEFAULT_PAGE_LIMIT, 1, MAX_PAGE_LIMIT)
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        if options['queue_id'] is not None and leads.custom_queue(options['queue_id']) is None:
+            self.send_json(404, {"error": "Queue not found"})
+            return
+        queue = leads.queue(limit=limit, **options)
+        self.send_json(200, {"leads": queue, "count": len(queue)})
+
+    def read_queue_request(self, *fields):
+        """
+        The JSON body of a /queue POST, checked for a `rep` and the integer
+        `fields`, or None once a 400 has been sent
+        """
+        try:
+            data = self.read_json_body()
+            if not isinstance(data, dict):
+                raise ValueError("the body must be a JSON object")
+            if not isinstance(data.get('rep'), str) or not data['rep'].strip():
+                raise ValueError("'rep' must name the rep")
+            for name in fields:
+                if not is_sqlite_int(data.get(name)):
+                    raise ValueError(f"'{name}' must be a 64-bit integer")
+            return data
+        except ValueError as e:  # no Content-Length, or not JSON
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return None
+
+    def handle_queue_next(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        data = self.read_queue_request()
+        if data is None:
+            return
+        try:
+            options = parse_queue_options(data)
+            hold = queue_number(data, 'hold', DEFAULT_QUEUE_HOLD, 1, MAX_QUEUE_HOLD)
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        if options['queue_id'] is not None and leads.custom_queue(options['queue_id']) is None:
+            self.send_json(404, {"error": "Queue not found"})
+            return
+        lead, reserved_until = leads.reserve_next(data['rep'].strip(), hold=hold, **options)
+        self.send_json(200, {"lead": lead, "reserved_until": reserved_until})
+
+    def handle_queue_called(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        data = self.read_queue_request('id')
+        if data is None:
+            return
+        outcome = data.get('outcome')
+        if outcome is not None and not isinstance(outcome, str):
+            self.send_json(400, {"error": "Invalid request: 'outcome' must be a string"})
+            return
+        lead, holder = leads.record_call(data['id'], data['rep'].strip(), outcome)
+        if lead is None:
+            self.send_json(404, {"error": "Lead not found"})
+        elif holder is not None:
+            self.send_json(409, {"error": f"Lead is reserved by {holder}", "rep": holder, "lead": lead})
+        else:
+            self.send_json(200, {"lead": lead})
+
+    def handle_queue_release(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        data = self.read_queue_request('id')
+        if data is None:
+            return
+        self.send_json(200, {"released": leads.release(data['id'], data['rep'].strip())})
+
+    def handle_custom_queues(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        self.send_json(200, {"queues": leads.custom_queues()})
+
+    def handle_custom_queue_page(self, queue_id):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        queue = leads.custom_queue(queue_id)
+        if queue is None:
+            self.send_json(404, {"error": "Queue not found"})
+            return
+        query = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+        try:
+            limit = queue_number(query, 'limit', DEFAULT_PAGE_LIMIT, 1, MAX_PAGE_LIMIT)
+            after = decode_cursor(query['cursor']) if query.get('cursor') else [0]
+            if len(after) != 1 or not is_sqlite_int(after[0]):
+                raise ValueError("cursor belongs to a different list")
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        page, position = leads.custom_queue_page(queue_id, after[0], limit)
+        self.send_json(200, dict(queue, leads=page, next_cursor=encode_cursor([position]) if position else None))
+
+    def handle_create_custom_queue(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        try:
+            data = parse_custom_queue_change(self.read_json_body(), new=True)
+        except (TypeError, ValueError) as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        self.send_json(201, leads.create_custom_queue(data['name'].strip(), data.get('description'),
+                                                      data['lead_ids']))
+
+    def handle_change_custom_queue(self, queue_id):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        try:
+            data = parse_custom_queue_change(self.read_json_body())
+        except (TypeError, ValueError) as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        result = leads.change_custom_queue(queue_id, data['add'], data['remove'])
+        if result is None:
+            self.send_json(404, {"error": "Queue not found"})
+        else:
+            self.send_json(200, result)
+
+    def handle_delete_custom_queue(self, queue_id):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        if leads.delete_custom_queue(queue_id):
+            self.send_json(200, {"id": queue_id, "deleted": True})
+        else:
+            self.send_json(404, {"error": "Queue not found"})
+
+    def handle_import_leads(self):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        existing = parse_qs(urlparse(self.path).query).get('existing', ['update'])[0]
+        if existing not in ('update', 'skip') or self.headers['Content-Length'] is None:
+            self.close_connection = True
+            self.send_json(400, {"error": "Invalid request: send the CSV as the body, with existing=update or skip"})
+            return
+        body = BodyReader(self.rfile, int(self.headers['Content-Length']))
+        start = time.perf_counter()
+        try:
+            result = leads.import_csv(io.TextIOWrapper(io.BufferedReader(body, 1 << 16), encoding='utf-8-sig',
+                                                       newline=''), existing)
+        except (ValueError, csv.Error) as e:  # UnicodeDecodeError is a ValueError
+            # Any of the body left unread closes the connection
+            self._body_unread = body.remaining > 0
+            self.send_json(400, {"error": f"Invalid CSV: {e}"})
+            return
+        self._body_unread = False
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        print(f"Imported {result['rows']} CSV rows: {result['imported']} new, {result['updated']} updated")
+        self.send_json(200, result)
+
+    def handle_get_lead(self, lead_id):
+        leads = self.leads_or_404()
+        if leads is None:
+            return
+        lead = leads.get(lead_id) if lead_id.isdigit() else None
+        if lead is None:
+            self.send_json(404, {"error": "Lead not found"})
+            return
+        self.send_json(200, lead)
+
+    def handle_metrics(self):
+        self.send_body(200, 'text/plain; version=0.0.4', self.server.render_metrics().encode())
+
+    def handle_cache_stats(self):
+        if self.server.cache is None:
+            self.send_json(200, {"enabled": False})
+            return
+        self.send_json(200, dict(self.server.cache.stats(), enabled=True))
 
     def log_message(self, format, *args):
         # Suppress default logging
         pass
 
-def run_server(port=8080):
+def run_server(port=8080, workers=DEFAULT_WORKERS, scraper_path=None, cache_path=DEFAULT_CACHE_PATH,
+               cache_ttl=DEFAULT_CACHE_TTL, cache_entries=DEFAULT_CACHE_ENTRIES, warm_workers=False,
+               worker_max_jobs=DEFAULT_WORKER_MAX_JOBS, worker_max_rss_mb=DEFAULT_WORKER_MAX_RSS_MB,
+               rate_limit=DEFAULT_RATE_LIMIT, rate_burst=DEFAULT_RATE_BURST, host_rates=None,
+               jobs_path=DEFAULT_JOBS_PATH, trace_path=None, leads_path=DEFAULT_LEADS_PATH,
+               migrate_leads=False):
     """Start the Thomasnet scraper server"""
     server_address = ('', port)
-    httpd = HTTPServer(server_address, ThomasnetHandler)
-    print(f"Thomasnet scraper server running on port {port}")
+    httpd = ThomasnetServer(server_address, ThomasnetHandler, workers=workers, scraper_path=scraper_path,
+                            cache_path=cache_path, cache_ttl=cache_ttl, cache_entries=cache_entries,
+                            warm_workers=warm_workers, worker_max_jobs=worker_max_jobs,
+                            worker_max_rss_mb=worker_max_rss_mb, rate_limit=rate_limit,
+                            rate_burst=rate_burst, host_rates=host_rates, jobs_path=jobs_path,
+                            trace_path=trace_path, leads_path=leads_path, migrate_leads=migrate_leads)
+    print(f"Thomasnet scraper server running on port {port} "
+          f"({workers} {'warm' if warm_workers else 'scrape'} workers)")
     print(f"Health check: http://localhost:{port}/health")
     print(f"Scrape endpoint: http://localhost:{port}/scrape")
-    
+    print(f"Job endpoint: http://localhost:{port}/jobs")
+    print(f"Batch endpoint: http://localhost:{port}/scrape/batch")
+    print(f"Metrics: http://localhost:{port}/metrics")
+    print(f"Streaming endpoint: http://localhost:{port}/scrape/stream")
+    print(f"Rate limit: {rate_limit} requests/s per host (burst {rate_burst})")
+    if cache_path:
+        print(f"Result cache: {cache_path} (ttl {cache_ttl}s, {cache_entries} entries)")
+    if jobs_path:
+        print(f"Job store: {jobs_path} ({httpd.resumed_jobs} interrupted jobs resumed)")
+    if trace_path:
+        print(f"Job traces: {trace_path}")
+    if httpd.leads is not None:
+        print(f"Leads: http://localhost:{port}/leads ({leads_path})")
+
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down server...")
         httpd.shutdown()
+    finally:
+        httpd.server_close()
+
+def parse_args(argv=None):
+    """Parse command line options for the server"""
+    parser = argparse.ArgumentParser(description="Thomasnet scraper HTTP server")
+    parser.add_argument('port', nargs='?', type=int, default=8080, help="port to listen on (default 8080)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"maximum number of scrapes run in parallel (default {DEFAULT_WORKERS})")
+    parser.add_argument('--scraper', default=None,
+                        help="path to the command-line scraper (default thomasnet-scraper/run_scraper.py)")
+    parser.add_argument('--cache-db', default=str(DEFAULT_CACHE_PATH),
+                        help="SQLite file for cached scrape results (default scrape_cache.db)")
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+                        help=f"seconds a cached result stays fresh; 0 disables the cache (default {DEFAULT_CACHE_TTL})")
+    parser.add_argument('--cache-entries', type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help=f"maximum cached searches before LRU eviction (default {DEFAULT_CACHE_ENTRIES})")
+    parser.add_argument('--warm-workers', action='store_true',
+                        help="keep --workers scraper processes running between jobs instead of spawning one per job")
+    parser.add_argument('--worker-max-jobs', type=int, default=DEFAULT_WORKER_MAX_JOBS,
+                        help=f"recycle a warm worker after this many jobs (default {DEFAULT_WORKER_MAX_JOBS})")
+    parser.add_argument('--worker-max-rss', type=int, default=DEFAULT_WORKER_MAX_RSS_MB,
+                        help=f"recycle a warm worker once it uses this many MB (default {DEFAULT_WORKER_MAX_RSS_MB})")
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                        help=f"requests per second allowed to each host across all jobs (default {DEFAULT_RATE_LIMIT})")
+    parser.add_argument('--rate-burst', type=int, default=DEFAULT_RATE_BURST,
+                        help=f"requests a host may receive back to back (default {DEFAULT_RATE_BURST})")
+    parser.add_argument('--host-rate', type=parse_host_rate, action='append', default=[],
+                        metavar='HOST=RATE[:BURST]', help="per-host rate limit override; may be repeated")
+    parser.add_argument('--jobs-db', default=str(DEFAULT_JOBS_PATH),
+                        help="SQLite file that keeps jobs across restarts so they can resume; "
+                             "empty to disable (default scrape_jobs.db)")
+    parser.add_argument('--trace-log', metavar='PATH',
+                        help="JSON lines file to append job phase spans to; it grows with every job, "
+                             "so it is off unless given")
+    parser.add_argument('--leads-db', default=str(DEFAULT_LEADS_PATH),
+                        help="the CRM's leads.db, served at /leads and skipped by new_only scrapes; "
+                             "empty to disable (default leads.db)")
+    parser.add_argument('--migrate-leads', action='store_true',
+                        help="upgrade an existing --leads-db written before this version in place, "
+                             "adding the tables, indexes and triggers the /leads API needs")
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
-    run_server(port)
+    args = parse_args()
+    run_server(args.port, workers=args.workers, scraper_path=args.scraper,
+               cache_path=args.cache_db if args.cache_ttl > 0 else None,
+               cache_ttl=args.cache_ttl, cache_entries=args.cache_entries, warm_workers=args.warm_workers,
+               worker_max_jobs=args.worker_max_jobs, worker_max_rss_mb=args.worker_max_rss,
+               rate_limit=args.rate_limit, rate_burst=args.rate_burst, host_rates=dict(args.host_rate),
+               jobs_path=args.jobs_db or None, trace_path=args.trace_log or None,
+               leads_path=args.leads_db or None, migrate_leads=args.migrate_leads)